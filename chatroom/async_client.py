@@ -1,35 +1,54 @@
-import threading
 import uuid
 import asyncio
+import functools
+import inspect
+import time
 
-from chatroom.client import Client
+import socketio
 
-from chatroom.utils import Event, AsyncEvent, EmitError
+from chatroom.client import Client, PROCESS_EXECUTOR
+from chatroom.stream import AsyncRPCStream
+from chatroom.fragment import estimate_size, split
+from chatroom.outbox import LANES
+from chatroom.utils import SOCKETIO_PATHS
+
+from chatroom.utils import AsyncEvent, EmitError, RPCCancelledError
 from logzero import setup_logger
 
 logger = setup_logger("chatroom.client")
 
-from socketIO_client import SocketIO, BaseNamespace
 
-class ChatNamespace(BaseNamespace):
-    def on_event(self, event, *args):
-        print("Without match eventhandler {}".format(event))
+class AsyncClient(Client):
+    def __init__(self, path, server_name, max_workers=2, event_loop=None,
+                 executor=None, max_concurrent_requests=100, **kwargs):
+        if event_loop is None:
+            event_loop = asyncio.get_event_loop()
+
+        super().__init__(path, server_name, max_workers=max_workers, event_loop=event_loop, **kwargs)
 
+        self.sweep_task = None
 
-class AsyncClient(Client):
-    def __init__(self, path, server_name, max_workers=2, event_loop=None):
-        if event_loop:
-            self._event_loop = event_loop
+        # The coroutine handlers run in the event loop, the plain functions run in the executor
+        if executor is not None:
+            self.request_handler_executor = executor
         else:
-            self._event_loop = asyncio.get_event_loop()
+            self.request_handler_executor = self.request_handler_thread_executor
 
-        super().__init__(path, server_name, max_workers=2)
+        # The limit of the RPC requests handled at the same time, the others wait for the semaphore
+        self.request_semaphore = asyncio.Semaphore(max_concurrent_requests)
 
+        # id -> the task handling the request, the task is cancelled when the caller cancels the request
+        self.request_tasks = {}
+
+        self.fragment_credits = asyncio.Semaphore(self.fragment_window)
+
+        self.publish_ready = asyncio.Event()
+        self.publish_ready.set()
 
     async def connect(self):
-        # Search the server by mDNS
+        # Search the server by mDNS, the browser blocks so it waits in the executor
         logger.info("Use mDNS to search the ip and port of servier {}".format(self.server_name))
-        service = self.browser.wait(self.server_name)
+        service = await self.event_loop.run_in_executor(None, self.browser.wait, self.server_name)
         if service is None:
             msg = "Can't find the server, try again..."
             logger.error(msg)
@@ -37,67 +56,120 @@ class AsyncClient(Client):
 
         # Use zeroconf to find the chatroom server
         self.service = service
+        serializer = self.get_serializer(service)
         logger.info("Found service at {}:{}".format(service.address, service.port))
-        logger.info("Try to connect to the service by socket.io")
-        self.socket_io = SocketIO(service.address, service.port)
-
-        # This thread handles the socket.io message
-        self.socket_io_wait_thread = threading.Thread(target=self.socket_io.wait, daemon=True)
-        self.socket_io_wait_thread.start()
+        logger.info("Try to connect to the service by socket.io with the {} serializer".format(serializer))
+        self.socket_io = socketio.AsyncClient(serializer=self.get_packet_serializer(serializer))
 
         # Register RPC response handler
         logger.info("Register RPC request/response Handler")
-        self.channel = self.socket_io.define(ChatNamespace, '/chat')
-        self.channel.on('rpc_request', self.on_rpc_request)
-        self.channel.on('rpc_response', self.on_rpc_response)
-        self.channel.on('publish', self.on_publish)
+        self.socket_io.on('rpc_request', self.on_rpc_request, namespace='/chat')
+        self.socket_io.on('rpc_response', self.on_rpc_response, namespace='/chat')
+        self.socket_io.on('rpc_credit', self.on_rpc_credit, namespace='/chat')
+        self.socket_io.on('rpc_cancel', self.on_rpc_cancel, namespace='/chat')
+        self.socket_io.on('backpressure', self.on_backpressure, namespace='/chat')
+        self.socket_io.on('rate_limit', self.on_rate_limit, namespace='/chat')
+        self.socket_io.on('publish', self.on_publish, namespace='/chat')
+        self.socket_io.on('echo', self.on_echo, namespace='/chat')
+
+        # The socket.io messages are handled in the event loop, no extra thread is needed
+        await self.socket_io.connect("http://{}:{}".format(service.address, service.port), namespaces=['/chat'],
+                                     socketio_path=SOCKETIO_PATHS[serializer], transports=service.transports)
+
+        # This task sweeps the expired RPC requests
+        self.sweep_task = self.event_loop.create_task(self._sweep_pending_requests())
 
         # Register self information to chatroom server
-        result = await self.emit("register", {
-            "path": self.path
-        })
+        result = await self.emit("register", self.get_register_info())
 
         if result is None:
             raise RuntimeError("Can't register to the server {}:{}".format(self.service.address, self.service.port))
         else:
             logger.info("Connect and register to the server {}:{}".format(self.service.address, self.service.port))
+            self.codec.negotiate(result.get("codecs"))
 
-    def create_event(self):
-        return AsyncEvent(loop=self.event_loop)
+    async def disconnect(self):
+        if self.sweep_task:
+            self.sweep_task.cancel()
 
-    async def emit(self, event_type, data, timeout=3600):
-        uid = str(uuid.uuid1())
-        data["_uid"] = uid
+        await self.socket_io.disconnect()
 
-        # Register the callback function for the emit response
-        event = self.create_event()
+    async def _sweep_pending_requests(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            expired = self.pending_requests.sweep()
+            if expired:
+                logger.error("{} RPC requests are timeout".format(expired))
+
+            dropped = self.reassembler.sweep()
+            if dropped:
+                logger.error("{} fragmented messages are incomplete".format(dropped))
 
-        def wait_emit_response(emit_response):
-            nonlocal event
-            event.set_msg(emit_response)
+            self._sweep_rpc_cancelled()
+
+    def create_event(self):
+        # The events are always set in the event loop thread
+        return AsyncEvent(loop=self.event_loop, threadsafe=False)
 
-        self.channel.once(uid, wait_emit_response)
-        self.channel.emit(event_type, data)
+    async def emit(self, event_type, data, timeout=3600, ack=True):
+        # Fire and forget, the server doesn't reply the message
+        if not ack:
+            await self.socket_io.emit(event_type, data, namespace='/chat')
+            return None
 
+        # The server replies by the Socket.IO ack instead of the uid event
         try:
-            result = await event.wait(timeout=timeout)
-            if result.get("success") is False:
-                msg = result.get("message")
-                logger.error("Emit {} failed, error msg {}".format(event_type, result.get("message")))
-                raise EmitError(msg)
-            else:
-                logger.info("Send event {} successfully".format(event_type))
-                return result
-        except TimeoutError as e:
-            logger.error("Emit event {} is timeout".format(event_type))
-            raise e
+            result = await self.socket_io.call(event_type, data, namespace='/chat', timeout=timeout)
+        except socketio.exceptions.TimeoutError:
+            msg = "Emit event {} is timeout".format(event_type)
+            logger.error(msg)
+            raise TimeoutError(msg)
+
+        if result.get("success") is False:
+            msg = result.get("error")
+            logger.error("Emit {} failed, error msg {}".format(event_type, msg))
+            raise EmitError(msg)
+        else:
+            logger.info("Send event {} successfully".format(event_type))
+            return result
+
+    async def emit_message(self, event_type, data, ack=False, priority=None):
+        # The rpc_request, rpc_response and publish messages may be large, the priority is the lane of the message
+        # in the outbox of the slow receiver, e.g. "bulk" for the large transfers
+        if priority is not None:
+            if priority not in LANES:
+                raise ValueError("The priority should be one of {}".format(", ".join(LANES)))
+            data = dict(data, priority=priority)
+
+        if self.fragment_size is None or estimate_size(data.get("payload"), self.fragment_size) <= self.fragment_size:
+            return await self.emit(event_type, data, ack=ack)
+
+        frames = list(split(data, self.fragment_size))
+        for frame in frames[:-1]:
+            try:
+                await asyncio.wait_for(self.fragment_credits.acquire(), self.pending_requests.timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("The fragments of {} are not acked".format(event_type))
+
+            await self.socket_io.emit(event_type, frame, namespace='/chat', callback=self._on_fragment_ack)
+
+        return await self.emit(event_type, frames[-1], ack=ack)
+
+    async def emit_many(self, messages, timeout=3600, ack=True):
+        # The messages is a list of (event_type, data), only rpc_request, rpc_response, publish and echo
+        # can be sent in one batch event
+        items = [dict(data, type=event_type) for event_type, data in messages]
+
+        return await self.emit("batch", {
+            "items": items
+        }, timeout=timeout, ack=ack)
 
     #########################################################################################################
     #
     #   RPC
     #
     #########################################################################################################
-    async def echo(self, message):
+    async def echo(self, message, timeout=None):
         event = self.create_event()
 
         payload = dict(
@@ -106,15 +178,19 @@ class AsyncClient(Client):
                 message=message
             )
         )
-        self.channel.once("echo", lambda echo_message: event.set_msg(echo_message))
-
-        await self.emit("echo", payload)
-        result = await event.wait()
+        self.echo_events.append(event)
 
-        return result
+        # The lost echo doesn't take the reply of the following one
+        try:
+            await self.emit("echo", payload)
+            return await event.wait(timeout or self.pending_requests.timeout)
+        except BaseException:
+            if event in self.echo_events:
+                self.echo_events.remove(event)
+            raise
 
     # Send Request
-    async def send_rpc_request(self, target, method, parameters):
+    async def send_rpc_request(self, target, method, parameters, timeout=None, stream=False, priority=None):
         id = str(uuid.uuid1())
 
         payload = dict(
@@ -122,26 +198,88 @@ class AsyncClient(Client):
             payload=dict(
                 id=id,
                 method=method,
-                parameters=parameters
+                parameters=self.codec.encode(parameters),
+                timeout=timeout or self.pending_requests.timeout
             )
         )
 
-        await self.emit('rpc_request', payload)
+        # The streaming request returns the async iterator of the chunks, only its receiving side is pending
+        if stream:
+            payload["payload"]["window"] = self.rpc_stream_window
+            event = self.create_stream(id)
+            pending = event.sink
+        else:
+            event = pending = self.create_event()
+            event.id = id
+
+        # Register the event before sending, the response may arrive at any time
+        self.pending_requests.add(id, pending, timeout=timeout)
 
-        event = self.create_event()
-        self.rpc_request_events[id] = event
+        # The server doesn't ack the request, the response is routed back by the id
+        await self.emit_message('rpc_request', payload, priority=priority)
 
         return event
 
-    async def _handle_rpc_request(self, data):
-        # Get the request information from SocketIO data
-        source = data.get("path")
+    def create_stream(self, id):
+        return AsyncRPCStream(id, self.rpc_stream_window, self._send_rpc_credit, self._cancel_rpc_request,
+                              self.event_loop)
+
+    async def _send_rpc_credit(self, id, credit):
+        await self.emit('rpc_credit', dict(
+            payload=dict(
+                id=id,
+                credit=credit
+            )
+        ), ack=False)
+
+    def on_rpc_request(self, data):
+        data = self.reassembler.reassemble(data)
+        if data is None:
+            return
+
+        # Every request is handled in its own task, a slow handler doesn't block the others. The request cancelled
+        # before its last fragment arrives is skipped
+        id = data.get("payload", {}).get("id")
+        if self.rpc_cancelled.pop(id, None) is not None:
+            return
+
+        task = self.event_loop.create_task(self._handle_rpc_request(data))
+        self.request_tasks[id] = task
+        task.add_done_callback(lambda _: self.request_tasks.pop(id, None))
+
+    def on_rpc_cancel(self, data):
         payload = data.get("payload", {})
+        logger.info("RPC request {} is cancelled, {}".format(payload.get("id"), payload.get("error")))
+
+        # The coroutine API receives the CancelledError, the function running in the executor can't be stopped
+        # but its result is dropped
+        task = self.request_tasks.get(payload.get("id"))
+        if task is not None:
+            task.cancel()
+        else:
+            self.rpc_cancelled[payload.get("id")] = time.monotonic() + self.pending_requests.timeout
+
+    async def cancel_rpc_request(self, event):
+        if not await self._cancel_rpc_request(event.id):
+            return False
+
+        event.set_error(RPCCancelledError("The request {} is cancelled".format(event.id)))
+        return True
+
+    async def _cancel_rpc_request(self, id):
+        if self.pending_requests.pop(id) is None:
+            return False
+
+        await self.emit('rpc_cancel', dict(
+            payload=dict(
+                id=id
+            )
+        ), ack=False)
+        return True
 
-        # Get the RPC information from payload
-        id = payload.get("id")
-        method = payload.get("method")
-        parameters = payload.get("parameters")
+    async def _handle_rpc_request(self, data):
+        source, id, method, parameters = self._parse_rpc_request(data)
+        window = data.get("payload", {}).get("window")
 
         # Check the method is existing
         fn = self.rpc_apis.get(method, None)
@@ -149,36 +287,128 @@ class AsyncClient(Client):
         error = None
 
         if fn is None:
-            error = "The method {} is not existing"
+            error = "The method {} is not existing".format(method)
         else:
             try:
-                result = fn(**parameters)
+                async with self.request_semaphore:
+                    result = await self._call_rpc_api(method, fn, parameters)
+
+                    # The items of the generator are streamed when the caller asks for it, otherwise sent as a list
+                    if inspect.isgenerator(result) or inspect.isasyncgen(result):
+                        if window:
+                            return await self._send_rpc_stream(source, id, result, window)
+                        result = [item async for item in self._iterate_rpc_result(result)]
+            except asyncio.CancelledError:
+                # The caller doesn't wait for the response of the cancelled request
+                return
             except Exception as e:
                 logger.exception(e)
                 error = str(e)
 
-        await self.emit('rpc_response', dict(
+        await self._send_rpc_response(source, id, result, error)
+
+    async def _call_rpc_api(self, method, fn, parameters):
+        parameters = self.codec.decode(parameters)
+
+        if asyncio.iscoroutinefunction(fn):
+            return await fn(**parameters)
+
+        # The async generator runs in the event loop as the coroutine
+        if inspect.isasyncgenfunction(fn):
+            return fn(**parameters)
+
+        # The plain function may block, it runs in the executor to keep the event loop responsive
+        if self.rpc_api_executors.get(method) == PROCESS_EXECUTOR:
+            executor = self.request_handler_process_executor
+        else:
+            executor = self.request_handler_executor
+
+        return await self.event_loop.run_in_executor(executor, functools.partial(fn, **parameters))
+
+    async def _iterate_rpc_result(self, items):
+        if inspect.isasyncgen(items):
+            async for item in items:
+                yield item
+            return
+
+        # Every item of the plain generator may block, it's produced in the executor
+        end = object()
+        while True:
+            item = await self.event_loop.run_in_executor(self.request_handler_executor, next, items, end)
+            if item is end:
+                return
+            yield item
+
+    async def _send_rpc_stream(self, source, id, items, window):
+        credits = self.rpc_stream_credits[id] = asyncio.Semaphore(window)
+        error = None
+
+        try:
+            async for item in self._iterate_rpc_result(items):
+                # Wait for the caller to consume the chunks, the caller which is gone stops the stream
+                try:
+                    await asyncio.wait_for(credits.acquire(), self.pending_requests.timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError("The stream {} is not consumed by the caller".format(id))
+
+                await self._send_rpc_response(source, id, item, None, more=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(e)
+            error = str(e)
+        finally:
+            self.rpc_stream_credits.pop(id, None)
+            if inspect.isasyncgen(items):
+                await items.aclose()
+            elif inspect.getgeneratorstate(items) != inspect.GEN_RUNNING:
+                # The generator cancelled while producing an item in the executor is left to finish
+                items.close()
+
+        await self._send_rpc_response(source, id, None, error, end=True)
+
+    async def _send_rpc_response(self, source, id, result, error, **flags):
+        await self.emit_message('rpc_response', dict(
             path=source,
             payload=dict(
                 id=id,
-                result=result,
-                error=error
+                result=self.codec.encode(result),
+                error=error,
+                **flags
             )
-        ))
+        ), ack=False)
 
     # Publish / Subscribe
-    async def publish(self, data):
-        await self.emit("publish", {
-            "payload": data
-        })
+    async def publish(self, data, ack=False, priority=None):
+        try:
+            await asyncio.wait_for(self.publish_ready.wait(), self.pending_requests.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("The subscribers {} are congested".format(self.get_congested_paths()))
 
-    async def subscribe(self, target, callback):
-        await self.emit("subscribe", dict(
+        await self.emit_message("publish", {
+            "payload": self.codec.encode(data)
+        }, ack=ack, priority=priority)
+
+    async def subscribe(self, target, callback, replay=True):
+        # The kept messages of the publishers are replayed before the ack, the callback is added first
+        self._add_subscribe(target, callback)
+
+        try:
+            await self.emit("subscribe", dict(
+                path=target,
+                replay=replay
+            ))
+        except Exception:
+            self._remove_subscribe(target)
+            raise
+
+    async def unsubscribe(self, target):
+        await self.emit("unsubscribe", dict(
             path=target
         ))
 
-        self.subscribes[target] = callback
+        self._remove_subscribe(target)
 
 if __name__ == "__main__":
-    client = Client("testing", "turing")
-    client.connect()
+    client = AsyncClient("testing", "turing")
+    asyncio.get_event_loop().run_until_complete(client.connect())
@@ -0,0 +1,329 @@
+"""
+The benchmark of the echo round trip, the RPC throughput and the publish fan-out latency against the in-repo server.
+
+    python -m chatroom.bench --save           # Run and save the results as the baseline
+    python -m chatroom.bench                  # Run and compare the results with the baseline
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+
+from logzero import setup_logger
+
+from chatroom.async_client import AsyncClient
+from chatroom.client import Client
+from chatroom.server import Server
+from chatroom.zeroconf_browser import Browser
+
+logger = setup_logger("chatroom.bench")
+
+DEFAULT_BASELINE = "bench_baseline.json"
+
+# The lost message fails the run instead of hanging it
+TIMEOUT = 30
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def at(ratio):
+        return samples[min(len(samples) - 1, int(len(samples) * ratio))] * 1000
+
+    return {
+        "p50_ms": at(0.5),
+        "p90_ms": at(0.9),
+        "p99_ms": at(0.99),
+        "max_ms": samples[-1] * 1000
+    }
+
+
+def start_server(name, address, port):
+    server = Server(name, address, port, "bench")
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        server.start(handle_signals=False)
+
+    threading.Thread(target=run, daemon=True).start()
+    return server
+
+
+##################################################################################################################
+#
+#   Client
+#
+##################################################################################################################
+def bench_echo(server_name, browser, count):
+    client = Client("bench.echo.client", server_name, browser=browser)
+    client.connect()
+
+    samples = []
+    try:
+        for index in range(count):
+            start = time.perf_counter()
+            client.echo(index)
+            samples.append(time.perf_counter() - start)
+    finally:
+        client.disconnect()
+
+    return percentiles(samples)
+
+
+def bench_rpc(server_name, browser, concurrency, count):
+    # Every level has its own path, the clients of the previous levels are still registered
+    path = "bench.rpc.target.c{}".format(concurrency)
+    target = Client(path, server_name, browser=browser, max_workers=concurrency)
+    target.connect()
+    target.register_rpc_api("echo", lambda message: message)
+
+    client = Client("bench.rpc.client", server_name, browser=browser)
+    client.connect()
+
+    # Keep the number of the requests in flight at the concurrency
+    try:
+        start = time.perf_counter()
+        for _ in range(count // concurrency):
+            events = [client.send_rpc_request(path, "echo", {"message": index}, timeout=TIMEOUT)
+                      for index in range(concurrency)]
+            for event in events:
+                event.wait(TIMEOUT)
+        elapsed = time.perf_counter() - start
+    finally:
+        client.disconnect()
+        target.disconnect()
+
+    return {
+        "requests_per_second": (count // concurrency) * concurrency / elapsed
+    }
+
+
+def bench_publish(server_name, browser, subscribers, count):
+    path = "bench.publish.publisher.s{}".format(subscribers)
+    publisher = Client(path, server_name, browser=browser)
+    publisher.connect()
+
+    lock = threading.Lock()
+    done = threading.Event()
+    received = []
+    samples = []
+
+    def on_publish(data):
+        with lock:
+            received.append(time.perf_counter() - data["time"])
+            if len(received) == subscribers:
+                done.set()
+
+    clients = [publisher]
+    try:
+        for index in range(subscribers):
+            subscriber = Client("bench.publish.subscriber", server_name, browser=browser)
+            subscriber.connect()
+            clients.append(subscriber)
+            subscriber.subscribe(path, on_publish)
+
+        for index in range(count):
+            done.clear()
+            publisher.publish({"time": time.perf_counter()})
+            if not done.wait(TIMEOUT):
+                raise TimeoutError("{} of {} subscribers received the message {}".format(
+                    len(received), subscribers, index))
+
+            # The latency of the fan-out is the time until the last subscriber receives the message
+            with lock:
+                samples.append(max(received))
+                received.clear()
+    finally:
+        for client in clients:
+            client.disconnect()
+
+    return percentiles(samples)
+
+
+##################################################################################################################
+#
+#   AsyncClient
+#
+##################################################################################################################
+async def bench_async_echo(server_name, browser, count):
+    client = AsyncClient("bench.async.echo.client", server_name, browser=browser)
+    await client.connect()
+
+    samples = []
+    try:
+        for index in range(count):
+            start = time.perf_counter()
+            await asyncio.wait_for(client.echo(index), TIMEOUT)
+            samples.append(time.perf_counter() - start)
+    finally:
+        await client.disconnect()
+
+    return percentiles(samples)
+
+
+async def bench_async_rpc(server_name, browser, concurrency, count):
+    path = "bench.async.rpc.target.c{}".format(concurrency)
+    target = AsyncClient(path, server_name, browser=browser,
+                         max_concurrent_requests=concurrency)
+    await target.connect()
+
+    async def echo(message):
+        return message
+
+    target.register_rpc_api("echo", echo)
+
+    client = AsyncClient("bench.async.rpc.client", server_name, browser=browser)
+    await client.connect()
+
+    async def worker(requests):
+        for index in range(requests):
+            event = await client.send_rpc_request(path, "echo", {"message": index}, timeout=TIMEOUT)
+            await event.wait(TIMEOUT)
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(count // concurrency) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    finally:
+        await client.disconnect()
+        await target.disconnect()
+
+    return {
+        "requests_per_second": (count // concurrency) * concurrency / elapsed
+    }
+
+
+async def bench_async_publish(server_name, browser, subscribers, count):
+    path = "bench.async.publish.publisher.s{}".format(subscribers)
+    publisher = AsyncClient(path, server_name, browser=browser)
+    await publisher.connect()
+
+    done = asyncio.Event()
+    received = []
+    samples = []
+
+    def on_publish(data):
+        received.append(time.perf_counter() - data["time"])
+        if len(received) == subscribers:
+            done.set()
+
+    clients = [publisher]
+    try:
+        for index in range(subscribers):
+            subscriber = AsyncClient("bench.async.publish.subscriber", server_name, browser=browser)
+            await subscriber.connect()
+            clients.append(subscriber)
+            await subscriber.subscribe(path, on_publish)
+
+        for index in range(count):
+            done.clear()
+            await publisher.publish({"time": time.perf_counter()})
+            try:
+                await asyncio.wait_for(done.wait(), TIMEOUT)
+            except asyncio.TimeoutError:
+                raise TimeoutError("{} of {} subscribers received the message {}".format(
+                    len(received), subscribers, index))
+
+            samples.append(max(received))
+            received.clear()
+    finally:
+        for client in clients:
+            await client.disconnect()
+
+    return percentiles(samples)
+
+
+##################################################################################################################
+#
+#   Baseline
+#
+##################################################################################################################
+def run(server_name, count, concurrency_levels, subscriber_levels):
+    browser = Browser()
+    browser.start()
+
+    results = {}
+    loop = asyncio.get_event_loop()
+
+    logger.info("Benchmark the echo round trip")
+    results["echo.client"] = bench_echo(server_name, browser, count)
+    results["echo.async_client"] = loop.run_until_complete(bench_async_echo(server_name, browser, count))
+
+    for concurrency in concurrency_levels:
+        logger.info("Benchmark the RPC throughput, concurrency {}".format(concurrency))
+        results["rpc.client.c{}".format(concurrency)] = bench_rpc(server_name, browser, concurrency, count)
+        results["rpc.async_client.c{}".format(concurrency)] = loop.run_until_complete(
+            bench_async_rpc(server_name, browser, concurrency, count))
+
+    for subscribers in subscriber_levels:
+        logger.info("Benchmark the publish fan-out, {} subscribers".format(subscribers))
+        results["publish.client.s{}".format(subscribers)] = bench_publish(server_name, browser, subscribers, count)
+        results["publish.async_client.s{}".format(subscribers)] = loop.run_until_complete(
+            bench_async_publish(server_name, browser, subscribers, count))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # The latency (_ms) is better when lower, the throughput (_per_second) is better when higher
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            if not base:
+                continue
+
+            if metric.endswith("_ms"):
+                change = value / base - 1
+            else:
+                change = base / value - 1
+
+            if change > tolerance:
+                regressions.append("{} {}: {:.3f} -> {:.3f} ({:+.0%})".format(name, metric, base, value, change))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="The benchmark of the chatroom server and clients")
+    parser.add_argument("--server-name", default="chatroom-bench")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6544)
+    parser.add_argument("--count", type=int, default=1000, help="The number of the messages of each benchmark")
+    parser.add_argument("--concurrency", default="1,10,100", help="The RPC requests in flight")
+    parser.add_argument("--subscribers", default="1,100,1000", help="The subscribers of the publish fan-out")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save", action="store_true", help="Save the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="The ratio of the change to be a regression")
+    args = parser.parse_args()
+
+    start_server(args.server_name, args.address, args.port)
+
+    results = run(args.server_name, args.count,
+                  [int(level) for level in args.concurrency.split(",")],
+                  [int(level) for level in args.subscribers.split(",")])
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        logger.info("Save the baseline to {}".format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        logger.info("The baseline {} is not existing, run with --save to create it".format(args.baseline))
+        return 0
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+
+    for regression in regressions:
+        logger.error("Regression {}".format(regression))
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,175 @@
+import asyncio
+import itertools
+import os
+import pickle
+import struct
+
+from logzero import setup_logger
+
+logger = setup_logger("chatroom.bus")
+
+# The frame is the length of the pickled message and the message
+HEADER = struct.Struct("!I")
+
+# The bytes waiting for a worker which doesn't read its connection, the connection is reset over it
+MAX_BUFFER = 64 * 1024 * 1024
+
+
+class Bus:
+    """
+    The local bus between the workers of one server. Every worker listens on its Unix socket and connects to the
+    sockets of the other workers, the messages to a worker are sent in order by its connection. The sockets are
+    in the private folder of the server, only the workers of the same user can connect.
+    """
+    def __init__(self, index, paths, handler, on_connect=None, on_disconnect=None, timeout=60, max_buffer=MAX_BUFFER):
+        self.index = index
+        self.paths = paths
+
+        # handler(message) is awaited for every message from the other workers in order, the result of the call is
+        # sent back. The handler must not call the other workers, the following messages wait for it
+        self.handler = handler
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.timeout = timeout
+
+        # The worker which is stuck is disconnected like the slow client with the disconnect policy, it's told to
+        # remove the clients of this worker and receives them again by the sync of the new connection
+        self.max_buffer = max_buffer
+
+        # worker -> the writer of the connection to the worker, the writer of the connection from a worker -> the
+        # task reading it, worker -> the writer of the latest connection from the worker
+        self.writers = {}
+        self.connections = {}
+        self.peer_connections = {}
+
+        # call id -> the future of the result
+        self.calls = {}
+        self.call_ids = itertools.count()
+
+        self.server = None
+        self.tasks = []
+
+    @property
+    def peers(self):
+        return [index for index in range(len(self.paths)) if index != self.index]
+
+    async def start(self):
+        path = self.paths[self.index]
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.server = await asyncio.start_unix_server(self._serve, path=path)
+        self.tasks = [asyncio.ensure_future(self._connect(peer)) for peer in self.peers]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+        # The connections closed by the stopping worker aren't reported as the gone workers
+        if self.server is not None:
+            self.server.close()
+
+        for writer in list(self.writers.values()) + list(self.connections):
+            writer.close()
+        self.writers.clear()
+
+        # The readers end by the EOF of the closed connections
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+
+        if self.server is not None:
+            await self.server.wait_closed()
+
+    def send(self, peer, message):
+        # The message to the worker which is not connected yet is dropped, it syncs the state when connected
+        writer = self.writers.get(peer)
+        if writer is None:
+            return False
+
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            logger.error("Worker {} doesn't read the bus, reset the connection".format(peer))
+            self.writers.pop(peer, None)
+            writer.transport.abort()
+            return False
+
+        data = pickle.dumps(dict(message, worker=self.index), protocol=pickle.HIGHEST_PROTOCOL)
+        writer.write(HEADER.pack(len(data)))
+        writer.write(data)
+        return True
+
+    def broadcast(self, message):
+        for peer in list(self.writers):
+            self.send(peer, message)
+
+    async def call(self, peer, message):
+        # Send the message and wait for the result of the handler of the worker
+        id = next(self.call_ids)
+        future = self.calls[id] = asyncio.get_event_loop().create_future()
+
+        try:
+            if not self.send(peer, dict(message, call=id)):
+                raise ConnectionError("The worker {} is not connected".format(peer))
+
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self.calls.pop(id, None)
+
+    async def _connect(self, peer):
+        # The workers start at the same time, retry until the worker listens
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.paths[peer])
+            except OSError:
+                await asyncio.sleep(0.1)
+                continue
+
+            self.writers[peer] = writer
+            logger.info("Worker {} connects to worker {}".format(self.index, peer))
+            if self.on_connect is not None:
+                self.on_connect(peer)
+
+            # Only the other side writes to the listening socket, the EOF means the worker is gone
+            await reader.read()
+            self.writers.pop(peer, None)
+            writer.close()
+            logger.error("Worker {} is disconnected".format(peer))
+
+    async def _serve(self, reader, writer):
+        peer = None
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                message = pickle.loads(await reader.readexactly(HEADER.unpack(header)[0]))
+                if peer is None:
+                    peer = message["worker"]
+                    self.peer_connections[peer] = writer
+
+                if "result" in message:
+                    future = self.calls.get(message["id"])
+                    if future is not None and not future.done():
+                        future.set_result(message["result"])
+                elif "call" in message:
+                    result = await self._handle(message)
+                    self.send(peer, {
+                        "id": message["call"],
+                        "result": result
+                    })
+                else:
+                    await self._handle(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
+
+            # The connection replaced by the reconnected worker doesn't report it as gone
+            if peer is not None and self.peer_connections.get(peer) is writer:
+                del self.peer_connections[peer]
+                if self.on_disconnect is not None and self.server.is_serving():
+                    await self.on_disconnect(peer)
+
+    async def _handle(self, message):
+        try:
+            return await self.handler(message)
+        except Exception as e:
+            logger.exception(e)
@@ -1,43 +1,177 @@
+import functools
+import inspect
+import queue
 import threading
+import time
 import uuid
 
-from collections import OrderedDict
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from chatroom.zeroconf_browser import Browser
+import engineio
+import socketio
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-from chatroom.utils import Event, AsyncEvent, EmitError
+from chatroom.zeroconf_browser import Browser
+from chatroom.pending import PendingRequests
+from chatroom.codec import Codec, CodecError
+from chatroom.stream import RPCStream, StreamSink
+from chatroom.fragment import Reassembler, estimate_size, split
+from chatroom.outbox import PAUSE_PUBLISHER, LANES
+
+from chatroom.utils import Event, AsyncEvent, EmitError, RPCError, RPCCancelledError, PathTrie
+from chatroom.utils import JSON_SERIALIZER, MSGPACK_SERIALIZER, SOCKETIO_PATHS
 from logzero import setup_logger
 
 logger = setup_logger("chatroom.client")
 
-from socketIO_client import SocketIO, BaseNamespace
 
-class ChatNamespace(BaseNamespace):
-    def on_event(self, event, *args):
-        print("Without match eventhandler {}".format(event))
+# The executors of the RPC API, the CPU-bound API can run in the process pool to use all the cores
+THREAD_EXECUTOR = "thread"
+PROCESS_EXECUTOR = "process"
+
+# Use the binary serializer when both the server and the client support it
+AUTO_SERIALIZER = "auto"
+
+
+class BinaryPacket(socketio.packet.Packet):
+    """
+    The JSON packet which also sends the memoryview as a binary attachment. engine.io only writes bytes, so the
+    memoryview is copied once here instead of the base64 encoding. The MessagePack packet writes it directly.
+    """
+    @classmethod
+    def data_is_binary(cls, data):
+        return isinstance(data, memoryview) or super().data_is_binary(data)
+
+    @classmethod
+    def deconstruct_binary(cls, data):
+        # The placeholders of the Socket.IO protocol, only the public API of the packet is overridden
+        attachments = []
+        return cls._extract_binary(data, attachments), attachments
+
+    @classmethod
+    def _extract_binary(cls, data, attachments):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            attachments.append(data.tobytes() if isinstance(data, memoryview) else data)
+            return {"_placeholder": True, "num": len(attachments) - 1}
+        elif isinstance(data, list):
+            return [cls._extract_binary(item, attachments) for item in data]
+        elif isinstance(data, dict):
+            return {key: cls._extract_binary(value, attachments) for key, value in data.items()}
+        else:
+            return data
+
+
+class OrderedEngineIOClient(engineio.Client):
+    """
+    engine.io runs the handler of every message in a new thread, so the messages are handled out of order and the
+    binary attachments of the Socket.IO packets are mixed up. The messages are handled by the reading thread in
+    order instead, the Client hands the events over to its dispatch thread.
+    """
+    def _trigger_event(self, event, *args, **kwargs):
+        if event == "message":
+            kwargs.pop("run_async", None)
+
+        return super()._trigger_event(event, *args, **kwargs)
+
+
+class OrderedSocketIOClient(socketio.Client):
+    def _engineio_client_class(self):
+        return OrderedEngineIOClient
 
 
 class Client:
-    def __init__(self, path, server_name, max_workers=2, event_loop=None):
+    def __init__(self, path, server_name, max_workers=2, event_loop=None,
+                 rpc_timeout=60, max_pending_requests=10000, sweep_interval=1, max_processes=None,
+                 service_strategy=None, service_weight=1, browser=None, serializer=AUTO_SERIALIZER,
+                 compression=None, compression_threshold=1024, compression_dictionaries=(), rpc_stream_window=16,
+                 fragment_size=256 * 1024, fragment_window=4, outbound_policy=None, history_size=None,
+                 history_max_bytes=None, conflate=None):
         self.path = path
         self.server_name = server_name
         self.event_loop = event_loop
 
+        # The clients registered under the same path share the RPC requests by the strategy of the server
+        self.service_strategy = service_strategy
+        self.service_weight = service_weight
+
         self.socket_io = None
-        self.socket_io_wait_thread = None
+        self.serializer = serializer
+
+        # The large RPC parameters, results and publish payloads are compressed by the codec negotiated with
+        # the server when registering, e.g. compression="zstd" or ["zstd", "zlib"]
+        self.codec = Codec(compression, compression_threshold, compression_dictionaries)
 
         self.service = None
-        self.channel = None
 
-        self.request_handler_thread_executor = ThreadPoolExecutor(max_workers=2)
+        self.request_handler_thread_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # The process pool is created when the first process API is registered
+        self.max_processes = max_processes
+        self.request_handler_process_executor = None
 
-        self.browser = Browser()
-        self.browser.start()
+        # Many clients in one process can share the started browser
+        if browser is None:
+            browser = Browser()
+            browser.start()
+        self.browser = browser
+
+        # The RPC requests waiting for the response, the expired requests are swept periodically
+        self.pending_requests = PendingRequests(max_size=max_pending_requests, timeout=rpc_timeout)
+        self.sweep_interval = sweep_interval
+        self.sweep_stop_event = threading.Event()
+
+        # The echo messages come back in order
+        self.echo_events = deque()
 
-        self.rpc_request_events = OrderedDict()
         self.subscribes = {}
+        self.subscribe_index = PathTrie()
         self.rpc_apis = {}
+        self.rpc_api_executors = {}
+
+        # The chunks of the streaming response sent before the caller returns the credits
+        self.rpc_stream_window = rpc_stream_window
+        self.rpc_stream_credits = {}
+
+        # id -> the event set when the request is cancelled, the handler running in the thread checks it by
+        # is_rpc_cancelled()
+        self.rpc_cancel_events = {}
+        self.rpc_context = threading.local()
+
+        # id -> the deadline of the cancelled request, the cancel may arrive before the handler starts
+        self.rpc_cancelled = {}
+
+        # The policy of the server when this client is too slow to receive, and the congested receivers of the
+        # messages of this client. The publish waits while a receiver with the pause_publisher policy is congested
+        self.outbound_policy = outbound_policy
+        self.congested_receivers = {}
+        self.publish_ready = threading.Event()
+        self.publish_ready.set()
+
+        # The number and the bytes of the published messages the server keeps for the new subscribers, the
+        # defaults of the server are used when they are None
+        self.history_size = history_size
+        self.history_max_bytes = history_max_bytes
+
+        # The published messages waiting for a slow subscriber are replaced by the newer ones, True conflates all
+        # the messages of this client and a field name conflates the messages with the same value of the field
+        self.conflate = conflate
+
+        # The payloads larger than the fragment size are sent as the fragments, at most fragment_window fragments
+        # wait for the ack of the server so the other messages aren't blocked behind a large one
+        self.fragment_size = fragment_size
+        self.fragment_window = fragment_window
+        self.fragment_credits = threading.Semaphore(fragment_window)
+        self.reassembler = Reassembler(timeout=rpc_timeout)
+
+        # The received events are handled in order by one thread, the reading thread only receives the messages
+        # and the acks, so the handler can wait for an ack
+        self.dispatch_queue = None
+        self.dispatch_thread = None
 
     def connect(self):
         # Search the server by mDNS
@@ -50,30 +184,100 @@ class Client:
 
         # Use zeroconf to find the chatroom server
         self.service = service
+        serializer = self.get_serializer(service)
         logger.info("Found service at {}:{}".format(service.address, service.port))
-        logger.info("Try to connect to the service by socket.io")
-        self.socket_io = SocketIO(service.address, service.port)
+        logger.info("Try to connect to the service by socket.io with the {} serializer".format(serializer))
+        self.socket_io = OrderedSocketIOClient(serializer=self.get_packet_serializer(serializer))
 
-        # This thread handles the socket.io message
-        self.socket_io_wait_thread = threading.Thread(target=self.socket_io.wait, daemon=True)
-        self.socket_io_wait_thread.start()
+        self.dispatch_queue = queue.Queue()
+        self.dispatch_thread = threading.Thread(target=self._dispatch_events, args=(self.dispatch_queue,),
+                                                daemon=True)
+        self.dispatch_thread.start()
 
         # Register RPC response handler
         logger.info("Register RPC request/response Handler")
-        self.channel = self.socket_io.define(ChatNamespace, '/chat')
-        self.channel.on('rpc_request', self.on_rpc_request)
-        self.channel.on('rpc_response', self.on_rpc_response)
-        self.channel.on('publish', self.on_publish)
+        self._on('rpc_request', self.on_rpc_request)
+        self._on('rpc_response', self.on_rpc_response)
+        self._on('rpc_credit', self.on_rpc_credit)
+        self._on('rpc_cancel', self.on_rpc_cancel)
+        self._on('backpressure', self.on_backpressure)
+        self._on('rate_limit', self.on_rate_limit)
+        self._on('publish', self.on_publish)
+        self._on('echo', self.on_echo)
+
+        # The server with many workers only accepts the websocket, the polling requests may reach other workers
+        self.socket_io.connect("http://{}:{}".format(service.address, service.port), namespaces=['/chat'],
+                               socketio_path=SOCKETIO_PATHS[serializer], transports=service.transports)
+
+        # This thread sweeps the expired RPC requests
+        self.sweep_thread = threading.Thread(target=self._sweep_pending_requests, daemon=True)
+        self.sweep_thread.start()
 
         # Register self information to chatroom server
-        result = self.emit("register", {
-            "path": self.path
-        })
+        result = self.emit("register", self.get_register_info())
 
         if result is None:
             raise RuntimeError("Can't register to the server {}:{}".format(self.service.address, self.service.port))
         else:
             logger.info("Connect and register to the server {}:{}".format(self.service.address, self.service.port))
+            self.codec.negotiate(result.get("codecs"))
+
+    def disconnect(self):
+        self.sweep_stop_event.set()
+        self.socket_io.disconnect()
+        self.dispatch_queue.put(None)
+
+    def _on(self, event, handler):
+        dispatch_queue = self.dispatch_queue
+        self.socket_io.on(event, lambda data: dispatch_queue.put((handler, data)), namespace='/chat')
+
+    def _dispatch_events(self, dispatch_queue):
+        while True:
+            item = dispatch_queue.get()
+            if item is None:
+                return
+
+            handler, data = item
+            try:
+                handler(data)
+            except Exception as e:
+                logger.exception(e)
+
+    def get_serializer(self, service):
+        if self.serializer != AUTO_SERIALIZER:
+            return self.serializer
+
+        if msgpack is not None and MSGPACK_SERIALIZER in service.serializers:
+            return MSGPACK_SERIALIZER
+
+        return JSON_SERIALIZER
+
+    def get_packet_serializer(self, serializer):
+        # The JSON packet sends the bytes as the binary attachments
+        if serializer == JSON_SERIALIZER:
+            return BinaryPacket
+
+        return serializer
+
+    def get_register_info(self):
+        info = {
+            "path": self.path,
+            "weight": self.service_weight,
+            "codecs": self.codec.accepted()
+        }
+        if self.service_strategy:
+            info["strategy"] = self.service_strategy
+        if self.outbound_policy:
+            info["outbound_policy"] = self.outbound_policy
+        if self.conflate:
+            info["conflate"] = self.conflate
+        if self.history_size is not None or self.history_max_bytes is not None:
+            info["history"] = {
+                "size": self.history_size,
+                "max_bytes": self.history_max_bytes
+            }
+
+        return info
 
     def create_event(self):
         if self.event_loop:
@@ -81,39 +285,69 @@ class Client:
         else:
             return Event()
 
-    def emit(self, event_type, data, timeout=3600):
-        uid = str(uuid.uuid1())
-        data["_uid"] = uid
+    def emit(self, event_type, data, timeout=3600, ack=True):
+        # Fire and forget, the server doesn't reply the message
+        if not ack:
+            self.socket_io.emit(event_type, data, namespace='/chat')
+            return None
 
-        # Register the callback function for the emit response
-        event = self.create_event()
+        # The server replies by the Socket.IO ack instead of the uid event
+        try:
+            result = self.socket_io.call(event_type, data, namespace='/chat', timeout=timeout)
+        except socketio.exceptions.TimeoutError:
+            msg = "Emit event {} is timeout".format(event_type)
+            logger.error(msg)
+            raise TimeoutError(msg)
 
-        def wait_emit_response(emit_response):
-            nonlocal event
-            event.set_msg(emit_response)
+        if result.get("success") is False:
+            msg = result.get("error")
+            logger.error("Emit {} failed, error msg {}".format(event_type, msg))
+            raise EmitError(msg)
+        else:
+            logger.info("Send event {} successfully".format(event_type))
+            return result
 
-        self.channel.once(uid, wait_emit_response)
+    def emit_message(self, event_type, data, ack=False, priority=None):
+        # The rpc_request, rpc_response and publish messages may be large, the priority is the lane of the message
+        # in the outbox of the slow receiver, e.g. "bulk" for the large transfers
+        if priority is not None:
+            if priority not in LANES:
+                raise ValueError("The priority should be one of {}".format(", ".join(LANES)))
+            data = dict(data, priority=priority)
 
-        self.channel.emit(event_type, data)
-        try:
-            result = event.wait(timeout=timeout)
-            if result.get("success") is False:
-                msg = result.get("message")
-                logger.error("Emit {} failed, error msg {}".format(event_type, result.get("message")))
-                raise EmitError(msg)
-            else:
-                logger.info("Send event {} successfully".format(event_type))
-                return result
-        except TimeoutError as e:
-            logger.error("Emit event {} is timeout".format(event_type))
-            raise e
+        if self.fragment_size is None or estimate_size(data.get("payload"), self.fragment_size) <= self.fragment_size:
+            return self.emit(event_type, data, ack=ack)
+
+        frames = list(split(data, self.fragment_size))
+        for frame in frames[:-1]:
+            if not self.fragment_credits.acquire(timeout=self.pending_requests.timeout):
+                raise TimeoutError("The fragments of {} are not acked".format(event_type))
+
+            self.socket_io.emit(event_type, frame, namespace='/chat', callback=self._on_fragment_ack)
+
+        return self.emit(event_type, frames[-1], ack=ack)
+
+    def _on_fragment_ack(self, result):
+        self.fragment_credits.release()
+
+        if result.get("success") is False:
+            logger.error("Emit fragment failed, error msg {}".format(result.get("error")))
+
+    def emit_many(self, messages, timeout=3600, ack=True):
+        # The messages is a list of (event_type, data), only rpc_request, rpc_response, publish and echo
+        # can be sent in one batch event
+        items = [dict(data, type=event_type) for event_type, data in messages]
+
+        return self.emit("batch", {
+            "items": items
+        }, timeout=timeout, ack=ack)
 
     #########################################################################################################
     #
     #   RPC
     #
     #########################################################################################################
-    def echo(self, message):
+    def echo(self, message, timeout=None):
         event = self.create_event()
 
         payload = dict(
@@ -122,15 +356,25 @@ class Client:
                 message=message
             )
         )
-        self.channel.once("echo", lambda echo_message: event.set_msg(echo_message))
+        self.echo_events.append(event)
 
-        self.emit("echo", payload)
-        result = event.wait()
-
-        return result
+        # The lost echo doesn't take the reply of the following one
+        try:
+            self.emit("echo", payload)
+            return event.wait(timeout or self.pending_requests.timeout)
+        except BaseException:
+            if event in self.echo_events:
+                self.echo_events.remove(event)
+            raise
+
+    def on_echo(self, data):
+        if self.echo_events:
+            self.echo_events.popleft().set_msg(data)
+        else:
+            logger.error("Can't find the echo event of the message {}".format(data))
 
     # Send Request
-    def send_rpc_request(self, target, method, parameters):
+    def send_rpc_request(self, target, method, parameters, timeout=None, stream=False, priority=None):
         id = str(uuid.uuid1())
 
         payload = dict(
@@ -138,18 +382,30 @@ class Client:
             payload=dict(
                 id=id,
                 method=method,
-                parameters=parameters
+                parameters=self.codec.encode(parameters),
+                timeout=timeout or self.pending_requests.timeout
             )
         )
 
-        self.emit('rpc_request', payload)
+        # The streaming request returns the iterator of the chunks, the timeout restarts with every chunk. Only the
+        # receiving side of the stream is pending, the stream dropped by the caller cancels the request
+        if stream:
+            payload["payload"]["window"] = self.rpc_stream_window
+            event = self.create_stream(id)
+            pending = event.sink
+        else:
+            event = pending = self.create_event()
+            event.id = id
+
+        # Register the event before sending, the response may arrive at any time
+        self.pending_requests.add(id, pending, timeout=timeout)
 
-        event = self.create_event()
-        self.rpc_request_events[id] = event
+        # The server doesn't ack the request, the response is routed back by the id
+        self.emit_message('rpc_request', payload, priority=priority)
 
         return event
 
-    def _handle_rpc_request(self, data):
+    def _parse_rpc_request(self, data):
         # Get the request information from SocketIO data
         source = data.get("path")
         payload = data.get("payload", {})
@@ -159,67 +415,335 @@ class Client:
         method = payload.get("method")
         parameters = payload.get("parameters")
 
+        return source, id, method, parameters
+
+    def cancel_rpc_request(self, event):
+        # The event of the request receives the RPCCancelledError and the callee is told to stop the work
+        if not self._cancel_rpc_request(event.id):
+            return False
+
+        event.set_error(RPCCancelledError("The request {} is cancelled".format(event.id)))
+        return True
+
+    def _cancel_rpc_request(self, id):
+        if self.pending_requests.pop(id) is None:
+            return False
+
+        self.emit('rpc_cancel', dict(
+            payload=dict(
+                id=id
+            )
+        ), ack=False)
+        return True
+
+    def create_stream(self, id):
+        return RPCStream(id, self.rpc_stream_window, self._send_rpc_credit, self._cancel_rpc_request)
+
+    def _send_rpc_credit(self, id, credit):
+        self.emit('rpc_credit', dict(
+            payload=dict(
+                id=id,
+                credit=credit
+            )
+        ), ack=False)
+
+    def _handle_rpc_request(self, data):
+        source, id, method, parameters = self._parse_rpc_request(data)
+        window = data.get("payload", {}).get("window")
+
         # Check the method is existing
         fn = self.rpc_apis.get(method, None)
         result = None
         error = None
 
         if fn is None:
-            error = "The method {} is not existing"
+            error = "The method {} is not existing".format(method)
         else:
+            # The event is registered before checking the cancelled requests, so the cancel is never missed
+            cancelled = self.rpc_cancel_events[id] = threading.Event()
+            if self.rpc_cancelled.pop(id, None) is not None:
+                self.rpc_cancel_events.pop(id, None)
+                return
+
+            self.rpc_context.cancelled = cancelled
+
             try:
-                result = fn(**parameters)
+                result = fn(**self.codec.decode(parameters))
+
+                # The items of the generator are streamed when the caller asks for it, otherwise sent as a list
+                if inspect.isgenerator(result):
+                    if window:
+                        return self._send_rpc_stream(source, id, result, window, cancelled)
+                    result = list(result)
             except Exception as e:
                 logger.exception(e)
                 error = str(e)
+            finally:
+                self.rpc_context.cancelled = None
+                self.rpc_cancel_events.pop(id, None)
+
+            # The caller doesn't wait for the response of the cancelled request
+            if cancelled.is_set():
+                return
+
+        self._send_rpc_response(source, id, result, error)
+
+    def is_rpc_cancelled(self):
+        # Called by the RPC API, the long running API can stop when the caller cancels the request
+        cancelled = getattr(self.rpc_context, "cancelled", None)
+        return cancelled is not None and cancelled.is_set()
+
+    def _send_rpc_stream(self, source, id, items, window, cancelled):
+        credits = self.rpc_stream_credits[id] = threading.Semaphore(window)
+        error = None
+
+        try:
+            for item in items:
+                # Wait for the caller to consume the chunks, the caller which is gone stops the stream
+                if not credits.acquire(timeout=self.pending_requests.timeout):
+                    raise TimeoutError("The stream {} is not consumed by the caller".format(id))
+
+                if cancelled.is_set():
+                    return
+
+                self._send_rpc_response(source, id, item, None, more=True)
+        except Exception as e:
+            logger.exception(e)
+            error = str(e)
+        finally:
+            items.close()
+            self.rpc_stream_credits.pop(id, None)
+
+        self._send_rpc_response(source, id, None, error, end=True)
+
+    def on_rpc_cancel(self, data):
+        payload = data.get("payload", {})
+        logger.info("RPC request {} is cancelled, {}".format(payload.get("id"), payload.get("error")))
+
+        # The request which isn't started yet is skipped by the handler
+        self.rpc_cancelled[payload.get("id")] = time.monotonic() + self.pending_requests.timeout
+        cancelled = self.rpc_cancel_events.get(payload.get("id"))
+        if cancelled is not None:
+            cancelled.set()
+
+        # Wake up the stream waiting for the credits
+        credits = self.rpc_stream_credits.get(payload.get("id"))
+        if credits is not None:
+            credits.release()
+
+    def on_rpc_credit(self, data):
+        payload = data.get("payload", {})
+
+        credits = self.rpc_stream_credits.get(payload.get("id"))
+        if credits is None:
+            return
+
+        for _ in range(payload.get("credit", 0)):
+            credits.release()
+
+    def _handle_process_rpc_request(self, data):
+        source, id, method, parameters = self._parse_rpc_request(data)
+        if self.rpc_cancelled.pop(id, None) is not None:
+            return
+
+        try:
+            parameters = self.codec.decode(parameters)
+        except CodecError as e:
+            logger.exception(e)
+            return self._send_rpc_response(source, id, None, str(e))
+
+        # The response is sent when the process returns the result
+        future = self.request_handler_process_executor.submit(self.rpc_apis[method], **parameters)
+        future.add_done_callback(functools.partial(self._on_process_rpc_done, source, id))
+
+    def _on_process_rpc_done(self, source, id, future):
+        result = None
+        error = None
+
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.exception(e)
+            error = str(e)
+
+        self._send_rpc_response(source, id, result, error)
 
-        self.emit('rpc_response', dict(
+    def _send_rpc_response(self, source, id, result, error, **flags):
+        # The chunk of the stream has more=True, the last frame of the stream has end=True
+        self.emit_message('rpc_response', dict(
             path=source,
             payload=dict(
                 id=id,
-                result=result,
-                error=error
+                result=self.codec.encode(result),
+                error=error,
+                **flags
             )
-        ))
+        ), ack=False)
 
     def on_rpc_request(self, data):
-        self.request_handler_thread_executor.submit(self._handle_rpc_request, data)
+        data = self.reassembler.reassemble(data)
+        if data is None:
+            return
+
+        method = data.get("payload", {}).get("method")
+
+        if self.rpc_api_executors.get(method) == PROCESS_EXECUTOR:
+            self._handle_process_rpc_request(data)
+        else:
+            self.request_handler_thread_executor.submit(self._handle_rpc_request, data)
 
     def on_rpc_response(self, data):
+        # The fragments of the large response restart the timeout of the request
+        id = data.get('payload', {}).get('id')
+        data = self.reassembler.reassemble(data)
+        if data is None:
+            self.pending_requests.touch(id)
+            return
+
         payload = data.get('payload')
         id = payload.get('id')
-        result = payload.get('result')
+        error = payload.get('error')
 
-        event = self.rpc_request_events.get(id)
-        if event:
-            event.set_msg(result)
+        try:
+            result = self.codec.decode(payload.get('result'))
+        except CodecError as e:
+            result = None
+            error = str(e)
+
+        if payload.get('more'):
+            stream = self.pending_requests.touch(id)
+            if stream is None:
+                logger.error("Can't find the rpc stream with id {}, it may be timeout".format(id))
+            else:
+                stream.put(result)
+            return
+
+        event = self.pending_requests.pop(id)
+        if event is None:
+            logger.error("Can't find the rpc request event with id {}, it may be timeout".format(id))
+        elif error:
+            logger.error("RPC request {} failed, error msg {}".format(id, error))
+            event.set_error(RPCError(error))
+        elif isinstance(event, StreamSink):
+            # The handler which isn't a generator replies one chunk
+            if not payload.get('end'):
+                event.put(result)
+            event.finish()
         else:
-            logger.error("Can't find the rpc request event with id {}".format(id))
+            event.set_msg(result)
+
+    def _sweep_pending_requests(self):
+        while not self.sweep_stop_event.wait(self.sweep_interval):
+            expired = self.pending_requests.sweep()
+            if expired:
+                logger.error("{} RPC requests are timeout".format(expired))
+
+            dropped = self.reassembler.sweep()
+            if dropped:
+                logger.error("{} fragmented messages are incomplete".format(dropped))
+
+            self._sweep_rpc_cancelled()
+
+    def _sweep_rpc_cancelled(self):
+        now = time.monotonic()
+        for id, deadline in list(self.rpc_cancelled.items()):
+            if deadline <= now:
+                self.rpc_cancelled.pop(id, None)
 
     # Handle request
-    def register_rpc_api(self, name, func):
-        logger.info("Register RPC API {}".format(name))
+    def register_rpc_api(self, name, func, executor=THREAD_EXECUTOR):
+        # The API runs in the process pool must be picklable, e.g. a function defined at the module level
+        if executor not in (THREAD_EXECUTOR, PROCESS_EXECUTOR):
+            raise ValueError("The executor should be {} or {}".format(THREAD_EXECUTOR, PROCESS_EXECUTOR))
+
+        if executor == PROCESS_EXECUTOR and (inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func)):
+            raise ValueError("The generator API {} can't run in the process pool".format(name))
+
+        if executor == PROCESS_EXECUTOR and self.request_handler_process_executor is None:
+            self.request_handler_process_executor = ProcessPoolExecutor(max_workers=self.max_processes)
+
+        logger.info("Register RPC API {} in the {} executor".format(name, executor))
         self.rpc_apis[name] = func
+        self.rpc_api_executors[name] = executor
 
     # Publish / Subscribe
-    def publish(self, data): 
-        self.emit("publish", {
-            "payload": data
-        })
+    def publish(self, data, ack=False, priority=None):
+        if not self.publish_ready.wait(timeout=self.pending_requests.timeout):
+            raise TimeoutError("The subscribers {} are congested".format(self.get_congested_paths()))
+
+        self.emit_message("publish", {
+            "payload": self.codec.encode(data)
+        }, ack=ack, priority=priority)
     
-    def subscribe(self, target, callback):
-        self.emit("subscribe", dict(
+    def subscribe(self, target, callback, replay=True):
+        # The kept messages of the publishers are replayed before the ack, the callback is added first
+        self._add_subscribe(target, callback)
+
+        try:
+            self.emit("subscribe", dict(
+                path=target,
+                replay=replay
+            ))
+        except Exception:
+            self._remove_subscribe(target)
+            raise
+
+    def unsubscribe(self, target):
+        self.emit("unsubscribe", dict(
             path=target
         ))
 
+        self._remove_subscribe(target)
+
+    def _add_subscribe(self, target, callback):
+        self._remove_subscribe(target)
+
         self.subscribes[target] = callback
+        self.subscribe_index.add(target, callback)
+
+    def _remove_subscribe(self, target):
+        callback = self.subscribes.pop(target, None)
+        if callback:
+            self.subscribe_index.remove(target, callback)
+
+    def on_rate_limit(self, data):
+        # The message sent without the ack is rejected by the rate limit of the server
+        logger.warning("The {} message is rejected, {}".format(data.get("event"), data.get("error")))
+
+    def get_congested_paths(self):
+        return sorted({info.get("path") for info in self.congested_receivers.values()})
+
+    def on_backpressure(self, data):
+        # The receivers of the same path are congested and drained one by one
+        path = data.get("path")
+        sid = data.get("sid", path)
+        if data.get("congested"):
+            logger.warning("The receiver {} is congested, {} messages are dropped by the {} policy".format(
+                path, data.get("dropped"), data.get("policy")))
+            self.congested_receivers[sid] = data
+        else:
+            logger.info("The receiver {} is drained".format(path))
+            self.congested_receivers.pop(sid, None)
+
+        if any(info.get("policy") == PAUSE_PUBLISHER for info in self.congested_receivers.values()):
+            self.publish_ready.clear()
+        else:
+            self.publish_ready.set()
 
     def on_publish(self, data):
+        data = self.reassembler.reassemble(data)
+        if data is None:
+            return
+
         source = data.get('path')
-        callback = self.subscribes.get(source, None)
 
-        if callback:
-            callback(data.get('payload'))
+        # The target of the subscribe can be a pattern, e.g. "sensors.*" or "sensors.#"
+        callbacks = self.subscribe_index.match(source)
+
+        if callbacks:
+            payload = self.codec.decode(data.get('payload'))
+            for callback in callbacks:
+                callback(payload)
         else:
             logger.error("Can't find the subscribe of the publish event {}".format(data))
 
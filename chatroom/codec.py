@@ -0,0 +1,301 @@
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ZLIB = "zlib"
+ZSTD = "zstd"
+
+# The compressed value is replaced by {"_compressed": <codec>, "data": <bytes>}
+MARKER = "_compressed"
+
+# The decompressed value is bounded, the payloads of the peers aren't trusted
+MAX_SIZE = 64 * 1024 * 1024
+
+# The ndarray is replaced by {"_ndarray": <dtype>, "shape": [...], "data": <the raw buffer>}
+NDARRAY_MARKER = "_ndarray"
+
+# The payload with the arrays is flagged by "_arrays", the other payloads aren't walked by the receiver
+ARRAYS_MARKER = "_arrays"
+
+# The values which can't contain the arrays, checked by the exact type
+SCALARS = frozenset((str, int, float, bool, bytes, type(None)))
+
+
+class CodecError(RuntimeError):
+    pass
+
+
+def train_dictionary(samples, size=16384):
+    # Train the zstd dictionary from the typical messages, the dictionary should be shared by all the clients
+    if zstandard is None:
+        raise CodecError("The zstandard package is required to train the dictionary")
+
+    samples = [json.dumps(sample).encode() for sample in samples]
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+class Codec:
+    """
+    Compress the large values of the payload. The small values skip the compression by the threshold and the
+    peers only receive the codecs they accepted when they registered.
+    """
+    def __init__(self, compression=None, threshold=1024, dictionaries=(), max_size=MAX_SIZE):
+        self.threshold = threshold
+        self.max_size = max_size
+
+        # dict id -> the zstd dictionary, the first dictionary is used to compress
+        self.dictionaries = {}
+        self.compress_dictionary = None
+        for data in dictionaries:
+            if zstandard is None:
+                raise CodecError("The zstandard package is required to use the dictionary")
+
+            dictionary = zstandard.ZstdCompressionDict(data)
+            self.dictionaries[dictionary.dict_id()] = dictionary
+            if self.compress_dictionary is None:
+                self.compress_dictionary = dictionary
+
+        self.preferences = [compression] if isinstance(compression, str) else list(compression or [])
+        for codec in self.preferences:
+            if codec not in self.accepted():
+                raise CodecError("The codec {} is not supported".format(codec))
+
+        # The codec used to compress, decided by the negotiation with the server
+        self.compression = None
+        self.compressor = None
+
+    def accepted(self):
+        codecs = [ZLIB]
+        if zstandard is not None:
+            codecs.append(ZSTD)
+            codecs.extend("{}:{}".format(ZSTD, dict_id) for dict_id in self.dictionaries)
+
+        return codecs
+
+    def negotiate(self, accepted):
+        # Use the first preferred codec which the other side can decode, zstd prefers the shared dictionary
+        accepted = accepted or []
+        for codec in self.preferences:
+            candidates = [codec]
+            if codec == ZSTD and self.compress_dictionary is not None:
+                candidates.insert(0, "{}:{}".format(ZSTD, self.compress_dictionary.dict_id()))
+
+            for candidate in candidates:
+                if candidate in accepted:
+                    self.compression = candidate
+                    if candidate == ZSTD:
+                        self.compressor = zstandard.ZstdCompressor()
+                    elif candidate != ZLIB:
+                        self.compressor = zstandard.ZstdCompressor(dict_data=self.compress_dictionary)
+                    return candidate
+
+        self.compression = None
+        self.compressor = None
+        return None
+
+    def compress(self, value):
+        if self.compression is None or value is None:
+            return value
+
+        if isinstance(value, str) and len(value) < self.threshold:
+            return value
+
+        try:
+            data = json.dumps(value).encode()
+        except TypeError:
+            # The value with the binary data is sent as it is
+            return value
+
+        if len(data) < self.threshold:
+            return value
+
+        if self.compression == ZLIB:
+            return {MARKER: ZLIB, "data": zlib.compress(data)}
+
+        if self.compression == ZSTD:
+            return {MARKER: ZSTD, "data": self.compressor.compress(data)}
+
+        return {MARKER: ZSTD, "dict": self.compress_dictionary.dict_id(), "data": self.compressor.compress(data)}
+
+    def decompress(self, value):
+        # Raise CodecError when the value can't be decompressed or it's larger than the max size
+        if not is_compressed(value):
+            return value
+
+        codec = value[MARKER]
+        try:
+            if codec == ZLIB:
+                data = self._decompress_zlib(value["data"])
+            elif codec == ZSTD and zstandard is not None:
+                data = self._decompress_zstd(value["data"], value.get("dict"))
+            else:
+                raise CodecError("The codec {} is not supported".format(codec))
+
+            return json.loads(data.decode())
+        except CodecError:
+            raise
+        except Exception as e:
+            raise CodecError("Can't decompress the {} value: {}".format(codec, e)) from e
+
+    def _decompress_zlib(self, data):
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data, self.max_size)
+        if decompressor.unconsumed_tail:
+            raise CodecError("The decompressed value is larger than {} bytes".format(self.max_size))
+        if not decompressor.eof:
+            raise CodecError("The zlib value is incomplete")
+
+        return data
+
+    def _decompress_zstd(self, data, dict_id):
+        dictionary = None
+        if dict_id is not None:
+            dictionary = self.dictionaries.get(dict_id)
+            if dictionary is None:
+                raise CodecError("The zstd dictionary {} is not existing".format(dict_id))
+
+        if dictionary is not None:
+            decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+
+        # The content size in the frame header can't be trusted either, read one more byte than the max size
+        with decompressor.stream_reader(data) as reader:
+            data = reader.read(self.max_size + 1)
+        if len(data) > self.max_size:
+            raise CodecError("The decompressed value is larger than {} bytes".format(self.max_size))
+
+        return data
+
+    def encode(self, value):
+        # The arrays are sent as the binary attachments, the payloads with the binary data skip the compression
+        return self.compress(encode_arrays(value))
+
+    def decode(self, value):
+        return decode_arrays(self.decompress(value))
+
+    def decompress_payload(self, payload):
+        # The payload itself or the top-level values of the payload can be compressed
+        if is_compressed(payload):
+            return self.decompress(payload)
+
+        if isinstance(payload, dict) and any(is_compressed(value) for value in payload.values()):
+            return {key: self.decompress(value) for key, value in payload.items()}
+
+        return payload
+
+
+def is_compressed(value):
+    return isinstance(value, dict) and MARKER in value
+
+
+def get_codec_name(value):
+    if value.get("dict") is not None:
+        return "{}:{}".format(value[MARKER], value["dict"])
+
+    return value[MARKER]
+
+
+def get_payload_codecs(payload):
+    if is_compressed(payload):
+        return {get_codec_name(payload)}
+
+    if isinstance(payload, dict):
+        return {get_codec_name(value) for value in payload.values() if is_compressed(value)}
+
+    return set()
+
+
+def encode_arrays(value):
+    # The payload with the arrays is flagged, the receiver only walks the flagged payloads. The dict is flagged by
+    # {"_arrays": true, ...}, the other values are sent as {"_arrays": <the value>}
+    if numpy is None:
+        return value
+
+    encoded = _encode_arrays(value)
+    if encoded is value:
+        return value
+
+    if isinstance(encoded, dict):
+        encoded[ARRAYS_MARKER] = True
+        return encoded
+
+    return {ARRAYS_MARKER: encoded}
+
+
+def _encode_arrays(value):
+    # The containers without any array are returned as they are
+    if type(value) in SCALARS:
+        return value
+
+    if isinstance(value, numpy.ndarray) and not value.dtype.hasobject and value.dtype.names is None:
+        # Only the non-contiguous array is copied, the buffer of the contiguous array is sent as it is
+        data = numpy.ascontiguousarray(value).reshape(-1).view(numpy.uint8)
+        return {NDARRAY_MARKER: value.dtype.str, "shape": list(value.shape), "data": memoryview(data)}
+
+    if isinstance(value, dict):
+        encoded = None
+        for key, item in value.items():
+            encoded_item = _encode_arrays(item)
+            if encoded_item is not item:
+                if encoded is None:
+                    encoded = dict(value)
+                encoded[key] = encoded_item
+
+        return value if encoded is None else encoded
+
+    if isinstance(value, (list, tuple)):
+        encoded = None
+        for index, item in enumerate(value):
+            encoded_item = _encode_arrays(item)
+            if encoded_item is not item:
+                if encoded is None:
+                    encoded = list(value)
+                encoded[index] = encoded_item
+
+        return value if encoded is None else encoded
+
+    return value
+
+
+def decode_arrays(value):
+    if numpy is None or not isinstance(value, dict):
+        return value
+
+    flag = value.get(ARRAYS_MARKER)
+    if flag is None:
+        return value
+
+    if flag is True:
+        return _decode_arrays({key: item for key, item in value.items() if key != ARRAYS_MARKER})
+
+    return _decode_arrays(flag)
+
+
+def _decode_arrays(value):
+    if isinstance(value, dict):
+        if NDARRAY_MARKER in value:
+            # The array shares the received buffer, it's read-only
+            return numpy.frombuffer(value["data"], dtype=value[NDARRAY_MARKER]).reshape(value["shape"])
+
+        for key, item in value.items():
+            if isinstance(item, (dict, list)):
+                value[key] = _decode_arrays(item)
+        return value
+
+    if isinstance(value, list):
+        for index, item in enumerate(value):
+            if isinstance(item, (dict, list)):
+                value[index] = _decode_arrays(item)
+        return value
+
+    return value
@@ -0,0 +1,181 @@
+import json
+import threading
+import time
+import uuid
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# The fragment of the payload is sent as {..., "_fragment": {"id", "index", "count", "encoding", "data"}}
+MARKER = "_fragment"
+
+JSON_ENCODING = "json"
+MSGPACK_ENCODING = "msgpack"
+
+# The fields copied to every frame, the server routes the RPC frames by them
+ROUTING_KEYS = ("id", "more", "timeout")
+
+# The size of the reassembled message is limited, the fragments of a larger one are dropped
+MAX_SIZE = 64 * 1024 * 1024
+
+
+def estimate_size(value, limit):
+    # Estimate the size of the serialized value, stop counting when it's larger than the limit
+    size = 0
+    values = [value]
+    while values and size <= limit:
+        value = values.pop()
+        if isinstance(value, (str, bytes, bytearray)):
+            size += len(value) + 2
+        elif isinstance(value, memoryview):
+            size += value.nbytes
+        elif isinstance(value, dict):
+            size += 2 * len(value)
+            values.extend(value.keys())
+            values.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            size += len(value)
+            values.extend(value)
+        else:
+            size += 8
+
+    return size
+
+
+def encode(value):
+    # The JSON fragments are sent as the text, only the payload with the binary data is encoded by MessagePack
+    try:
+        return json.dumps(value), JSON_ENCODING
+    except TypeError:
+        if msgpack is None:
+            raise
+
+    return msgpack.packb(value, use_bin_type=True), MSGPACK_ENCODING
+
+
+def decode(data, encoding):
+    if encoding == JSON_ENCODING:
+        return json.loads(data)
+
+    if encoding == MSGPACK_ENCODING and msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+
+    raise ValueError("The encoding {} of the fragments is not supported".format(encoding))
+
+
+def split(data, size):
+    # Yield the frames of the message, the binary fragments are the slices of the encoded payload without copying
+    payload = data.get("payload")
+    encoded, encoding = encode(payload)
+
+    id = str(uuid.uuid1())
+    count = (len(encoded) + size - 1) // size
+    view = memoryview(encoded) if encoding == MSGPACK_ENCODING else encoded
+
+    routing = {key: payload[key] for key in ROUTING_KEYS if key in payload} if isinstance(payload, dict) else {}
+
+    for index in range(count):
+        frame = dict(routing)
+
+        # The RPC route is kept by the server until the last frame
+        if index < count - 1:
+            frame["more"] = True
+
+        frame[MARKER] = {
+            "id": id,
+            "index": index,
+            "count": count,
+            "encoding": encoding,
+            "data": view[index * size:(index + 1) * size]
+        }
+
+        yield dict(data, payload=frame)
+
+
+def get_fragment(data):
+    payload = data.get("payload")
+    if isinstance(payload, dict):
+        return payload.get(MARKER)
+
+    return None
+
+
+class Reassembler:
+    """
+    The fragments of the messages being received. The message is decoded when all its fragments arrive, the
+    messages which don't receive any fragment in the timeout are dropped by the sweep.
+    """
+    def __init__(self, timeout=60, max_size=MAX_SIZE):
+        self.timeout = timeout
+        self.max_size = max_size
+
+        # id -> [deadline, the number of the fragments, index -> the buffer of the fragment, the received size]
+        self.messages = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, fragment):
+        id = fragment.get("id")
+        count = fragment.get("count")
+        index = fragment.get("index")
+        data = fragment.get("data")
+
+        # Every fragment has one byte at least, so the message with more fragments than max_size bytes is invalid
+        if not isinstance(count, int) or isinstance(count, bool) or not 0 < count <= self.max_size:
+            raise ValueError("The count {!r} of the fragments is invalid".format(count))
+        if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < count:
+            raise ValueError("The index {!r} of the fragment is invalid".format(index))
+        if not isinstance(data, (str, bytes, bytearray, memoryview)):
+            raise ValueError("The data of the fragment should be str or bytes")
+
+        with self.lock:
+            entry = self.messages.get(id)
+            if entry is None:
+                entry = self.messages[id] = [0, count, {}, 0]
+            elif entry[1] != count:
+                del self.messages[id]
+                raise ValueError("The count of the fragments of {} is changed".format(id))
+
+            previous = entry[2].get(index)
+            entry[3] += len(data) - (len(previous) if previous is not None else 0)
+            if entry[3] > self.max_size:
+                del self.messages[id]
+                raise ValueError("The fragmented message {} is larger than {} bytes".format(id, self.max_size))
+
+            entry[0] = time.monotonic() + self.timeout
+            entry[2][index] = data
+
+            if len(entry[2]) < count:
+                return None
+
+            del self.messages[id]
+
+        separator = "" if fragment["encoding"] == JSON_ENCODING else b""
+        return decode(separator.join(entry[2][index] for index in range(count)), fragment["encoding"])
+
+    def reassemble(self, data):
+        # Return the data with the whole payload, or None until the last fragment arrives
+        fragment = get_fragment(data)
+        if fragment is None:
+            return data
+
+        payload = self.add(fragment)
+        if payload is None:
+            return None
+
+        return dict(data, payload=payload)
+
+    def sweep(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        with self.lock:
+            expired = [id for id, entry in self.messages.items() if entry[0] <= now]
+            for id in expired:
+                del self.messages[id]
+
+        return len(expired)
@@ -0,0 +1,132 @@
+import itertools
+
+from collections import deque
+
+from chatroom.utils import PathTrie
+
+
+class TopicHistory:
+    """
+    The last messages published to one topic. The oldest message is dropped when the ring is full, the size 1 keeps
+    only the last value.
+    """
+    def __init__(self, size, max_bytes):
+        self.size = size
+        self.max_bytes = max_bytes
+
+        # (seq, message, size)
+        self.messages = deque()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def is_full(self, size=0):
+        return len(self.messages) + 1 > self.size or self.bytes + size > self.max_bytes
+
+    def popleft(self):
+        seq, message, size = self.messages.popleft()
+        self.bytes -= size
+        return size
+
+
+class History:
+    """
+    The ring buffers of the published topics, the new subscribers receive the snapshot of the matched topics. The
+    memory is bounded per topic and by the total bytes of all the topics, which drops the globally oldest messages.
+    """
+    def __init__(self, size=0, max_bytes=1024 * 1024, total_bytes=64 * 1024 * 1024):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.total_bytes = total_bytes
+
+        # topic -> the ring buffer, topic -> (size, max_bytes) chosen by the publisher
+        self.topics = {}
+        self.configs = {}
+
+        self.bytes = 0
+        self.count = 0
+
+        # (seq, topic) of the kept messages in the publish order, the messages dropped by their own topic leave
+        # the stale entries which are skipped
+        self.order = deque()
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return self.count
+
+    def configure(self, topic, size=None, max_bytes=None):
+        # The publisher can keep more or less messages, but not more bytes than the cap of the server
+        size = self.size if size is None else size
+        max_bytes = self.max_bytes if max_bytes is None else min(max_bytes, self.max_bytes)
+        self.configs[topic] = (size, max_bytes)
+
+        history = self.topics.get(topic)
+        if history is not None:
+            history.size = size
+            history.max_bytes = max_bytes
+            while history and (len(history) > size or history.bytes > max_bytes):
+                self._drop(topic, history)
+
+    def get_config(self, topic):
+        # (size, max_bytes) of the topic, the size 0 keeps nothing
+        return self.configs.get(topic, (self.size, self.max_bytes))
+
+    def add(self, topic, message, size):
+        topic_size, topic_max_bytes = self.get_config(topic)
+        if topic_size <= 0 or size > topic_max_bytes or size > self.total_bytes:
+            return False
+
+        history = self.topics.get(topic)
+        if history is None:
+            history = TopicHistory(topic_size, topic_max_bytes)
+
+        while history.is_full(size):
+            self._drop(topic, history)
+
+        while self.bytes + size > self.total_bytes:
+            self._drop_oldest()
+
+        # The topic emptied by the global limit is removed, add it back
+        self.topics[topic] = history
+
+        seq = next(self.seq)
+        history.messages.append((seq, message, size))
+        history.bytes += size
+        self.bytes += size
+        self.count += 1
+        self.order.append((seq, topic))
+
+        # Rebuild the order when it's mostly stale
+        if len(self.order) > 2 * self.count + 64:
+            self.order = deque(sorted((seq, topic) for topic, history in self.topics.items()
+                                      for seq, _, _ in history.messages))
+
+        return True
+
+    def snapshot(self, pattern):
+        # The messages of the topics matched by the pattern in the publish order
+        if PathTrie.is_pattern(pattern):
+            trie = PathTrie()
+            trie.add(pattern, pattern)
+            topics = [topic for topic in self.topics if trie.match(topic)]
+        else:
+            topics = [pattern] if pattern in self.topics else []
+
+        entries = sorted(entry for topic in topics for entry in self.topics[topic].messages)
+        return [message for _, message, _ in entries]
+
+    def _drop(self, topic, history):
+        self.bytes -= history.popleft()
+        self.count -= 1
+
+        if not history:
+            self.topics.pop(topic, None)
+
+    def _drop_oldest(self):
+        while self.order:
+            seq, topic = self.order.popleft()
+            history = self.topics.get(topic)
+            if history and history.messages[0][0] == seq:
+                self._drop(topic, history)
+                return
@@ -0,0 +1,98 @@
+import asyncio
+import functools
+import time
+
+from bisect import bisect_left
+
+# The upper bounds of the latency buckets in milliseconds
+LATENCY_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+def get_size(data):
+    # The text packets are counted by their UTF-8 bytes, only the non-ASCII text is encoded
+    if isinstance(data, str) and not data.isascii():
+        return len(data.encode("utf-8"))
+
+    return len(data)
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def dump(self):
+        buckets = {"<={}".format(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets[">{}".format(self.bounds[-1])] = self.counts[-1]
+
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": buckets
+        }
+
+
+class Metrics:
+    """
+    The counters of the server. All the handlers run in the event loop thread, the counters are plain integers
+    without any lock.
+    """
+    def __init__(self):
+        self.events = {}
+        self.latencies = {}
+
+        self.connections = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        # The messages dropped by the outboxes of the slow clients, and replaced by the newer messages of the
+        # conflated topics
+        self.dropped = 0
+        self.conflated = 0
+
+        # The messages rejected by the rate limits
+        self.limited = 0
+
+    def instrument(self, event, handler):
+        if not asyncio.iscoroutinefunction(handler):
+            raise TypeError("The handler of the event {} should be a coroutine function".format(event))
+
+        self.events[event] = 0
+        latency = self.latencies[event] = Histogram()
+
+        @functools.wraps(handler)
+        async def instrumented(*args):
+            self.events[event] += 1
+            start = time.perf_counter()
+            try:
+                return await handler(*args)
+            finally:
+                latency.observe((time.perf_counter() - start) * 1000)
+
+        return instrumented
+
+    def count_in(self, data):
+        self.bytes_in += get_size(data)
+
+    def count_out(self, data):
+        if data is not None:
+            self.bytes_out += get_size(data)
+
+    def dump(self):
+        return {
+            "events": dict(self.events),
+            "latency_ms": {event: histogram.dump() for event, histogram in self.latencies.items()},
+            "connections": self.connections,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "dropped": self.dropped,
+            "conflated": self.conflated,
+            "limited": self.limited
+        }
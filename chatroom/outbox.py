@@ -0,0 +1,179 @@
+from collections import deque
+
+# The policies when the outbox of a slow client is full
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DISCONNECT = "disconnect"
+PAUSE_PUBLISHER = "pause_publisher"
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT, PAUSE_PUBLISHER)
+
+# The priority lanes from the highest, the senders can tag the messages by "priority"
+CONTROL = "control"
+RPC = "rpc"
+PUBLISH = "publish"
+BULK = "bulk"
+
+LANES = (CONTROL, RPC, PUBLISH, BULK)
+
+# The share of every lane when all the lanes are waiting
+DEFAULT_WEIGHTS = {
+    CONTROL: 8,
+    RPC: 4,
+    PUBLISH: 2,
+    BULK: 1
+}
+
+# The lanes of the events without the priority, the other events are the control messages
+EVENT_LANES = {
+    "rpc_request": RPC,
+    "rpc_response": RPC,
+    "publish": PUBLISH,
+    "echo": PUBLISH
+}
+
+
+def get_lane(event, priority=None):
+    if priority is not None:
+        return priority
+
+    return EVENT_LANES.get(event, CONTROL)
+
+
+class Outbox:
+    """
+    The messages waiting for a slow client. The messages are queued here when the Engine.IO queue of the client
+    is not empty, the caps bound the memory and the policy decides what happens when the outbox is full. Every
+    priority lane is a FIFO and the lanes share the client by the smooth weighted round robin.
+    """
+    def __init__(self, max_bytes, max_messages, policy=DROP_OLDEST, weights=None):
+        if policy not in POLICIES:
+            raise ValueError("The outbound policy {} is not supported".format(policy))
+
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.policy = policy
+
+        # lane -> [message, size, key, lane], key -> the pending entry of the conflated topic
+        self.lanes = {lane: deque() for lane in LANES}
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.current_weights = dict.fromkeys(LANES, 0)
+        self.keys = {}
+        self.count = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.conflated = 0
+
+        # The outbox is congested from full until drained to the half, the senders are told about both
+        self.congested = False
+        self.senders = set()
+
+        # The task sending the messages to the client
+        self.task = None
+
+    def __len__(self):
+        return self.count
+
+    def is_full(self, size=0):
+        return self.count + 1 > self.max_messages or self.bytes + size > self.max_bytes
+
+    def is_drained(self):
+        return self.count <= self.max_messages // 2 and self.bytes <= self.max_bytes // 2
+
+    def put(self, message, size, key=None, lane=PUBLISH):
+        # Return the number of the dropped messages, or None when the client should be disconnected
+        if size > self.max_bytes:
+            # The message larger than the cap never fits, the queued messages are kept
+            self.dropped += 1
+            return 1
+
+        entry = self.keys.get(key) if key is not None else None
+        if entry is not None:
+            # The newer message of the conflated topic replaces the pending one in place, the slow client catches
+            # up to the current state instead of the backlog
+            self.conflated += 1
+            if self.bytes + size - entry[1] <= self.max_bytes:
+                self.bytes += size - entry[1]
+                entry[0] = message
+                entry[1] = size
+                return 0
+
+            # The larger message doesn't fit in place, the stale one is removed and the new one queued by the policy
+            self._remove(entry)
+
+        if not self.is_full(size):
+            self._append(message, size, key, lane)
+            return 0
+
+        self.congested = True
+        if self.policy == DISCONNECT:
+            return None
+
+        dropped = 1
+        if self.policy == DROP_OLDEST:
+            # Only the messages of the same or lower priority make room for the new message
+            dropped = 0
+            while self.is_full(size) and self._drop_oldest(lane):
+                dropped += 1
+
+            # The higher lanes may keep the outbox full
+            if self.is_full(size):
+                dropped += 1
+            else:
+                self._append(message, size, key, lane)
+
+        self.dropped += dropped
+        return dropped
+
+    def get(self):
+        # The smooth weighted round robin between the waiting lanes
+        total = 0
+        selected = None
+        for lane, messages in self.lanes.items():
+            if messages:
+                self.current_weights[lane] += self.weights[lane]
+                total += self.weights[lane]
+                if selected is None or self.current_weights[lane] > self.current_weights[selected]:
+                    selected = lane
+
+        self.current_weights[selected] -= total
+        return self._popleft(selected)
+
+    def _drop_oldest(self, lane):
+        # Drop the oldest message of the lowest lane, but not higher than the lane
+        for lower in reversed(LANES):
+            if self.lanes[lower]:
+                self._popleft(lower)
+                return True
+
+            if lower == lane:
+                break
+
+        return False
+
+    def _popleft(self, lane):
+        message, size, key, _ = self.lanes[lane].popleft()
+        self.count -= 1
+        self.bytes -= size
+        if key is not None:
+            del self.keys[key]
+        return message
+
+    def _remove(self, entry):
+        messages = self.lanes[entry[3]]
+        for index, queued in enumerate(messages):
+            if queued is entry:
+                del messages[index]
+                break
+
+        self.count -= 1
+        self.bytes -= entry[1]
+        del self.keys[entry[2]]
+
+    def _append(self, message, size, key, lane):
+        entry = [message, size, key, lane]
+        self.lanes[lane].append(entry)
+        self.count += 1
+        self.bytes += size
+        if key is not None:
+            self.keys[key] = entry
@@ -0,0 +1,110 @@
+import heapq
+import threading
+import time
+
+from chatroom.utils import PendingLimitError
+
+
+class Deadlines:
+    """
+    The heap of (deadline, id) of the requests with the deadlines. The requests responded or touched before the
+    deadline aren't removed from the heap, their stale entries are dropped lazily by the expire.
+    """
+    def __init__(self):
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, deadline, id):
+        heapq.heappush(self.heap, (deadline, id))
+
+    def expire(self, now, entries, get_deadline):
+        # The ids of the entries whose current deadline is passed, the caller removes them from the entries
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, id = heapq.heappop(self.heap)
+
+            entry = entries.get(id)
+            if entry is not None and get_deadline(entry) == deadline:
+                expired.append(id)
+
+        # Most requests are responded before the deadline, rebuild the heap when it's mostly garbage
+        if len(self.heap) > 2 * len(entries) + 64:
+            self.heap = [(get_deadline(entry), id) for id, entry in entries.items()]
+            heapq.heapify(self.heap)
+
+        return expired
+
+
+class PendingRequests:
+    """
+    The RPC requests waiting for the response. Every request has a deadline, the expired requests are removed by
+    the sweep and their events receive the TimeoutError.
+    """
+    def __init__(self, max_size=10000, timeout=60):
+        self.max_size = max_size
+        self.timeout = timeout
+
+        # id -> (deadline, event, timeout)
+        self.requests = {}
+
+        self.deadlines = Deadlines()
+
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __contains__(self, id):
+        return id in self.requests
+
+    def add(self, id, event, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        if len(self.requests) >= self.max_size:
+            self.sweep()
+
+        with self.lock:
+            if len(self.requests) >= self.max_size:
+                raise PendingLimitError("Too many pending requests, the limit is {}".format(self.max_size))
+
+            deadline = time.monotonic() + timeout
+            self.requests[id] = (deadline, event, timeout)
+            self.deadlines.push(deadline, id)
+
+    def touch(self, id):
+        # Restart the timeout of the request, e.g. the streaming request receives a chunk
+        with self.lock:
+            entry = self.requests.get(id)
+            if entry is None:
+                return None
+
+            deadline = time.monotonic() + entry[2]
+            self.requests[id] = (deadline, entry[1], entry[2])
+            self.deadlines.push(deadline, id)
+
+        return entry[1]
+
+    def pop(self, id):
+        with self.lock:
+            entry = self.requests.pop(id, None)
+
+        if entry is None:
+            return None
+
+        return entry[1]
+
+    def sweep(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        with self.lock:
+            ids = self.deadlines.expire(now, self.requests, lambda entry: entry[0])
+            expired = [(id, self.requests.pop(id)[1]) for id in ids]
+
+        for id, event in expired:
+            event.set_error(TimeoutError("The request {} is timeout".format(id)))
+
+        return len(expired)
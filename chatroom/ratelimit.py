@@ -0,0 +1,64 @@
+class TokenBucket:
+    """
+    The tokens refill at the rate per second up to the burst and every message takes one token. The bucket is
+    updated in place, checking a message doesn't allocate.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def consume(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        # The seconds until the next token
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """
+    The token buckets of every key, e.g. the sid or the path, for every limited event. The limit of an event is
+    the rate per second or (rate, burst), the burst is the rate by default. The buckets of a key are created by its
+    first message and removed with the key.
+    """
+    def __init__(self, limits=None):
+        # event -> (rate, burst)
+        self.limits = {}
+        for event, limit in (limits or {}).items():
+            rate, burst = limit if isinstance(limit, (tuple, list)) else (limit, None)
+            if rate <= 0:
+                raise ValueError("The rate limit of {} should be positive".format(event))
+
+            self.limits[event] = (rate, max(1, rate if burst is None else burst))
+
+        # key -> event -> the token bucket
+        self.buckets = {}
+
+    def __contains__(self, event):
+        return event in self.limits
+
+    def get_bucket(self, key, event, now):
+        buckets = self.buckets.get(key)
+        if buckets is None:
+            buckets = self.buckets[key] = {}
+
+        bucket = buckets.get(event)
+        if bucket is None:
+            rate, burst = self.limits[event]
+            bucket = buckets[event] = TokenBucket(rate, burst, now)
+
+        return bucket
+
+    def remove(self, key):
+        self.buckets.pop(key, None)
@@ -0,0 +1,247 @@
+from chatroom.utils import PathTrie
+
+
+class ServiceGroup:
+    """
+    The clients registered under the same path, the requests to the path are balanced between them.
+    """
+    ROUND_ROBIN = "round_robin"
+    LEAST_OUTSTANDING = "least_outstanding"
+    WEIGHTED = "weighted"
+
+    STRATEGIES = (ROUND_ROBIN, LEAST_OUTSTANDING, WEIGHTED)
+
+    def __init__(self, path, strategy=ROUND_ROBIN):
+        if strategy not in self.STRATEGIES:
+            raise ValueError("The strategy {} is not supported".format(strategy))
+
+        self.path = path
+        self.strategy = strategy
+
+        # sid -> the index in sids, the removed sid is replaced by the last one
+        self.sids = []
+        self.positions = {}
+        self.weights = {}
+        self.outstanding = {}
+
+        # The state of the round robin and the smooth weighted round robin
+        self.next_index = 0
+        self.current_weights = {}
+
+    def __len__(self):
+        return len(self.sids)
+
+    def __contains__(self, sid):
+        return sid in self.weights
+
+    def add(self, sid, weight=1):
+        if sid not in self.weights:
+            self.positions[sid] = len(self.sids)
+            self.sids.append(sid)
+
+        self.weights[sid] = weight
+        self.outstanding.setdefault(sid, 0)
+        self.current_weights.setdefault(sid, 0)
+
+    def remove(self, sid):
+        if sid not in self.weights:
+            return
+
+        index = self.positions.pop(sid)
+        last = self.sids.pop()
+        if last != sid:
+            self.sids[index] = last
+            self.positions[last] = index
+
+        del self.weights[sid]
+        del self.outstanding[sid]
+        del self.current_weights[sid]
+
+    def select(self):
+        if not self.sids:
+            return None
+
+        if self.strategy == self.LEAST_OUTSTANDING:
+            return min(self.sids, key=self.outstanding.__getitem__)
+
+        if self.strategy == self.WEIGHTED:
+            # Smooth weighted round robin, the heavier sid is selected more often but not in a row
+            total = 0
+            selected = None
+            for sid in self.sids:
+                self.current_weights[sid] += self.weights[sid]
+                total += self.weights[sid]
+                if selected is None or self.current_weights[sid] > self.current_weights[selected]:
+                    selected = sid
+
+            self.current_weights[selected] -= total
+            return selected
+
+        self.next_index = self.next_index % len(self.sids)
+        selected = self.sids[self.next_index]
+        self.next_index += 1
+        return selected
+
+    def acquire(self, sid):
+        if sid in self.outstanding:
+            self.outstanding[sid] += 1
+
+    def release(self, sid):
+        if self.outstanding.get(sid, 0) > 0:
+            self.outstanding[sid] -= 1
+
+
+class ClientRecord:
+    """
+    The connected client. Only the fields the server uses are kept from the register information, the record of
+    every connection stays small.
+    """
+    __slots__ = ("sid", "server", "worker", "path", "codecs", "outbound_policy", "conflate", "rooms")
+
+    def __init__(self, sid, server, worker=None):
+        self.sid = sid
+        self.server = server
+
+        # The index of the worker the client connects to, None for the clients of this worker
+        self.worker = worker
+
+        # Set by the register, the rooms are the subscribed path patterns
+        self.path = None
+        self.codecs = frozenset()
+        self.outbound_policy = None
+        self.conflate = None
+        self.rooms = None
+
+    def dump(self):
+        return {
+            "sid": self.sid,
+            "worker": self.worker,
+            "path": self.path,
+            "rooms": sorted(self.rooms or ())
+        }
+
+
+class Registry:
+    """
+    The records of the connected clients with the reverse indexes, path -> the service group of the registered sids
+    and room -> the subscribed sids. Every lookup is O(1) and the cleanup of a sid is O(k) of its rooms.
+    """
+    def __init__(self):
+        # sid -> the record, path -> the service group, room -> sids
+        self.records = {}
+        self.groups = {}
+        self.rooms = {}
+
+        # The room patterns -> sids, matched by the published path
+        self.subscriptions = PathTrie()
+
+        self.registered = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, sid):
+        return sid in self.records
+
+    def get(self, sid):
+        return self.records.get(sid)
+
+    def get_path(self, sid):
+        record = self.records.get(sid)
+        return record.path if record is not None else None
+
+    def get_group(self, path):
+        return self.groups.get(path)
+
+    def connect(self, sid, server, worker=None):
+        record = self.records[sid] = ClientRecord(sid, server, worker)
+        return record
+
+    def disconnect(self, sid):
+        # Return the record of the sid, None when it's not connected
+        self.unregister(sid)
+
+        record = self.records.pop(sid, None)
+        if record is not None:
+            for room in record.rooms or ():
+                self._leave(sid, room)
+
+        return record
+
+    def register(self, sid, path, strategy=None, weight=1):
+        # The clients registered under the same path share the requests by the strategy of the first one, raise
+        # ValueError when the strategy or the weight is not supported
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not weight > 0:
+            raise ValueError("The weight should be a positive number, not {!r}".format(weight))
+
+        record = self.records[sid]
+
+        group = self.groups.get(path)
+        if group is None:
+            group = ServiceGroup(path, strategy or ServiceGroup.ROUND_ROBIN)
+            self.groups[path] = group
+
+        # The client registered again moves to the new path
+        if record.path is not None and record.path != path:
+            self.unregister(sid)
+
+        if record.path is None:
+            self.registered += 1
+        record.path = path
+        group.add(sid, weight)
+
+        return record
+
+    def unregister(self, sid):
+        # Return the path the sid was registered under, None when it's not registered
+        record = self.records.get(sid)
+        if record is None or record.path is None:
+            return None
+
+        path = record.path
+        record.path = None
+        self.registered -= 1
+
+        group = self.groups[path]
+        group.remove(sid)
+        if not group:
+            del self.groups[path]
+
+        return path
+
+    def join(self, sid, room):
+        record = self.records[sid]
+        if record.rooms is None:
+            record.rooms = set()
+
+        if room not in record.rooms:
+            record.rooms.add(room)
+            self.rooms.setdefault(room, set()).add(sid)
+            self.subscriptions.add(room, sid)
+
+    def leave(self, sid, room):
+        record = self.records.get(sid)
+        if record is None or not record.rooms or room not in record.rooms:
+            return
+
+        record.rooms.discard(room)
+        self._leave(sid, room)
+
+    def match(self, path):
+        # The sids subscribed to the published path
+        return self.subscriptions.match(path)
+
+    def list(self, path=None):
+        if path is None:
+            return [record.dump() for record in self.records.values() if record.path is not None]
+
+        group = self.groups.get(path)
+        return [self.records[sid].dump() for sid in group.sids] if group is not None else []
+
+    def _leave(self, sid, room):
+        sids = self.rooms[room]
+        sids.discard(sid)
+        if not sids:
+            del self.rooms[room]
+
+        self.subscriptions.remove(room, sid)
@@ -1,26 +1,137 @@
+import asyncio
+import functools
+import multiprocessing
 import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from collections import deque
+
 import socketio
 from aiohttp import web
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from logzero import setup_logger
 
 from chatroom.zeroconf_server import Server as ZServer
+from chatroom.bus import Bus
+from chatroom.codec import Codec, CodecError, get_payload_codecs
+from chatroom.fragment import MARKER as FRAGMENT_MARKER, estimate_size
+from chatroom.history import History
+from chatroom.metrics import Metrics
+from chatroom.outbox import Outbox, DROP_OLDEST, LANES, get_lane
+from chatroom.pending import Deadlines
+from chatroom.ratelimit import RateLimiter
+from chatroom.registry import Registry
+from chatroom.utils import JSON_SERIALIZER, MSGPACK_SERIALIZER, SOCKETIO_PATHS
 
 ROOT_FOLDER = os.path.join(os.path.dirname(__file__), "..")
 STATIC_FOLDER = os.path.join(ROOT_FOLDER, "static")
 
 logger = setup_logger("chatroom.server")
 
+# The packets in the Engine.IO queue of a client before the following messages wait in its outbox
+EIO_QUEUE_LIMIT = 8
+
+
+class RPCRoute:
+    """
+    The RPC request in flight. The response is routed back to the caller by the request id, the request fails when
+    the deadline passes or the caller or the callee disconnects.
+    """
+    def __init__(self, caller_sid, group, callee_sid, timeout, priority=None):
+        self.caller_sid = caller_sid
+        self.group = group
+        self.callee_sid = callee_sid
+        self.timeout = timeout
+        self.priority = priority
+        self.deadline = time.monotonic() + timeout
+
+        # The worker of the callee, None when the callee connects to this worker
+        self.callee_worker = None
+
 
 class Server:
-    def __init__(self, name, address, port, version):
+    def __init__(self, name, address, port, version, serializers=None, compression_dictionaries=(),
+                 rpc_timeout=60, sweep_interval=1, outbound_max_bytes=16 * 1024 * 1024, outbound_max_messages=10000,
+                 outbound_policy=DROP_OLDEST, outbound_weights=None, history_size=0, history_max_bytes=1024 * 1024,
+                 history_total_bytes=64 * 1024 * 1024, rate_limits=None, path_rate_limits=None, workers=1):
         self.name = name
         self.address = address
         self.port = port
         self.version = version
 
-        self.registers = {}
-        self.path_index = {}
+        # The workers share the port by SO_REUSEPORT and forward the messages to each other by the local bus. The
+        # bus is created in every worker, the index of this worker is None until it's started
+        self.workers = workers
+        self.worker = None
+        self.bus = None
+
+        # RPC request id -> the worker keeping the route of the request, for the requests to the sids of this worker
+        # from the callers of the other workers
+        self.remote_routes = {}
+
+        # Every serializer has its own Socket.IO endpoint, the JSON one is always available for the browser
+        if serializers is None:
+            serializers = [JSON_SERIALIZER]
+            if msgpack is not None:
+                serializers.append(MSGPACK_SERIALIZER)
+        elif JSON_SERIALIZER not in serializers:
+            serializers = [JSON_SERIALIZER] + list(serializers)
+        self.serializers = serializers
+
+        # The records of the connected clients with the Socket.IO server of their serializers, the service groups
+        # of the registered paths and the subscribed rooms
+        self.registry = Registry()
+
+        # The compressed payload is decompressed by the server for the clients which don't accept its codec,
+        # e.g. the browser
+        self.codec = Codec(dictionaries=compression_dictionaries)
+
+        # RPC request id -> the route of the request, sid -> the ids of its requests as the caller or the callee
+        self.rpc_routes = {}
+        self.sid_rpc_routes = {}
+
+        # The deadlines of the routes, the requests without the timeout use the rpc_timeout of the server
+        self.rpc_timeout = rpc_timeout
+        self.rpc_deadlines = Deadlines()
+        self.sweep_interval = sweep_interval
+        self.sweep_task = None
+
+        # sid -> the outbox of the slow client, the client can choose its policy by "outbound_policy" in the
+        # register information. The priority lanes of the outbox share the client by the weights
+        self.outbound_max_bytes = outbound_max_bytes
+        self.outbound_max_messages = outbound_max_messages
+        self.outbound_policy = outbound_policy
+        self.outbound_weights = outbound_weights
+        self.outboxes = {}
+
+        # The last history_size messages of every publisher are replayed to the new subscribers, the publisher can
+        # choose its own size by "history" in the register information. sid -> fragment id -> the frames of the
+        # fragmented publish, the frames of a message larger than the cap are None
+        self.history = History(history_size, history_max_bytes, history_total_bytes)
+        self.history_fragments = {}
+
+        # sid -> [the number of its running replays, the live publishes held until the replay is sent]
+        self.replaying = {}
+
+        # The token buckets of every sid and every registered path for the limited events, e.g.
+        # rate_limits={"publish": (100, 200)} allows 100 publish per second and the burst of 200 for every sid
+        self.sid_limiter = RateLimiter(rate_limits)
+        self.path_limiter = RateLimiter(path_rate_limits)
+
+        # sid -> the ids of the fragmented messages admitted by the first frame, the following frames take no token
+        self.admitted_fragments = {}
+
+        self.metrics = Metrics()
 
         self._init_zeroconfig()
         self._init_socketio()
@@ -28,9 +139,16 @@ class Server:
     def _init_zeroconfig(self):
         # Zeroconf
         logger.info("Start zeroconfig server {} at {}:{}".format(self.name, self.address, self.port))
-        self.zserver = ZServer(self.name, self.address, self.port, {
-            "version": self.version
-        })
+        properties = {
+            "version": self.version,
+            "serializers": ",".join(self.serializers)
+        }
+
+        # The polling requests of one client may reach different workers, only the websocket is accepted
+        if self.workers > 1:
+            properties["transports"] = "websocket"
+
+        self.zserver = ZServer(self.name, self.address, self.port, properties)
         self.zserver.register()
 
     def _init_socketio(self):
@@ -38,37 +156,349 @@ class Server:
         self.app = web.Application()
         #self.app.router.add_static('/static', STATIC_FOLDER)
         self.app.router.add_get('/', self.index)
+        self.app.on_startup.append(self._start_sweep)
+        self.app.on_cleanup.append(self._stop_sweep)
+        self.app.router.add_get('/metrics', self.get_metrics)
+        self.app.router.add_get('/clients', self.get_clients)
+
+        # The count and the latency of every event are recorded in the metrics
+        handlers = {
+            "register": self.register,
+            "unregister": self.unregister,
+            "rpc_request": self.rpc_request,
+            "rpc_response": self.rpc_response,
+            "rpc_credit": self.rpc_credit,
+            "rpc_cancel": self.rpc_cancel,
+            "publish": self.publish,
+            "subscribe": self.subscribe,
+            "unsubscribe": self.unsubscribe,
+            "echo": self.echo,
+            "batch": self.batch
+        }
+        handlers = {event: self.metrics.instrument(event, self._limit(event, handler))
+                    for event, handler in handlers.items()}
+
+        # The clients share the same handlers whichever serializer they use
+        self.sios = {}
+        for serializer in self.serializers:
+            sio = socketio.AsyncServer(serializer="default" if serializer == JSON_SERIALIZER else serializer,
+                                       transports=["websocket"] if self.workers > 1 else None)
+            sio.attach(self.app, socketio_path=SOCKETIO_PATHS[serializer])
+
+            sio.on("connect", self._get_connect_handler(sio), namespace="/chat")
+            sio.on("disconnect", self.disconnect, namespace="/chat")
+            for event, handler in handlers.items():
+                sio.on(event, handler, namespace="/chat")
+
+            self._init_traffic_metrics(sio)
+            self.sios[serializer] = sio
+
+        self.sio = self.sios[JSON_SERIALIZER]
+
+        # The events which can be carried by the batch event
+        self.batch_handlers = {
+            "rpc_request": self.rpc_request,
+            "rpc_response": self.rpc_response,
+            "rpc_credit": self.rpc_credit,
+            "rpc_cancel": self.rpc_cancel,
+            "publish": self.publish,
+            "echo": self.echo
+        }
+        self.batch_handlers = {event: self._limit(event, handler, batch=True)
+                               for event, handler in self.batch_handlers.items()}
+
+    def _get_connect_handler(self, sio):
+        def connect(sid, environ):
+            self.registry.connect(sid, sio)
+            return self.connect(sid, environ)
 
-        self.sio = socketio.AsyncServer()
-        self.sio.attach(self.app)
+        return connect
 
-        self.sio.on("connect", self.connect, namespace="/chat")
-        self.sio.on("disconnect", self.disconnect, namespace="/chat")
-        self.sio.on("register", self.register, namespace="/chat")
-        self.sio.on("unregister", self.unregister, namespace="/chat")
+    def _init_traffic_metrics(self, sio):
+        # Count the bytes of the Engine.IO messages in and out
+        eio = sio.eio
 
-        self.sio.on("rpc_request", self.rpc_request, namespace="/chat")
-        self.sio.on("rpc_response", self.rpc_response, namespace="/chat")
-        self.sio.on("publish", self.publish, namespace="/chat")
-        self.sio.on("subscribe", self.subscribe, namespace="/chat")
+        handle_message = eio.handlers['message']
+        async def count_message(sid, data):
+            self.metrics.count_in(data)
+            return await handle_message(sid, data)
+        eio.on('message', count_message)
 
-        self.sio.on("echo", self.echo, namespace="/chat")
+        send_packet = eio.send_packet
+        async def count_packet(sid, pkt):
+            self.metrics.count_out(pkt.data)
+            return await send_packet(sid, pkt)
+        eio.send_packet = count_packet
 
     async def index(self, request):
         with open('index.html') as f:
             return web.Response(text=f.read(), content_type='text/html')
 
-    def get_broadcast_path(self, name):
-        return "{}-broadcast".format(name)
+    async def get_metrics(self, request):
+        metrics = self.metrics.dump()
+
+        metrics.update({
+            "worker": self.worker,
+            "registers": self.registry.registered,
+            "path_index": len(self.registry.groups),
+            "rpc_in_flight": len(self.rpc_routes),
+            "outboxes": len(self.outboxes),
+            "outbox_bytes": sum(outbox.bytes for outbox in self.outboxes.values()),
+            "history_topics": len(self.history.topics),
+            "history_messages": len(self.history),
+            "history_bytes": self.history.bytes,
+            "subscribers": {room: len(sids) for room, sids in self.registry.rooms.items()}
+        })
+
+        return web.json_response(metrics)
+
+    async def get_clients(self, request):
+        # The registered clients, or only the clients of ?path=. The clients of this worker have no worker in the
+        # registry
+        clients = self.registry.list(request.query.get("path"))
+        for client in clients:
+            if client["worker"] is None:
+                client["worker"] = self.worker
 
-    async def reply(self, uid, sid, success, error=""):
+        return web.json_response(clients)
+
+    async def reply(self, uid, sid, success, error="", **kwargs):
         msg = {
             "success": success
         }
         if not success:
             msg['error'] = error
+        msg.update(kwargs)
+
+        # Without the uid, the message is returned as the Socket.IO ack when the sender asks for it
+        if uid is None:
+            return msg
+
+        await self.send(uid, msg, [sid])
+        return msg
+
+    async def send(self, event, data, sids, sender_sid=None, conflation_key=None, priority=None, replay=False):
+        # The sids connected to the same Socket.IO server share one encoded packet, the messages to the slow sids
+        # wait in the priority lanes of their outboxes where the message with the conflation key replaces the
+        # pending one with the same key. Return the number of the dropped messages
+        groups = {}
+        slow_sids = []
+        remote_sids = {}
+        for sid in sids:
+            # The live publishes to the sid receiving the replay are sent after it
+            if event == "publish" and not replay and sid in self.replaying:
+                self.replaying[sid][1].append((data, sender_sid, conflation_key, priority))
+                continue
+
+            record = self.registry.get(sid)
+            if record is not None and record.worker is not None:
+                remote_sids.setdefault(record.worker, []).append(sid)
+                continue
+
+            sio = record.server if record is not None else self.sio
+            if sid in self.outboxes or self._is_slow(sio, sid):
+                slow_sids.append(sid)
+            else:
+                groups.setdefault(sio, []).append(sid)
+
+        for sio, group in groups.items():
+            await sio.emit(event, data, room=group, namespace="/chat")
+
+        # The worker of the sids sends the message by its own outboxes
+        for worker, worker_sids in remote_sids.items():
+            self.bus.send(worker, {
+                "type": "send",
+                "event": event,
+                "data": data,
+                "sids": worker_sids,
+                "sender_sid": sender_sid,
+                "conflation_key": conflation_key,
+                "priority": priority
+            })
+
+        if not slow_sids:
+            return 0
+
+        return await self._queue(event, data, slow_sids, sender_sid, conflation_key, get_lane(event, priority))
+
+    def _get_server(self, sid):
+        record = self.registry.get(sid)
+        return record.server if record is not None else self.sio
+
+    ##################################################################################################################
+    #
+    #   Outbox
+    #
+    ##################################################################################################################
+    def _get_eio_queue(self, sio, sid):
+        socket = sio.eio.sockets.get(sio.manager.eio_sid_from_sid(sid, "/chat"))
+        if socket is None:
+            return None
+
+        return socket.queue
+
+    def _is_slow(self, sio, sid):
+        queue = self._get_eio_queue(sio, sid)
+        return queue is not None and queue.qsize() >= EIO_QUEUE_LIMIT
+
+    async def _queue(self, event, data, sids, sender_sid, conflation_key, lane):
+        size = estimate_size(data, float("inf"))
+
+        dropped = 0
+        for sid in sids:
+            outbox = self.outboxes.get(sid)
+            if outbox is None:
+                # The sid is disconnecting
+                record = self.registry.get(sid)
+                if record is None:
+                    continue
+
+                policy = self.outbound_policy
+                if record is not None and record.outbound_policy:
+                    policy = record.outbound_policy
+                outbox = self.outboxes[sid] = Outbox(self.outbound_max_bytes, self.outbound_max_messages, policy,
+                                                     self.outbound_weights)
+
+            conflated = outbox.conflated
+            count = outbox.put((event, data), size, conflation_key, lane)
+            self.metrics.conflated += outbox.conflated - conflated
+
+            if outbox.congested and sender_sid is not None and sender_sid not in outbox.senders:
+                outbox.senders.add(sender_sid)
+                await self._notify_senders(sid, outbox, [sender_sid])
+
+            if count is None:
+                logger.error("The outbox of {} is full, disconnect it".format(sid))
+                await self._get_server(sid).disconnect(sid, namespace="/chat")
+                continue
 
-        await self.sio.emit(uid, msg, room=sid, namespace="/chat")
+            dropped += count
+            self.metrics.dropped += count
+
+            if outbox.task is None:
+                outbox.task = asyncio.ensure_future(self._drain(sid, outbox))
+
+        return dropped
+
+    async def _drain(self, sid, outbox):
+        sio = self._get_server(sid)
+
+        while outbox:
+            # The writer of the slow client takes the packets slowly, send the next message when it's idle
+            queue = self._get_eio_queue(sio, sid)
+            if queue is None:
+                break
+            await queue.join()
+
+            event, data = outbox.get()
+            await sio.emit(event, data, room=sid, namespace="/chat")
+
+            if outbox.congested and outbox.is_drained():
+                outbox.congested = False
+                await self._notify_senders(sid, outbox, outbox.senders)
+                outbox.senders.clear()
+
+        outbox.task = None
+        if self.outboxes.get(sid) is outbox and not outbox:
+            del self.outboxes[sid]
+
+    async def _notify_senders(self, sid, outbox, sender_sids, path=None):
+        # The senders learn the congestion of the receiver, the publishers pause by the pause_publisher policy
+        await self.send("backpressure", {
+            "sid": sid,
+            "path": path or self.registry.get_path(sid),
+            "policy": outbox.policy,
+            "congested": outbox.congested,
+            "dropped": outbox.dropped
+        }, [sender_sid for sender_sid in sender_sids if sender_sid in self.registry])
+
+    ##################################################################################################################
+    #
+    #   Rate Limit
+    #
+    ##################################################################################################################
+    def _limit(self, event, handler, batch=False):
+        # The events without any limit skip the check
+        if event not in self.sid_limiter and event not in self.path_limiter:
+            return handler
+
+        @functools.wraps(handler)
+        async def limited(sid, data=None, *args):
+            payload = data.get("payload") if isinstance(data, dict) else None
+            fragment = payload.get(FRAGMENT_MARKER) if isinstance(payload, dict) else None
+            if not isinstance(fragment, dict):
+                fragment = None
+
+            # The message takes one token by its first frame, the following frames of the admitted message pass
+            if fragment is not None and fragment.get("index"):
+                if self._admit_fragment(sid, fragment):
+                    return await handler(sid, data, *args)
+
+                return await self.reply(data.get("_uid"), sid, success=False,
+                                        error="The message {} is rejected by the rate limit".format(fragment.get("id")),
+                                        rate_limited=True)
+
+            retry_after = self._check_rate(sid, event)
+            if retry_after is not None:
+                self.metrics.limited += 1
+                return await self._reject(event, sid, data, retry_after, batch)
+
+            if fragment is not None and isinstance(fragment.get("count"), int) and fragment["count"] > 1:
+                self.admitted_fragments.setdefault(sid, set()).add(fragment.get("id"))
+
+            return await handler(sid, data, *args)
+
+        return limited
+
+    def _admit_fragment(self, sid, fragment):
+        admitted = self.admitted_fragments.get(sid)
+        if admitted is None or fragment.get("id") not in admitted:
+            return False
+
+        # The last frame ends the message
+        count = fragment.get("count")
+        if not isinstance(count, int) or fragment["index"] >= count - 1:
+            admitted.discard(fragment.get("id"))
+            if not admitted:
+                del self.admitted_fragments[sid]
+
+        return True
+
+    async def _reject(self, event, sid, data, retry_after, batch):
+        error = "The rate limit of {} is exceeded, retry after {:.3f}s".format(event, retry_after)
+        uid = data.get("_uid") if isinstance(data, dict) else None
+
+        # Without the ack, the caller of the request only knows the failure from the response and the publisher
+        # from the rate_limit event. The batch items are replied by the batch ack
+        if uid is None and isinstance(data, dict):
+            payload = data.get("payload")
+            if event == "rpc_request" and isinstance(payload, dict):
+                await self._send_request_error(sid, data.get("path"), payload.get("id"), error)
+            elif not batch:
+                await self.send("rate_limit", {
+                    "event": event,
+                    "error": error,
+                    "retry_after": retry_after
+                }, [sid])
+
+        return await self.reply(uid, sid, success=False, error=error, rate_limited=True, retry_after=retry_after)
+
+    def _check_rate(self, sid, event):
+        # Return None when the message is allowed, otherwise the seconds to wait for the token
+        now = time.monotonic()
+
+        if event in self.sid_limiter:
+            bucket = self.sid_limiter.get_bucket(sid, event, now)
+            if not bucket.consume(now):
+                return bucket.retry_after()
+
+        path = self.registry.get_path(sid)
+        if path is not None and event in self.path_limiter:
+            bucket = self.path_limiter.get_bucket(path, event, now)
+            if not bucket.consume(now):
+                return bucket.retry_after()
+
+        return None
 
     async def register(self, sid, client_info):
         uid = client_info.get('_uid')
@@ -77,16 +507,52 @@ class Server:
         path = client_info.get('path')
 
         if path is None:
-            await self.reply(uid, sid, success=False, error="The 'path' should be in the register data")
+            return await self.reply(uid, sid, success=False, error="The 'path' should be in the register data")
 
-        # Save the client information
-        self.registers[sid] = client_info
-        self.path_index[path] = sid
+        error = self._check_client_info(client_info)
+        if error is not None:
+            return await self.reply(uid, sid, success=False, error=error)
 
-        # Create a broadcast room for this client
-        self.sio.enter_room(sid, room=self.get_broadcast_path(path))
+        # The clients registered under the same path share the requests
+        try:
+            record = self.registry.register(sid, path, client_info.get('strategy'), client_info.get('weight', 1))
+        except ValueError as e:
+            return await self.reply(uid, sid, success=False, error=str(e))
 
-        await self.reply(uid, sid, success=True)
+        # Only keep the fields used by the server
+        record.codecs = frozenset(client_info.get('codecs', ()))
+        record.outbound_policy = client_info.get('outbound_policy')
+        record.conflate = client_info.get('conflate')
+
+        history = client_info.get('history')
+        if history:
+            self.history.configure(path, history.get('size'), history.get('max_bytes'))
+
+        self._sync(dict(self._dump_record(record), type="register"))
+
+        # The client compresses the payload by the codec both sides accept
+        return await self.reply(uid, sid, success=True, codecs=self.codec.accepted())
+
+    def _check_client_info(self, client_info):
+        # Return the error of the options the server keeps, they are checked before the client is registered
+        # True conflates the messages of the path, a field name the messages with the same value of the field
+        conflate = client_info.get('conflate')
+        if conflate is not None and not isinstance(conflate, (bool, str)):
+            return "The conflate should be true or a field name, not {!r}".format(conflate)
+
+        history = client_info.get('history')
+        if history is None:
+            return None
+
+        if not isinstance(history, dict):
+            return "The history should be an object, not {!r}".format(history)
+
+        for key in ('size', 'max_bytes'):
+            value = history.get(key)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+                return "The history {} should be a non-negative integer, not {!r}".format(key, value)
+
+        return None
 
     async def unregister(self, sid, data=None, reply=True):
         if data:
@@ -94,38 +560,336 @@ class Server:
         else:
             uid = None
 
-        client_info = self.registers.get(sid)
-        if client_info:
-            del self.registers[sid]
+        path = self.registry.unregister(sid)
+        if path is not None and self.registry.get_group(path) is None:
+            self.path_limiter.remove(path)
 
-        del self.path_index[client_info.get('path')]
+        if path is not None:
+            self._sync({"type": "unregister", "sid": sid})
 
-        if reply and uid:
-            await self.reply(uid, success=True)
+        if not reply:
+            return None
+
+        if path is None:
+            return await self.reply(uid, sid, success=False, error="The client {} is not registered".format(sid))
+
+        return await self.reply(uid, sid, success=True)
 
     def connect(self, sid, environ):
         logger.info("New connection {}".format(sid))
+        self.metrics.connections += 1
 
     async def disconnect(self, sid):
         logger.info("{} disconnected".format(sid))
+        self.metrics.connections -= 1
+        self.history_fragments.pop(sid, None)
+        self.admitted_fragments.pop(sid, None)
+        self.sid_limiter.remove(sid)
+
+        # Remove the sid before any await, the messages sent meanwhile don't reach it
+        path = self.registry.get_path(sid)
         await self.unregister(sid, reply=False)
+        self.registry.disconnect(sid)
+        self._sync({"type": "disconnect", "sid": sid})
+
+        # The paused publishers resume when the slow client is gone
+        outbox = self.outboxes.pop(sid, None)
+        if outbox is not None:
+            if outbox.task is not None:
+                outbox.task.cancel()
+            if outbox.congested:
+                outbox.congested = False
+                await self._notify_senders(sid, outbox, outbox.senders, path)
+
+        await self._fail_sid_routes(sid)
+
+    async def _fail_sid_routes(self, sid):
+        # Fail the requests of the sid now instead of waiting for the timeout
+        for request_id in list(self.sid_rpc_routes.get(sid, ())):
+            route = self._pop_route(request_id)
+            if route.callee_sid == sid:
+                error = "The target {} is disconnected".format(route.group.path)
+            else:
+                error = "The caller of the request {} is disconnected".format(request_id)
+            await self._fail_route(request_id, route, error)
 
-    async def _emit(self, uid, source_sid, type_, target_path, payload):
-        source_client_info = self.registers[source_sid]
-        source_path = source_client_info.get('path')
+    async def _emit(self, uid, source_sid, type_, target_path, payload, target_sid=None, conflation_key=None,
+                    priority=None):
+        source_path = self.registry.get_path(source_sid)
+        if source_path is None:
+            return await self.reply(uid, source_sid, success=False,
+                                    error="The client {} is not registered".format(source_sid))
 
-        if "broadcast" == target_path:
-            target_sid = self.get_broadcast_path(source_path)
+        if priority is not None and priority not in LANES:
+            return await self.reply(uid, source_sid, success=False,
+                                    error="The priority {} is not supported".format(priority))
+
+        if target_sid is not None:
+            target_sids = [target_sid]
+        elif "broadcast" == target_path:
+            # Every subscriber whose pattern matches the source path. The published message is kept before any
+            # await, the subscriber joining meanwhile receives it either by the replay or by this message
+            target_sids = list(self.registry.match(source_path))
+            if type_ == "publish":
+                self._keep_history(source_sid, payload)
         else:
-            target_sid = self.path_index.get(target_path)
+            target_sid = self._select(target_path)
+            if target_sid is None:
+                return await self.reply(uid, source_sid, success=False,
+                                        error="The target {} is not existing".format(target_path))
+            target_sids = [target_sid]
+
+        msg = await self.reply(uid, source_sid, success=True)
 
-        await self.reply(uid, source_sid, success=True)
+        if not target_sids:
+            return msg
 
         request_payload = {
             "path": source_path,
             "payload": payload
         }
-        await self.sio.emit(type_, request_payload, room=target_sid, namespace="/chat")
+
+        # The messages dropped by the outboxes of the slow receivers
+        dropped = await self._send_payload(type_, request_payload, target_sids, source_sid, conflation_key, priority)
+        if dropped:
+            msg["dropped"] = dropped
+        return msg
+
+    async def _send_payload(self, type_, request_payload, target_sids, sender_sid=None, conflation_key=None,
+                            priority=None, replay=False):
+        codecs = get_payload_codecs(request_payload["payload"])
+        dropped = 0
+        if codecs:
+            target_sids, dropped = await self._send_decompressed(type_, request_payload, codecs, target_sids,
+                                                                 sender_sid, conflation_key, priority, replay)
+
+        return dropped + await self.send(type_, request_payload, target_sids, sender_sid=sender_sid,
+                                         conflation_key=conflation_key, priority=priority, replay=replay)
+
+    async def _send_decompressed(self, type_, request_payload, codecs, target_sids, sender_sid, conflation_key=None,
+                                 priority=None, replay=False):
+        # Decompress the payload once for the sids which don't accept the codecs, return the others and the number
+        # of the dropped messages
+        accepted_sids = []
+        other_sids = []
+        for sid in target_sids:
+            record = self.registry.get(sid)
+            if record is not None and codecs <= record.codecs:
+                accepted_sids.append(sid)
+            else:
+                other_sids.append(sid)
+
+        if not other_sids:
+            return accepted_sids, 0
+
+        try:
+            payload = self.codec.decompress_payload(request_payload["payload"])
+        except CodecError as e:
+            logger.error("Can't decompress the payload for {} sids: {}".format(len(other_sids), e))
+            return target_sids, 0
+
+        dropped = await self.send(type_, dict(request_payload, payload=payload), other_sids, sender_sid=sender_sid,
+                                  conflation_key=conflation_key, priority=priority, replay=replay)
+        return accepted_sids, dropped
+
+    ##################################################################################################################
+    #
+    #   RPC Route
+    #
+    ##################################################################################################################
+    def _add_route(self, request_id, route):
+        self.rpc_routes[request_id] = route
+        self.rpc_deadlines.push(route.deadline, request_id)
+
+        for sid in (route.caller_sid, route.callee_sid):
+            self.sid_rpc_routes.setdefault(sid, set()).add(request_id)
+
+        # The worker of the callee forwards the responses to this worker, it's told before the request
+        record = self.registry.get(route.callee_sid)
+        if record is not None and record.worker is not None:
+            route.callee_worker = record.worker
+            self.bus.send(record.worker, {"type": "route", "id": request_id})
+
+    def _touch_route(self, request_id, route):
+        # The streaming response restarts the timeout with every chunk
+        route.deadline = time.monotonic() + route.timeout
+        self.rpc_deadlines.push(route.deadline, request_id)
+
+    def _pop_route(self, request_id):
+        route = self.rpc_routes.pop(request_id, None)
+        if route is None:
+            return None
+
+        route.group.release(route.callee_sid)
+        for sid in (route.caller_sid, route.callee_sid):
+            request_ids = self.sid_rpc_routes.get(sid)
+            if request_ids is not None:
+                request_ids.discard(request_id)
+                if not request_ids:
+                    del self.sid_rpc_routes[sid]
+
+        if route.callee_worker is not None:
+            self.bus.send(route.callee_worker, {"type": "unroute", "id": request_id})
+
+        return route
+
+    async def _fail_route(self, request_id, route, error):
+        # The caller receives the error as the response, the callee is told to stop the work
+        if route.caller_sid in self.registry:
+            await self.send("rpc_response", {
+                "path": route.group.path,
+                "payload": {
+                    "id": request_id,
+                    "result": None,
+                    "error": error
+                }
+            }, [route.caller_sid])
+
+        if route.callee_sid in self.registry:
+            await self.send("rpc_cancel", {
+                "payload": {
+                    "id": request_id,
+                    "error": error
+                }
+            }, [route.callee_sid])
+
+    async def sweep_rpc_routes(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        expired = self.rpc_deadlines.expire(now, self.rpc_routes, lambda route: route.deadline)
+
+        for request_id in expired:
+            route = self._pop_route(request_id)
+            await self._fail_route(request_id, route, "The request {} is timeout".format(request_id))
+
+        return len(expired)
+
+    async def _sweep_rpc_routes_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            expired = await self.sweep_rpc_routes()
+            if expired:
+                logger.error("{} RPC requests are timeout".format(expired))
+
+    async def _start_sweep(self, app):
+        self.sweep_task = asyncio.ensure_future(self._sweep_rpc_routes_forever())
+
+    async def _stop_sweep(self, app):
+        if self.sweep_task:
+            self.sweep_task.cancel()
+
+    ##################################################################################################################
+    #
+    #   History
+    #
+    ##################################################################################################################
+    def _keep_history(self, sid, payload):
+        # Nothing is kept by default, the publish doesn't pay for the history
+        path = self.registry.get_path(sid)
+        size, max_bytes = self.history.get_config(path)
+        if size <= 0:
+            return
+
+        message = {
+            "path": path,
+            "payload": payload
+        }
+
+        # The frames of the fragmented publish are kept as one message when all its frames arrive, the frames of
+        # the messages sent at the same time are told apart by the fragment id. The message larger than the cap of
+        # the topic is skipped
+        fragment = payload.get(FRAGMENT_MARKER) if isinstance(payload, dict) else None
+        if isinstance(fragment, dict):
+            fragments = self.history_fragments.setdefault(sid, {})
+            id = fragment.get("id")
+            entry = fragments.setdefault(id, [0, []])
+            entry[0] += 1
+            if entry[1] is not None:
+                entry[1].append(message)
+                if estimate_size(entry[1], max_bytes) > max_bytes:
+                    entry[1] = None
+
+            count = fragment.get("count")
+            if not isinstance(count, int) or entry[0] < count:
+                return
+
+            del fragments[id]
+            if not fragments:
+                del self.history_fragments[sid]
+
+            messages = entry[1]
+            if messages is None:
+                return
+        else:
+            messages = [message]
+
+        self.history.add(path, messages, estimate_size(messages, float("inf")))
+
+    def _get_conflation_key(self, sid, payload):
+        # The publisher opts in by "conflate" in the register information, true conflates the messages of its
+        # path and a field name conflates the messages with the same value of the field
+        record = self.registry.get(sid)
+        conflate = record.conflate if record is not None else None
+        if not conflate or not isinstance(payload, dict) or FRAGMENT_MARKER in payload:
+            return None
+
+        if conflate is True:
+            return record.path, None
+
+        # The field of the compressed payload can't be read, the message isn't conflated
+        if conflate not in payload:
+            return None
+
+        key = record.path, payload[conflate]
+        try:
+            hash(key)
+        except TypeError:
+            return None
+
+        return key
+
+    async def _replay_history(self, sid, pattern):
+        # The snapshot is taken when subscribing, the messages published later are sent by the subscription. Every
+        # worker keeps the history of its own publishers and takes its snapshot when it joins the sid, so a message
+        # is either replayed or sent live. The live publishes to the sid are held until the replay is sent
+        entry = self.replaying.setdefault(sid, [0, deque()])
+        entry[0] += 1
+
+        try:
+            snapshot = self.history.snapshot(pattern)
+            if self.bus is not None:
+                for peer in self.bus.peers:
+                    try:
+                        snapshot += await self.bus.call(peer, {"type": "join", "sid": sid, "room": pattern,
+                                                               "snapshot": True}) or []
+                    except (ConnectionError, asyncio.TimeoutError) as e:
+                        logger.error("Can't get the history of worker {}: {}".format(peer, e))
+
+            for messages in snapshot:
+                for message in messages:
+                    await self._send_payload("publish", message, [sid], replay=True)
+        finally:
+            entry[0] -= 1
+            if entry[0] == 0:
+                await self._send_held(sid, entry[1])
+
+    async def _send_held(self, sid, held):
+        # The last replay of the sid sends the held publishes, the ones held meanwhile too
+        try:
+            while held:
+                data, sender_sid, conflation_key, priority = held.popleft()
+                await self.send("publish", data, [sid], sender_sid=sender_sid, conflation_key=conflation_key,
+                                priority=priority, replay=True)
+        finally:
+            del self.replaying[sid]
+
+    def _select(self, path):
+        group = self.registry.get_group(path)
+        if group is None:
+            return None
+
+        return group.select()
 
     ##################################################################################################################
     #
@@ -142,54 +906,396 @@ class Server:
     async def echo(self, sid, data):
         uid, target_path, payload = self._get_info(data)
 
-        await self._emit(
+        # The echo to its own path returns to the sender, not to another client of the service group
+        target_sid = sid if target_path == self.registry.get_path(sid) else None
+
+        return await self._emit(
             uid=uid,
             source_sid=sid,
             type_="echo",
             target_path=target_path,
-            payload=payload
+            payload=payload,
+            target_sid=target_sid,
+            priority=data.get("priority")
         )
 
     async def rpc_request(self, sid, data):
         uid, target_path, payload = self._get_info(data)
+        if not isinstance(payload, dict):
+            return await self.reply(uid, sid, success=False, error="The payload should be an object")
+
+        request_id = payload.get("id")
+        if not isinstance(request_id, str) or not request_id:
+            return await self.reply(uid, sid, success=False,
+                                    error="The request id should be a string, not {!r}".format(request_id))
+
+        # The following fragments of the large request are sent to the callee of the first one
+        fragment = payload.get(FRAGMENT_MARKER)
+        if isinstance(fragment, dict) and fragment.get("index"):
+            route = self.rpc_routes.get(request_id)
+            if route is None or route.caller_sid != sid:
+                return await self.reply(uid, sid, success=False,
+                                        error="The request {} is not existing".format(request_id))
+
+            return await self._emit(uid=uid, source_sid=sid, type_="rpc_request", target_path=target_path,
+                                    payload=payload, target_sid=route.callee_sid, priority=route.priority)
 
-        await self._emit(
+        # The timeout of the caller is capped by the timeout of the server
+        timeout = payload.get("timeout")
+        error = None
+        if request_id in self.rpc_routes:
+            error = "The request {} is existing".format(request_id)
+        elif timeout is not None and (not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or
+                                      not timeout > 0):
+            error = "The timeout should be a positive number, not {!r}".format(timeout)
+
+        if error is not None:
+            if uid is None:
+                await self._send_request_error(sid, target_path, request_id, error)
+            return await self.reply(uid, sid, success=False, error=error)
+
+        timeout = min(timeout, self.rpc_timeout) if timeout is not None else self.rpc_timeout
+
+        # Select the callee from the service group of the target path
+        group = self.registry.get_group(target_path)
+        target_sid = group.select() if group else None
+
+        # Remember the caller, the response is routed back by the request id in the priority of the request
+        priority = data.get("priority")
+        if target_sid is not None:
+            group.acquire(target_sid)
+            self._add_route(request_id, RPCRoute(sid, group, target_sid, timeout, priority))
+
+        msg = await self._emit(
             uid=uid,
             source_sid=sid,
             type_="rpc_request",
             target_path=target_path,
-            payload=payload
+            payload=payload,
+            target_sid=target_sid,
+            priority=priority
         )
 
+        if not msg["success"]:
+            self._pop_route(request_id)
+
+            # Without the ack, the caller only knows the failure from the response
+            if uid is None:
+                await self._send_request_error(sid, target_path, request_id, msg["error"])
+
+        return msg
+
+    async def _send_request_error(self, sid, target_path, request_id, error):
+        await self.send("rpc_response", {
+            "path": target_path,
+            "payload": {
+                "id": request_id,
+                "result": None,
+                "error": error
+            }
+        }, [sid])
+
     async def rpc_response(self, sid, data):
         uid, target_path, payload = self._get_info(data)
 
-        await self._emit(
+        # The request may be timeout or cancelled, its response is dropped
+        request_id = payload.get("id")
+        route = self.rpc_routes.get(request_id)
+        if route is None and request_id in self.remote_routes:
+            return await self._forward_rpc_response(self.remote_routes[request_id], sid, data)
+
+        if route is None or route.callee_sid != sid:
+            return await self.reply(uid, sid, success=False,
+                                    error="The request {} is not existing".format(request_id))
+
+        # The chunks of the streaming response keep the route until the last frame
+        if payload.get("more"):
+            self._touch_route(request_id, route)
+        else:
+            self._pop_route(request_id)
+
+        return await self._emit(
             uid=uid,
             source_sid=sid,
             type_="rpc_response",
             target_path=target_path,
-            payload=payload
+            payload=payload,
+            target_sid=route.caller_sid,
+            priority=data.get("priority", route.priority)
         )
 
+    async def rpc_credit(self, sid, data):
+        uid, _, payload = self._get_info(data)
+
+        # The caller of the streaming request allows the callee to send more chunks
+        route = self.rpc_routes.get(payload.get("id"))
+        if route is None or route.caller_sid != sid:
+            return await self.reply(uid, sid, success=False,
+                                    error="The stream {} is not existing".format(payload.get("id")))
+
+        await self.send("rpc_credit", {"payload": payload}, [route.callee_sid])
+        return await self.reply(uid, sid, success=True)
+
+    async def rpc_cancel(self, sid, data):
+        uid, _, payload = self._get_info(data)
+        request_id = payload.get("id")
+
+        # Only the caller can cancel the request, the callee is told to stop the work
+        route = self.rpc_routes.get(request_id)
+        if route is None or route.caller_sid != sid:
+            return await self.reply(uid, sid, success=False,
+                                    error="The request {} is not existing".format(request_id))
+
+        self._pop_route(request_id)
+        if route.callee_sid in self.registry:
+            await self.send("rpc_cancel", {
+                "payload": {
+                    "id": request_id,
+                    "error": "The request {} is cancelled by the caller".format(request_id)
+                }
+            }, [route.callee_sid])
+
+        return await self.reply(uid, sid, success=True)
+
     async def publish(self, sid, data):
         uid, _, payload = self._get_info(data)
 
-        await self._emit(
+        return await self._emit(
             uid=uid,
             source_sid=sid,
             type_="publish",
             target_path="broadcast",
-            payload=payload
+            payload=payload,
+            conflation_key=self._get_conflation_key(sid, payload),
+            priority=data.get("priority")
         )
 
     async def subscribe(self, sid, data):
         uid, path, payload = self._get_info(data)
-        room = self.get_broadcast_path(path)
-        self.sio.enter_room(sid, room=room, namespace="/chat")
-        await self.reply(uid, sid, success=True)
+
+        # The path can be a pattern, e.g. "sensors.*" or "sensors.#". The new subscriber receives the kept messages
+        # of the matched publishers first, the other workers join it with their snapshots
+        self.registry.join(sid, path)
+        if data.get("replay", True):
+            await self._replay_history(sid, path)
+        else:
+            self._sync({"type": "join", "sid": sid, "room": path})
+
+        return await self.reply(uid, sid, success=True)
+
+    async def unsubscribe(self, sid, data):
+        uid, path, payload = self._get_info(data)
+
+        self.registry.leave(sid, path)
+        self._sync({"type": "leave", "sid": sid, "room": path})
+
+        return await self.reply(uid, sid, success=True)
+
+    async def batch(self, sid, data):
+        uid = data.get("_uid")
+        items = data.get("items", [])
+        if not isinstance(items, list):
+            return await self.reply(uid, sid, success=False, error="The items should be a list")
+
+        errors = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                errors.append(dict(index=index, error="The item should be an object"))
+                continue
+
+            handler = self.batch_handlers.get(item.get("type"))
+            if handler is None:
+                errors.append(dict(index=index, error="The type {} can't be sent in batch".format(item.get("type"))))
+                continue
+
+            # The items are replied together by the batch ack
+            item.pop("_uid", None)
+
+            try:
+                msg = await handler(sid, item)
+            except Exception as e:
+                logger.exception(e)
+                errors.append(dict(index=index, error=str(e)))
+                continue
+
+            if not msg["success"]:
+                errors.append(dict(index=index, error=msg["error"]))
+
+        if errors:
+            return await self.reply(uid, sid, success=False,
+                                    error="{} of {} items failed".format(len(errors), len(items)), errors=errors)
+        else:
+            return await self.reply(uid, sid, success=True)
+
+    ##################################################################################################################
+    #
+    #   Workers
+    #
+    ##################################################################################################################
+    def _dump_record(self, record):
+        # The fields of the local record the other workers need to route the messages to it
+        group = self.registry.get_group(record.path) if record.path is not None else None
+        return {
+            "sid": record.sid,
+            "path": record.path,
+            "strategy": group.strategy if group is not None else None,
+            "weight": group.weights.get(record.sid, 1) if group is not None else 1,
+            "codecs": record.codecs,
+            "outbound_policy": record.outbound_policy,
+            "conflate": record.conflate,
+            "rooms": list(record.rooms or ())
+        }
+
+    def _add_remote_record(self, worker, info):
+        sid = info["sid"]
+        record = self.registry.get(sid)
+        if record is None:
+            record = self.registry.connect(sid, None, worker)
+
+        if info["path"] is not None:
+            self.registry.register(sid, info["path"], info["strategy"], info["weight"])
+
+        record.codecs = frozenset(info["codecs"])
+        record.outbound_policy = info["outbound_policy"]
+        record.conflate = info["conflate"]
+
+        for room in info["rooms"]:
+            self.registry.join(sid, room)
+
+    def _sync(self, message):
+        # The other workers keep the records of the clients of this worker
+        if self.bus is not None:
+            self.bus.broadcast(message)
+
+    async def _forward_rpc_response(self, worker, sid, data):
+        # The worker keeping the route handles the response, its reply reaches the callee by the bus
+        try:
+            return await self.bus.call(worker, {"type": "rpc_response", "sid": sid, "data": data})
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            self.remote_routes.pop(data["payload"].get("id"), None)
+            return await self.reply(data.get("_uid"), sid, success=False,
+                                    error="The worker {} of the request is gone: {}".format(worker, e))
+
+    def _on_bus_connect(self, worker):
+        # The messages before the connection are dropped, the worker receives all the local records instead
+        self.bus.send(worker, {
+            "type": "sync",
+            "records": [self._dump_record(record) for record in self.registry.records.values()
+                        if record.worker is None]
+        })
+
+    async def _on_bus_disconnect(self, worker):
+        logger.error("Worker {} is gone, remove its clients".format(worker))
+
+        for request_id in [request_id for request_id, owner in self.remote_routes.items() if owner == worker]:
+            del self.remote_routes[request_id]
+
+        for sid in [sid for sid, record in self.registry.records.items() if record.worker == worker]:
+            self.registry.disconnect(sid)
+            await self._fail_sid_routes(sid)
+
+    async def _on_bus_message(self, message):
+        type_ = message["type"]
+        worker = message["worker"]
+
+        if type_ == "send":
+            return await self.send(message["event"], message["data"], message["sids"],
+                                   sender_sid=message["sender_sid"], conflation_key=message["conflation_key"],
+                                   priority=message["priority"])
+        elif type_ == "rpc_response":
+            return await self.rpc_response(message["sid"], message["data"])
+        elif type_ == "route":
+            self.remote_routes[message["id"]] = worker
+        elif type_ == "unroute":
+            self.remote_routes.pop(message["id"], None)
+        elif type_ == "sync":
+            # The worker sends all its clients when it connects, the ones it doesn't have any more are gone
+            sids = {info["sid"] for info in message["records"]}
+            for sid in [sid for sid, record in self.registry.records.items()
+                        if record.worker == worker and sid not in sids]:
+                self.registry.disconnect(sid)
+                await self._fail_sid_routes(sid)
+
+            for info in message["records"]:
+                self._add_remote_record(worker, info)
+        elif type_ == "register":
+            self._add_remote_record(worker, message)
+        elif type_ == "unregister":
+            path = self.registry.unregister(message["sid"])
+            if path is not None and self.registry.get_group(path) is None:
+                self.path_limiter.remove(path)
+        elif type_ == "join":
+            # The client can subscribe without the register
+            if message["sid"] not in self.registry:
+                self.registry.connect(message["sid"], None, worker)
+            self.registry.join(message["sid"], message["room"])
+
+            # The snapshot is taken with the join, the messages published later are sent to the sid
+            if message.get("snapshot"):
+                return self.history.snapshot(message["room"])
+        elif type_ == "leave":
+            self.registry.leave(message["sid"], message["room"])
+        elif type_ == "disconnect":
+            self.registry.disconnect(message["sid"])
+            await self._fail_sid_routes(message["sid"])
+        else:
+            logger.error("Unknown bus message {}".format(type_))
+
+    async def _start_bus(self, app):
+        await self.bus.start()
+
+    async def _stop_bus(self, app):
+        await self.bus.stop()
+
+    def _start_workers(self, handle_signals):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("The workers need SO_REUSEPORT which is not supported by the platform")
+
+        # The sockets of the bus are in the private folder of the server
+        folder = tempfile.mkdtemp(prefix="chatroom-")
+        paths = [os.path.join(folder, "worker-{}.sock".format(index)) for index in range(self.workers)]
+
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=self._run_worker, args=(index, paths, handle_signals), daemon=True)
+                     for index in range(self.workers)]
+
+        # The workers are stopped with the server, SIGTERM exits by the cleanup below
+        if handle_signals:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            for process in processes:
+                process.start()
+
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def _run_worker(self, index, paths, handle_signals):
+        self.worker = index
+        self.bus = Bus(index, paths, self._on_bus_message, on_connect=self._on_bus_connect,
+                       on_disconnect=self._on_bus_disconnect, timeout=self.rpc_timeout)
+        self.app.on_startup.append(self._start_bus)
+        self.app.on_cleanup.append(self._stop_bus)
+
+        # The kernel balances the new connections between the workers listening on the same port
+        sock = socket.socket(socket.AF_INET6 if ":" in self.address else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.address, self.port))
+
+        logger.info("Start worker {} at {}:{}".format(index, self.address, self.port))
+        web.run_app(self.app, sock=sock, handle_signals=handle_signals)
 
     def start(self, handle_signals=True):
+        if self.workers > 1:
+            return self._start_workers(handle_signals)
+
         web.run_app(self.app, host=self.address, port=self.port, handle_signals=handle_signals)
 
     def stop(self):
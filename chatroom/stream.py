@@ -0,0 +1,149 @@
+import asyncio
+import queue
+
+# The kinds of the items in the queue of the stream
+CHUNK = 0
+END = 1
+ERROR = 2
+
+
+class StreamSink:
+    """
+    The receiving side of the stream kept by the pending requests. Only the caller keeps the stream itself, so the
+    stream dropped by the caller is garbage collected and cancelled.
+    """
+    def __init__(self, id, queue):
+        self.id = id
+        self.queue = queue
+
+    def put(self, chunk):
+        self.queue.put_nowait((CHUNK, chunk))
+
+    def finish(self):
+        self.queue.put_nowait((END, None))
+
+    def set_error(self, error):
+        self.queue.put_nowait((ERROR, error))
+
+
+class RPCStream:
+    """
+    The chunks of the streaming RPC response. The caller iterates the stream and the callee only sends the chunks
+    allowed by the credits, the consumed chunks are returned as the credits when half of the window is consumed.
+    The stream closed or dropped before the end cancels the request.
+    """
+    def __init__(self, id, window, send_credit, cancel=None):
+        self.id = id
+        self.window = window
+        self.send_credit = send_credit
+        self.cancel = cancel
+
+        self.queue = queue.Queue()
+        self.sink = StreamSink(id, self.queue)
+        self.consumed = 0
+        self.done = False
+
+    def put(self, chunk):
+        self.sink.put(chunk)
+
+    def finish(self):
+        self.sink.finish()
+
+    def set_error(self, error):
+        self.sink.set_error(error)
+
+    def close(self):
+        if self.done:
+            return
+
+        self.done = True
+        if self.cancel is not None:
+            self.cancel(self.id)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+
+        kind, value = self.queue.get()
+        if kind != CHUNK:
+            self.done = True
+            if kind == ERROR:
+                raise value
+            raise StopIteration
+
+        self.consumed += 1
+        if self.consumed >= max(1, self.window // 2):
+            self.send_credit(self.id, self.consumed)
+            self.consumed = 0
+
+        return value
+
+
+class AsyncRPCStream(RPCStream):
+    """
+    The stream of the AsyncClient, the chunks are put in the event loop thread. cancel(id) is a coroutine function,
+    the stream dropped without aclose() schedules it in the event loop.
+    """
+    def __init__(self, id, window, send_credit, cancel=None, loop=None):
+        super().__init__(id, window, send_credit, cancel)
+        self.queue = asyncio.Queue()
+        self.sink = StreamSink(id, self.queue)
+        self.loop = loop
+
+    async def aclose(self):
+        if self.done:
+            return
+
+        self.done = True
+        if self.cancel is not None:
+            await self.cancel(self.id)
+
+    def close(self):
+        if self.done:
+            return
+
+        self.done = True
+        if self.cancel is not None and self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(asyncio.ensure_future, self.cancel(self.id))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.done:
+            raise StopAsyncIteration
+
+        kind, value = await self.queue.get()
+        if kind != CHUNK:
+            self.done = True
+            if kind == ERROR:
+                raise value
+            raise StopAsyncIteration
+
+        self.consumed += 1
+        if self.consumed >= max(1, self.window // 2):
+            await self.send_credit(self.id, self.consumed)
+            self.consumed = 0
+
+        return value
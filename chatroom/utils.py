@@ -5,6 +5,16 @@ TYPE = "_http._tcp.local."
 FULL_NAME_FORMAT = "{}._http._tcp.local."
 
 
+# The serializers of the Socket.IO packets, every serializer has its own Socket.IO endpoint
+JSON_SERIALIZER = "json"
+MSGPACK_SERIALIZER = "msgpack"
+
+SOCKETIO_PATHS = {
+    JSON_SERIALIZER: "socket.io",
+    MSGPACK_SERIALIZER: "socket.io-msgpack"
+}
+
+
 def get_full_name(name):
     if not name.startswith("_"):
         name = "_{}".format(name)
@@ -16,43 +26,156 @@ def get_resp_event_name(req_event_name):
     return "{}-magic_keyword".format(req_event_name)
 
 
+class PathTrie:
+    """
+    The index of the dotted path patterns, "*" matches exactly one level and "#" matches zero or more levels.
+    e.g. "sensors.*" matches "sensors.a" and "sensors.#" matches "sensors", "sensors.a" and "sensors.a.b"
+    """
+    SEPARATOR = "."
+    SINGLE_LEVEL = "*"
+    MULTI_LEVEL = "#"
+
+    class Node:
+        def __init__(self):
+            self.children = {}
+            self.values = set()
+
+    def __init__(self):
+        self.root = PathTrie.Node()
+
+    @classmethod
+    def is_pattern(cls, path):
+        levels = path.split(cls.SEPARATOR)
+        return cls.SINGLE_LEVEL in levels or cls.MULTI_LEVEL in levels
+
+    def add(self, pattern, value):
+        node = self.root
+        for level in pattern.split(self.SEPARATOR):
+            node = node.children.setdefault(level, PathTrie.Node())
+
+        node.values.add(value)
+
+    def remove(self, pattern, value):
+        nodes = [self.root]
+        levels = pattern.split(self.SEPARATOR)
+        for level in levels:
+            node = nodes[-1].children.get(level)
+            if node is None:
+                return
+            nodes.append(node)
+
+        nodes[-1].values.discard(value)
+
+        # Prune the empty nodes from the leaf
+        for index in range(len(levels), 0, -1):
+            node = nodes[index]
+            if node.values or node.children:
+                break
+            del nodes[index - 1].children[levels[index - 1]]
+
+    def match(self, path):
+        result = set()
+        self._match(self.root, path.split(self.SEPARATOR), 0, result)
+        return result
+
+    def _match(self, node, levels, index, result):
+        multi = node.children.get(self.MULTI_LEVEL)
+        if multi is not None:
+            # "#" consumes zero or more levels
+            for next_index in range(index, len(levels) + 1):
+                self._match(multi, levels, next_index, result)
+
+        if index == len(levels):
+            result.update(node.values)
+            return
+
+        child = node.children.get(levels[index])
+        if child is not None:
+            self._match(child, levels, index + 1, result)
+
+        single = node.children.get(self.SINGLE_LEVEL)
+        if single is not None:
+            self._match(single, levels, index + 1, result)
+
+
 class Event(threading.Event):
     def __init__(self):
         self._msg = None
+        self._error = None
         super().__init__()
 
     def set_msg(self, msg):
         self._msg = msg
         return super().set()
 
+    def set_error(self, error):
+        self._error = error
+        return super().set()
+
     def clear(self):
         self._msg = None
+        self._error = None
         return super().clear()
 
     def wait(self, timeout=None):
-        super().wait(timeout=timeout)
+        if not super().wait(timeout=timeout):
+            raise TimeoutError("Waiting the event is timeout")
+
+        if self._error is not None:
+            raise self._error
+
         return self._msg
 
 class AsyncEvent(asyncio.Event):
-    def __init__(self, loop=None):
+    def __init__(self, loop=None, threadsafe=True):
         self._msg = None
-        super().__init__(loop=loop)
+        self._error = None
+        self._threadsafe = threadsafe
+
+        # asyncio.Event doesn't take the loop since Python 3.10 and binds it by the first wait(), the event set from
+        # another thread before that wakes up the loop kept here
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        super().__init__()
 
     def set(self):
-        #FIXME: The _loop attribute is not documented as public api!
-        self._loop.call_soon_threadsafe(super().set)
+        # The event set in the event loop thread doesn't need to wake up the loop
+        if not self._threadsafe:
+            return super().set()
+
+        self.loop.call_soon_threadsafe(super().set)
 
     def set_msg(self, msg):
         self._msg = msg
         return self.set()
 
+    def set_error(self, error):
+        self._error = error
+        return self.set()
+
     def clear(self):
         self._msg = None
+        self._error = None
         return super().clear()
 
     async def wait(self, timeout=None):
-        await super().wait()
+        try:
+            await asyncio.wait_for(super().wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Waiting the event is timeout")
+
+        if self._error is not None:
+            raise self._error
+
         return self._msg
 
 class EmitError(RuntimeError):
     pass
+
+class RPCError(RuntimeError):
+    pass
+
+class RPCCancelledError(RPCError):
+    pass
+
+class PendingLimitError(RuntimeError):
+    pass
@@ -33,8 +33,34 @@ class Service:
 
         if info.properties:
             self.version = info.properties.get("version")
+            self.serializers = self._get_serializers(info.properties)
+            self.transports = self._get_transports(info.properties)
         else:
             self.version = None
+            self.serializers = [utils.JSON_SERIALIZER]
+            self.transports = None
+
+    def _get_serializers(self, properties):
+        # The old servers don't advertise the serializers, they only support JSON
+        serializers = properties.get("serializers", properties.get(b"serializers"))
+        if serializers is None:
+            return [utils.JSON_SERIALIZER]
+
+        if isinstance(serializers, bytes):
+            serializers = serializers.decode()
+
+        return serializers.split(",")
+
+    def _get_transports(self, properties):
+        # The server with many workers only accepts the websocket, None means all the transports
+        transports = properties.get("transports", properties.get(b"transports"))
+        if transports is None:
+            return None
+
+        if isinstance(transports, bytes):
+            transports = transports.decode()
+
+        return transports.split(",")
 
     def __str__(self):
         return "[{}] {}:{} {}".format(self.state, self.address, self.port, self.name)
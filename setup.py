@@ -33,13 +33,20 @@ setup(
     license='MIT',
     packages=['chatroom'],
     install_requires=[
-        "python-socketio",
+        "python-socketio>=5.7,<6",
+        "python-engineio>=4.3,<5",
         "aiohttp",
-        "socketIO-client",
+        "requests",
+        "websocket-client",
         "retrying",
         "logzero",
         "zeroconf"
     ],
+    extras_require={
+        "msgpack": ["msgpack"],
+        "zstd": ["zstandard"],
+        "numpy": ["numpy"]
+    },
     include_package_data=True,
     classifiers=classifiers,
     cmdclass=versioneer.get_cmdclass(),
@@ -0,0 +1,68 @@
+from chatroom.client import Client
+from chatroom.async_client import AsyncClient
+import pytest
+
+from threading import Event
+
+# Run with "pytest test/test_bench.py --benchmark-autosave" to save the baseline and
+# "--benchmark-compare" to compare with it
+pytest.importorskip("pytest_benchmark")
+
+
+def test_bench_echo(benchmark, server_name, server):
+    client = Client("testing.bench.echo", server_name=server_name)
+    client.connect()
+
+    benchmark(client.echo, "Hello World!")
+
+
+def test_bench_async_echo(benchmark, server_name, server, event_loop):
+    client = AsyncClient("testing.bench.async.echo", server_name=server_name, event_loop=event_loop)
+    event_loop.run_until_complete(client.connect())
+
+    benchmark(lambda: event_loop.run_until_complete(client.echo("Hello World!")))
+
+
+def test_bench_rpc(benchmark, server_name, server):
+    client = Client("testing.bench.rpc", server_name=server_name)
+    client.connect()
+    client.register_rpc_api("echo", lambda message: message)
+
+    def rpc():
+        return client.send_rpc_request("testing.bench.rpc", "echo", {"message": "Hello World!"}).wait()
+
+    assert benchmark(rpc) == "Hello World!"
+
+
+def test_bench_async_rpc(benchmark, server_name, server, event_loop):
+    client = AsyncClient("testing.bench.async.rpc", server_name=server_name, event_loop=event_loop)
+    event_loop.run_until_complete(client.connect())
+
+    async def echo(message):
+        return message
+
+    client.register_rpc_api("echo", echo)
+
+    async def rpc():
+        event = await client.send_rpc_request("testing.bench.async.rpc", "echo", {"message": "Hello World!"})
+        return await event.wait()
+
+    assert benchmark(lambda: event_loop.run_until_complete(rpc())) == "Hello World!"
+
+
+def test_bench_publish(benchmark, server_name, server):
+    publisher = Client("testing.bench.publisher", server_name=server_name)
+    publisher.connect()
+
+    subscriber = Client("testing.bench.subscriber", server_name=server_name)
+    subscriber.connect()
+
+    event = Event()
+    subscriber.subscribe("testing.bench.publisher", lambda data: event.set())
+
+    def publish():
+        event.clear()
+        publisher.publish({"message": "Hello World!"})
+        event.wait()
+
+    benchmark(publish)
@@ -0,0 +1,109 @@
+import asyncio
+import os
+
+import pytest
+
+from chatroom.bus import Bus
+
+
+async def _start_buses(folder, handlers):
+    paths = [os.path.join(folder, "worker-{}.sock".format(index)) for index in range(len(handlers))]
+    connected = asyncio.Queue()
+    disconnected = []
+
+    async def on_disconnect(peer):
+        disconnected.append(peer)
+
+    buses = [Bus(index, paths, handler, on_connect=connected.put_nowait, on_disconnect=on_disconnect, timeout=1)
+             for index, handler in enumerate(handlers)]
+    for bus in buses:
+        await bus.start()
+
+    # Every worker connects to every other one
+    for _ in range(len(buses) * (len(buses) - 1)):
+        await asyncio.wait_for(connected.get(), 5)
+
+    return buses, connected, disconnected
+
+
+def test_bus_send_and_call(tmp_path):
+    async def main():
+        received = []
+
+        async def handler(message):
+            received.append(message)
+            if message["type"] == "add":
+                return message["a"] + message["b"]
+
+        async def other_handler(message):
+            return message["type"]
+
+        buses, _, disconnected = await _start_buses(str(tmp_path), [handler, other_handler])
+        first, second = buses
+
+        # The messages to a worker are received in order with the index of the sender
+        for index in range(10):
+            assert second.send(0, {"type": "send", "index": index, "data": b"\x00"})
+        assert await second.call(0, {"type": "add", "a": 1, "b": 2}) == 3
+        assert [message["index"] for message in received[:10]] == list(range(10))
+        assert {message["worker"] for message in received} == {1}
+
+        assert await first.call(1, {"type": "echo"}) == "echo"
+
+        # The gone worker is reported to the others, its messages are dropped
+        await second.stop()
+        await asyncio.sleep(0.2)
+        assert disconnected == [1]
+        assert not first.send(1, {"type": "send"})
+
+        await first.stop()
+
+    asyncio.run(main())
+
+
+def test_bus_call_not_connected(tmp_path):
+    async def main():
+        async def handler(message):
+            return None
+
+        bus = Bus(0, [str(tmp_path / "worker-0.sock"), str(tmp_path / "worker-1.sock")], handler, timeout=1)
+        await bus.start()
+
+        try:
+            with pytest.raises(ConnectionError):
+                await bus.call(1, {"type": "snapshot"})
+        finally:
+            await bus.stop()
+
+    asyncio.run(main())
+
+
+def test_bus_reset_stuck_worker(tmp_path):
+    async def main():
+        received = []
+
+        async def handler(message):
+            received.append(message)
+
+        buses, connected, disconnected = await _start_buses(str(tmp_path), [handler, handler])
+        first, second = buses
+
+        # The connection to the worker over the buffer cap is reset, the worker reconnects and syncs the state
+        assert second.send(0, {"type": "send", "index": 0})
+        await asyncio.sleep(0.1)
+
+        second.max_buffer = -1
+        assert not second.send(0, {"type": "send", "index": 1})
+        assert await asyncio.wait_for(connected.get(), 5) == 0
+        await asyncio.sleep(0.1)
+        assert disconnected == [1]
+
+        second.max_buffer = 1024
+        assert second.send(0, {"type": "send", "index": 2})
+        await asyncio.sleep(0.1)
+        assert [message["index"] for message in received] == [0, 2]
+
+        await second.stop()
+        await first.stop()
+
+    asyncio.run(main())
@@ -1,15 +1,33 @@
-from chatroom.client import Client
+from chatroom.client import Client, OrderedEngineIOClient
 from chatroom.async_client import AsyncClient
+from chatroom.utils import RPCCancelledError
 import logging
 import pytest
 import asyncio
 import time
 
-from threading import Event
+from threading import Event, get_ident
 
 filter = logging.Filter('chatroom')
 
 
+# The RPC API runs in the process pool must be picklable
+def square(value):
+    return value * value
+
+
+def test_ordered_messages():
+    # The messages are handled by the reading thread in order instead of a new thread for every message
+    client = OrderedEngineIOClient()
+    handled = []
+    client.on("message", lambda data: handled.append((data, get_ident())))
+
+    for index in range(10):
+        client._trigger_event("message", index, run_async=True)
+
+    assert handled == [(index, get_ident()) for index in range(10)]
+
+
 def test_client_connect(server_name, server):
     client = Client("testing-turing-client", server_name=server_name)
     client.connect()
@@ -119,3 +137,209 @@ def test_publish(server_name, server):
     assert len(result) == 10
 
 
+def test_batch_publish(server_name, server):
+    publisher = Client("testing.batch.publisher", server_name=server_name)
+    publisher.connect()
+
+    subscriber = Client("testing.batch.subscriber", server_name=server_name)
+    subscriber.connect()
+
+    event = Event()
+    result = []
+    def subscribe_cb(data):
+        result.append(data)
+        if len(result) == 10:
+            event.set()
+
+    subscriber.subscribe("testing.batch.publisher", subscribe_cb)
+
+    publisher.emit_many([
+        ("publish", {"payload": {"message": "Hello world! {}".format(index)}})
+        for index in range(0, 10)
+    ])
+
+    event.wait(timeout=10)
+    assert [data["message"] for data in result] == ["Hello world! {}".format(index) for index in range(0, 10)]
+
+
+def test_wildcard_subscribe(server_name, server):
+    publisher = Client("testing.wildcard.sensors.temperature", server_name=server_name)
+    publisher.connect()
+
+    subscriber = Client("testing.wildcard.subscriber", server_name=server_name)
+    subscriber.connect()
+
+    event = Event()
+    result = []
+    def subscribe_cb(data):
+        result.append(data)
+        event.set()
+
+    subscriber.subscribe("testing.wildcard.sensors.*", subscribe_cb)
+
+    publisher.publish({
+        "message": "Hello world!"
+    })
+
+    event.wait(timeout=10)
+    assert result == [{"message": "Hello world!"}]
+
+
+def test_async_rpc_coroutine_handler(server_name, server, event_loop):
+    async def run_test_async_rpc_coroutine_handler_in_loop(loop):
+        target_client = AsyncClient("testing.rpc.coroutine.target", server_name=server_name, event_loop=loop)
+        await target_client.connect()
+
+        async def slow_echo(message):
+            await asyncio.sleep(0.5)
+            return message
+
+        target_client.register_rpc_api("slow_echo", slow_echo)
+
+        client = AsyncClient("testing.rpc.coroutine.client", server_name=server_name, event_loop=loop)
+        await client.connect()
+
+        # The requests are handled concurrently, they don't wait for each other
+        start = time.time()
+        events = []
+        for index in range(0, 10):
+            events.append(await client.send_rpc_request(
+                target="testing.rpc.coroutine.target",
+                method="slow_echo",
+                parameters={
+                    "message": "Hello World!{}".format(index)
+                }))
+
+        for index, event in enumerate(events):
+            assert await event.wait() == "Hello World!{}".format(index)
+
+        # Ten 0.5s handlers take 5s in a row
+        assert time.time() - start < 2
+        return True
+
+    result = event_loop.run_until_complete(run_test_async_rpc_coroutine_handler_in_loop(event_loop))
+    assert result is True
+
+
+def test_process_rpc(server_name, server):
+    client = Client("testing.rpc.process", server_name=server_name, max_processes=2)
+    client.connect()
+
+    client.register_rpc_api("square", square, executor="process")
+
+    events = [
+        client.send_rpc_request(target="testing.rpc.process", method="square", parameters={"value": index})
+        for index in range(0, 10)
+    ]
+
+    assert [event.wait() for event in events] == [index * index for index in range(0, 10)]
+
+
+def test_service_group_rpc(server_name, server):
+    client = Client("testing.service.client", server_name=server_name)
+    client.connect()
+
+    workers = []
+    for index in range(0, 2):
+        worker = Client("testing.service.worker", server_name=server_name)
+        worker.connect()
+        worker.register_rpc_api("whoami", lambda index=index: index)
+        workers.append(worker)
+
+    events = [
+        client.send_rpc_request(target="testing.service.worker", method="whoami", parameters={})
+        for _ in range(0, 4)
+    ]
+
+    # The requests are sent to the workers by round robin
+    assert sorted(event.wait() for event in events) == [0, 0, 1, 1]
+
+
+def test_binary_rpc(server_name, server):
+    client = Client("testing.rpc.binary", server_name=server_name, serializer="json")
+    client.connect()
+
+    client.register_rpc_api("echo", lambda message: message)
+
+    # The bytes and memoryview are sent as the binary attachments, the receiver gets the bytes
+    frame = bytes(range(256)) * 16
+    event = client.send_rpc_request(target="testing.rpc.binary", method="echo",
+                                    parameters={"message": memoryview(frame)[16:1024]})
+
+    assert event.wait() == frame[16:1024]
+
+
+def test_stream_rpc(server_name, server):
+    client = Client("testing.rpc.stream", server_name=server_name, rpc_stream_window=2)
+    client.connect()
+
+    def count(number):
+        for index in range(number):
+            yield index
+
+    client.register_rpc_api("count", count)
+
+    stream = client.send_rpc_request(target="testing.rpc.stream", method="count", parameters={"number": 10},
+                                     stream=True)
+    assert list(stream) == list(range(10))
+
+    # The caller which doesn't stream receives the list
+    event = client.send_rpc_request(target="testing.rpc.stream", method="count", parameters={"number": 3})
+    assert event.wait() == [0, 1, 2]
+
+
+def test_fragmented_rpc(server_name, server):
+    client = Client("testing.rpc.fragment", server_name=server_name, fragment_size=1024)
+    client.connect()
+
+    client.register_rpc_api("echo", lambda message: message)
+
+    # The request and the response are sent as the fragments of 1KB
+    message = {"values": list(range(10000))}
+    event = client.send_rpc_request(target="testing.rpc.fragment", method="echo", parameters={"message": message})
+
+    assert event.wait() == message
+
+
+def test_cancel_rpc(server_name, server):
+    client = Client("testing.rpc.cancel", server_name=server_name)
+    client.connect()
+
+    started = Event()
+    stopped = Event()
+
+    def work():
+        started.set()
+        deadline = time.time() + 5
+        while not client.is_rpc_cancelled() and time.time() < deadline:
+            time.sleep(0.01)
+        if client.is_rpc_cancelled():
+            stopped.set()
+
+    client.register_rpc_api("work", work)
+
+    event = client.send_rpc_request(target="testing.rpc.cancel", method="work", parameters={})
+    assert started.wait(timeout=5)
+    assert client.cancel_rpc_request(event)
+
+    with pytest.raises(RPCCancelledError):
+        event.wait()
+
+    # The cancel is forwarded to the callee by the server
+    assert stopped.wait(timeout=5)
+
+
+def test_cancel_rpc_before_start(server_name, server):
+    client = Client("testing.rpc.cancel.early", server_name=server_name)
+    client.connect()
+
+    # The cancel which arrives before the handler starts skips the handler
+    client.rpc_cancelled["request"] = time.monotonic() + 5
+    called = []
+    client.register_rpc_api("work", lambda: called.append(True))
+    client._handle_rpc_request({"path": "testing.rpc.cancel.early",
+                                "payload": {"id": "request", "method": "work", "parameters": {}}})
+
+    assert called == []
+    assert "request" not in client.rpc_cancelled
+    assert "request" not in client.rpc_cancel_events
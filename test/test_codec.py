@@ -0,0 +1,107 @@
+import pytest
+
+from chatroom.codec import Codec, CodecError, MARKER, ZLIB, ZSTD, get_payload_codecs, train_dictionary
+from chatroom.codec import ARRAYS_MARKER
+
+
+def test_codec_threshold():
+    codec = Codec(ZLIB, threshold=100)
+    codec.negotiate([ZLIB])
+
+    assert codec.compress({"message": "small"}) == {"message": "small"}
+    assert codec.compress(b"binary" * 100) == b"binary" * 100
+
+    value = {"message": "large" * 100}
+    compressed = codec.compress(value)
+    assert compressed[MARKER] == ZLIB
+    assert codec.decompress(compressed) == value
+
+
+def test_codec_negotiate():
+    codec = Codec([ZSTD, ZLIB])
+
+    assert codec.negotiate([ZLIB]) == ZLIB
+    assert codec.negotiate([]) is None
+    assert codec.compress("large" * 1000) == "large" * 1000
+
+    with pytest.raises(CodecError):
+        Codec("brotli")
+
+
+def test_codec_zstd_dictionary():
+    pytest.importorskip("zstandard")
+
+    samples = [{"values": list(range(index, index + 50)), "name": "sensor-{}".format(index)} for index in range(200)]
+    dictionary = train_dictionary(samples, 4096)
+
+    codec = Codec(ZSTD, threshold=0, dictionaries=[dictionary])
+    assert codec.negotiate(Codec(dictionaries=[dictionary]).accepted()).startswith(ZSTD + ":")
+
+    compressed = codec.compress(samples[0])
+    assert get_payload_codecs({"parameters": compressed}) == {codec.compression}
+    assert Codec(dictionaries=[dictionary]).decompress(compressed) == samples[0]
+
+    with pytest.raises(CodecError):
+        Codec().decompress(compressed)
+
+
+def test_codec_ndarray():
+    numpy = pytest.importorskip("numpy")
+
+    codec = Codec(ZLIB, threshold=0)
+    codec.negotiate([ZLIB])
+
+    array = numpy.arange(24, dtype=">i4").reshape(4, 6)[:, ::2]
+    encoded = codec.encode({"array": array, "arrays": [array.T]})
+
+    # The arrays are sent as the raw buffers, the payload isn't compressed
+    assert isinstance(encoded["array"]["data"], memoryview)
+    assert encoded["array"]["shape"] == [4, 3]
+
+    decoded = codec.decode(encoded)
+    assert decoded["array"].dtype == array.dtype
+    assert (decoded["array"] == array).all()
+    assert (decoded["arrays"][0] == array.T).all()
+    assert ARRAYS_MARKER not in decoded
+
+    # The array which isn't in a dict
+    decoded = codec.decode(codec.encode([1, array]))
+    assert decoded[0] == 1 and (decoded[1] == array).all()
+
+
+def test_codec_without_arrays():
+    numpy = pytest.importorskip("numpy")
+
+    # The payloads without any array are sent and received as they are
+    codec = Codec()
+    value = {"values": list(range(1000)), "nested": [{"name": "a"}, ("b", 1)]}
+    assert codec.encode(value) is value
+    assert codec.decode(value) is value
+
+    # Only the containers with the arrays are rebuilt
+    value["array"] = numpy.zeros(3)
+    encoded = codec.encode(value)
+    assert encoded is not value and encoded["values"] is value["values"] and encoded["nested"] is value["nested"]
+
+
+@pytest.mark.parametrize("codec_name", [ZLIB, ZSTD])
+def test_codec_invalid(codec_name):
+    if codec_name == ZSTD:
+        pytest.importorskip("zstandard")
+
+    codec = Codec(codec_name, threshold=0, max_size=1000)
+    codec.negotiate(codec.accepted())
+
+    # The corrupt value and the value over the max size raise CodecError
+    with pytest.raises(CodecError):
+        codec.decompress({MARKER: codec_name, "data": b"corrupt"})
+
+    with pytest.raises(CodecError):
+        codec.decompress({MARKER: codec_name})
+
+    compressed = codec.compress("x" * 2000)
+    with pytest.raises(CodecError):
+        codec.decompress(compressed)
+
+    compressed = codec.compress("x" * 900)
+    assert codec.decompress(compressed) == "x" * 900
@@ -0,0 +1,80 @@
+import pytest
+
+from chatroom.fragment import Reassembler, estimate_size, get_fragment, split
+
+
+def test_estimate_size():
+    assert estimate_size({"message": "small"}, 1024) < 1024
+    assert estimate_size({"values": list(range(100000))}, 1024) > 1024
+
+
+def test_split_and_reassemble():
+    data = {"path": "testing.target", "payload": {"id": "request", "timeout": 5, "parameters": {"message": "x" * 1000}}}
+    frames = list(split(data, 100))
+
+    # The frames keep the routing fields, only the last frame ends the RPC route
+    assert len(frames) > 1
+    assert all(frame["payload"]["id"] == "request" for frame in frames)
+    assert frames[0]["payload"]["timeout"] == 5
+    assert [frame["payload"].get("more", False) for frame in frames] == [True] * (len(frames) - 1) + [False]
+
+    reassembler = Reassembler()
+    for frame in reversed(frames[1:]):
+        assert reassembler.reassemble(frame) is None
+
+    assert reassembler.reassemble(frames[0]) == data
+    assert len(reassembler) == 0
+
+
+def test_split_binary():
+    data = {"payload": {"blob": b"\x00" * 1000}}
+    frames = list(split(data, 300))
+
+    # The binary fragments are the slices of the encoded payload
+    assert isinstance(get_fragment(frames[0])["data"], memoryview)
+
+    reassembler = Reassembler()
+    assert [reassembler.reassemble(frame) for frame in frames][-1] == data
+
+
+def test_reassembler_sweep():
+    reassembler = Reassembler(timeout=0)
+    reassembler.reassemble(next(split({"payload": "x" * 1000}, 100)))
+
+    assert reassembler.sweep() == 1
+    assert len(reassembler) == 0
+
+
+@pytest.mark.parametrize("payload", ["video frame " * 100, list(range(100))])
+def test_split_not_object(payload):
+    data = {"path": "testing.source", "payload": payload}
+    frames = list(split(data, 100))
+
+    reassembler = Reassembler()
+    assert [reassembler.reassemble(frame) for frame in frames][-1] == data
+
+
+@pytest.mark.parametrize("fragment", [
+    {"id": "message", "index": 0, "count": 0, "encoding": "json", "data": "x"},
+    {"id": "message", "index": 0, "count": 10 ** 12, "encoding": "json", "data": "x"},
+    {"id": "message", "index": 2, "count": 2, "encoding": "json", "data": "x"},
+    {"id": "message", "index": -1, "count": 2, "encoding": "json", "data": "x"},
+    {"id": "message", "index": "0", "count": 2, "encoding": "json", "data": "x"},
+    {"id": "message", "index": 0, "count": 2, "encoding": "json", "data": None},
+])
+def test_reassembler_invalid(fragment):
+    reassembler = Reassembler(max_size=1024)
+    with pytest.raises(ValueError):
+        reassembler.add(fragment)
+    assert len(reassembler) == 0
+
+
+def test_reassembler_max_size():
+    reassembler = Reassembler(max_size=1000)
+    frames = list(split({"payload": "x" * 2000}, 300))
+
+    # The message is dropped when its fragments are larger than the limit
+    with pytest.raises(ValueError):
+        for frame in frames:
+            reassembler.reassemble(frame)
+    assert len(reassembler) == 0
@@ -0,0 +1,45 @@
+from chatroom.history import History
+
+
+def test_history_ring():
+    history = History(size=2)
+    for index in range(3):
+        history.add("sensors.a", index, 10)
+    history.add("sensors.b", "b", 10)
+
+    assert history.snapshot("sensors.a") == [1, 2]
+    assert history.snapshot("sensors.*") == [1, 2, "b"]
+    assert history.snapshot("sensors.c") == []
+    assert len(history) == 3 and history.bytes == 30
+
+    # The last value of the topic
+    history.configure("sensors.a", size=1)
+    assert history.snapshot("sensors.a") == [2]
+
+    assert not History().add("sensors.a", 0, 10)
+
+
+def test_history_limits():
+    history = History(size=10, max_bytes=30, total_bytes=50)
+    for index in range(4):
+        history.add("sensors.a", index, 10)
+
+    assert history.snapshot("sensors.a") == [1, 2, 3]
+
+    # The globally oldest messages are dropped by the total bytes
+    history.add("sensors.b", "b0", 10)
+    history.add("sensors.b", "b1", 10)
+    history.add("sensors.b", "b2", 10)
+    assert history.snapshot("#") == [2, 3, "b0", "b1", "b2"]
+    assert history.bytes == 50
+
+    # The message larger than the cap of the topic isn't kept
+    history.add("sensors.c", "c", 40)
+    assert history.snapshot("#") == [2, 3, "b0", "b1", "b2"]
+
+    history.add("sensors.b", "b3", 30)
+    assert history.snapshot("#") == [2, 3, "b3"]
+
+    history.add("sensors.c", "c", 30)
+    assert history.snapshot("#") == ["c"]
+    assert list(history.topics) == ["sensors.c"]
@@ -0,0 +1,43 @@
+import asyncio
+
+from chatroom.metrics import Histogram, Metrics
+
+
+def test_histogram():
+    histogram = Histogram(bounds=(1, 10))
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value)
+
+    assert histogram.dump() == {
+        "count": 4,
+        "sum": 56.5,
+        "buckets": {"<=1": 2, "<=10": 1, ">10": 1}
+    }
+
+
+def test_metrics_instrument():
+    metrics = Metrics()
+
+    async def handler(sid, data):
+        return data
+
+    instrumented = metrics.instrument("echo", handler)
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(instrumented("sid", "data")) == "data"
+    finally:
+        loop.close()
+
+    assert metrics.dump()["events"] == {"echo": 1}
+    assert metrics.dump()["latency_ms"]["echo"]["count"] == 1
+
+
+def test_metrics_bytes():
+    metrics = Metrics()
+    metrics.count_in("4hello")
+    metrics.count_out("4你好")
+    metrics.count_out(b"\x00\x01")
+    metrics.count_out(None)
+
+    assert metrics.bytes_in == 6
+    assert metrics.bytes_out == 7 + 2
@@ -0,0 +1,99 @@
+import pytest
+
+from chatroom.outbox import Outbox, DROP_OLDEST, DROP_NEWEST, DISCONNECT, PAUSE_PUBLISHER
+from chatroom.outbox import CONTROL, RPC, BULK, get_lane
+
+
+def test_outbox_drop_oldest():
+    outbox = Outbox(max_bytes=100, max_messages=3, policy=DROP_OLDEST)
+    for index in range(3):
+        assert outbox.put(index, 10) == 0
+
+    assert outbox.put(3, 10) == 1
+    assert outbox.congested
+    assert [outbox.get() for _ in range(len(outbox))] == [1, 2, 3]
+
+    # The message larger than the byte cap is dropped without dropping the queued messages
+    outbox.put(4, 10)
+    assert outbox.put(5, 1000) == 1
+    assert len(outbox) == 1 and outbox.bytes == 10
+    assert outbox.dropped == 2
+
+
+@pytest.mark.parametrize("policy", [DROP_NEWEST, PAUSE_PUBLISHER])
+def test_outbox_drop_newest(policy):
+    outbox = Outbox(max_bytes=20, max_messages=10, policy=policy)
+    outbox.put(0, 10)
+    outbox.put(1, 10)
+
+    assert outbox.put(2, 10) == 1
+    assert outbox.congested
+    assert not outbox.is_drained()
+
+    assert outbox.get() == 0
+    assert outbox.is_drained()
+
+
+def test_outbox_disconnect():
+    outbox = Outbox(max_bytes=20, max_messages=1, policy=DISCONNECT)
+    outbox.put(0, 10)
+
+    assert outbox.put(1, 10) is None
+
+    with pytest.raises(ValueError):
+        Outbox(20, 1, policy="block")
+
+
+def test_outbox_conflate():
+    outbox = Outbox(max_bytes=100, max_messages=10)
+    outbox.put("a0", 10, key="a")
+    outbox.put("b0", 10, key="b")
+    outbox.put("x", 10)
+
+    assert outbox.put("a1", 20, key="a") == 0
+    assert len(outbox) == 3 and outbox.bytes == 40 and outbox.conflated == 1
+
+    assert outbox.get() == "a1"
+    outbox.put("a2", 10, key="a")
+    assert [outbox.get() for _ in range(len(outbox))] == ["b0", "x", "a2"]
+    assert outbox.keys == {} and outbox.bytes == 0
+
+
+def test_outbox_conflate_cap():
+    outbox = Outbox(max_bytes=100, max_messages=10)
+    outbox.put("a0", 10, key="a")
+    outbox.put("x", 60)
+
+    # The larger replacement goes through the cap, the stale message is removed and the oldest dropped
+    assert outbox.put("a1", 50, key="a") == 1
+    assert outbox.bytes == 50 and outbox.bytes <= outbox.max_bytes
+    assert [outbox.get() for _ in range(len(outbox))] == ["a1"]
+    assert outbox.keys == {}
+
+
+def test_outbox_lanes():
+    outbox = Outbox(max_bytes=1000, max_messages=10)
+    for index in range(4):
+        outbox.put(("bulk", index), 10, lane=BULK)
+    for index in range(2):
+        outbox.put(("rpc", index), 10, lane=RPC)
+
+    # The RPC lane takes 4 of every 5 messages while both lanes are waiting
+    assert [outbox.get() for _ in range(len(outbox))] == [
+        ("rpc", 0), ("rpc", 1), ("bulk", 0), ("bulk", 1), ("bulk", 2), ("bulk", 3)
+    ]
+
+    assert get_lane("rpc_response") == RPC
+    assert get_lane("backpressure") == CONTROL
+    assert get_lane("publish", BULK) == BULK
+
+
+def test_outbox_drop_lower_lanes():
+    outbox = Outbox(max_bytes=1000, max_messages=2)
+    outbox.put("rpc", 10, lane=RPC)
+    outbox.put("bulk", 10, lane=BULK)
+
+    # The bulk message makes room for the control message, but not for another bulk message
+    assert outbox.put("control", 10, lane=CONTROL) == 1
+    assert outbox.put("bulk", 10, lane=BULK) == 1
+    assert [outbox.get() for _ in range(len(outbox))] == ["control", "rpc"]
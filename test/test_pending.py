@@ -0,0 +1,65 @@
+import pytest
+
+from chatroom.pending import Deadlines, PendingRequests
+from chatroom.utils import Event, PendingLimitError
+
+
+def test_pending_requests_pop():
+    pending = PendingRequests(timeout=60)
+    event = Event()
+    pending.add("request", event)
+
+    assert pending.pop("request") is event
+    assert pending.pop("request") is None
+    assert len(pending) == 0
+
+
+def test_pending_requests_sweep():
+    pending = PendingRequests(timeout=0)
+    event = Event()
+    pending.add("request", event)
+
+    assert pending.sweep() == 1
+    assert len(pending) == 0
+
+    with pytest.raises(TimeoutError):
+        event.wait(timeout=1)
+
+
+def test_pending_requests_limit():
+    pending = PendingRequests(max_size=1, timeout=60)
+    pending.add("first", Event())
+
+    with pytest.raises(PendingLimitError):
+        pending.add("second", Event())
+
+
+def test_pending_requests_touch():
+    pending = PendingRequests(timeout=60)
+    event = Event()
+    pending.add("request", event, timeout=0)
+
+    # The deadline restarts by the timeout of the request
+    assert pending.touch("request") is event
+    assert pending.touch("missing") is None
+    assert pending.sweep() == 1
+
+
+def test_deadlines_expire():
+    deadlines = Deadlines()
+    entries = {}
+    for id in range(200):
+        entries[id] = id
+        deadlines.push(id, id)
+
+    # The touched entry has a new deadline, its old one is stale
+    entries[0] = 1000
+    deadlines.push(1000, 0)
+
+    assert deadlines.expire(2, entries, lambda deadline: deadline) == [1, 2]
+
+    # The responded entries are dropped by the rebuild when the heap is mostly garbage
+    for id in range(1, 190):
+        del entries[id]
+    assert deadlines.expire(2, entries, lambda deadline: deadline) == []
+    assert len(deadlines) == len(entries)
@@ -0,0 +1,35 @@
+import pytest
+
+from chatroom.ratelimit import TokenBucket, RateLimiter
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2, now=0)
+
+    assert bucket.consume(0)
+    assert bucket.consume(0)
+    assert not bucket.consume(0)
+    assert bucket.retry_after() == pytest.approx(0.1)
+
+    # One token refills in 0.1 second, the tokens never exceed the burst
+    assert bucket.consume(0.1)
+    assert not bucket.consume(0.1)
+    assert bucket.consume(10)
+    assert bucket.consume(10)
+    assert not bucket.consume(10)
+
+
+def test_rate_limiter():
+    limiter = RateLimiter({"publish": 5, "rpc_request": (1, 3)})
+    assert "publish" in limiter and "echo" not in limiter
+
+    assert limiter.get_bucket("a", "publish", 0).burst == 5
+    assert limiter.get_bucket("a", "rpc_request", 0).burst == 3
+    assert limiter.get_bucket("a", "publish", 0) is limiter.get_bucket("a", "publish", 1)
+    assert limiter.get_bucket("a", "publish", 0) is not limiter.get_bucket("b", "publish", 0)
+
+    limiter.remove("a")
+    assert list(limiter.buckets) == ["b"]
+
+    with pytest.raises(ValueError):
+        RateLimiter({"publish": 0})
@@ -0,0 +1,55 @@
+import pytest
+
+from chatroom.registry import Registry
+
+
+def test_registry_register():
+    registry = Registry()
+    registry.connect("a", None)
+    registry.connect("b", None)
+
+    registry.register("a", "testing.service")
+    registry.register("b", "testing.service")
+    assert registry.registered == 2
+    assert registry.get_group("testing.service").sids == ["a", "b"]
+
+    # The client registered again moves to the new path
+    registry.register("b", "testing.other")
+    assert registry.get_path("b") == "testing.other"
+    assert registry.get_group("testing.service").sids == ["a"]
+    assert registry.registered == 2
+
+    assert registry.list("testing.other") == [{"sid": "b", "worker": None, "path": "testing.other", "rooms": []}]
+
+    with pytest.raises(ValueError):
+        registry.register("a", "testing.invalid", strategy="random")
+
+    assert registry.unregister("a") == "testing.service"
+    assert registry.get_group("testing.service") is None
+
+    # The unknown and the unregistered sids are ignored
+    assert registry.unregister("a") is None
+    assert registry.unregister("c") is None
+    assert registry.disconnect("c") is None
+
+
+def test_registry_rooms():
+    registry = Registry()
+    registry.connect("a", None)
+    registry.connect("b", None)
+    registry.register("a", "sensors.a")
+
+    registry.join("a", "sensors.#")
+    registry.join("b", "sensors.#")
+    registry.join("b", "sensors.a")
+    assert registry.match("sensors.a") == {"a", "b"}
+    assert registry.rooms == {"sensors.#": {"a", "b"}, "sensors.a": {"b"}}
+
+    registry.leave("b", "sensors.a")
+    registry.leave("b", "sensors.b")
+    assert registry.rooms == {"sensors.#": {"a", "b"}}
+
+    assert registry.disconnect("b").rooms == {"sensors.#"}
+    assert registry.disconnect("a").path is None
+    assert registry.rooms == {} and registry.match("sensors.a") == set()
+    assert len(registry) == 0 and registry.registered == 0 and registry.groups == {}
@@ -0,0 +1,581 @@
+import asyncio
+import itertools
+import os
+
+import pytest
+
+from chatroom.bus import Bus
+from chatroom.fragment import Reassembler, split
+from chatroom.registry import ServiceGroup
+from chatroom.server import EIO_QUEUE_LIMIT, Server
+
+
+@pytest.fixture
+def make_server(monkeypatch):
+    # The server is driven by its handlers without the network, the emitted messages are recorded by sid and the
+    # Engine.IO queues of the slow sids are set by the test
+    monkeypatch.setattr(Server, "_init_zeroconfig", lambda self: None)
+
+    def make(**kwargs):
+        server = Server("testing", "127.0.0.1", 6543, "0.0.1", **kwargs)
+        server.received = {}
+        server.eio_queues = {}
+
+        async def emit(event, data, room=None, namespace=None):
+            for sid in [room] if isinstance(room, str) else room:
+                server.received.setdefault(sid, []).append((event, data))
+
+        for sio in server.sios.values():
+            monkeypatch.setattr(sio, "emit", emit)
+        monkeypatch.setattr(server, "_get_eio_queue", lambda sio, sid: server.eio_queues.get(sid))
+        return server
+
+    return make
+
+
+async def connect(server, sid, path=None, **client_info):
+    server.registry.connect(sid, server.sio)
+    server.connect(sid, {})
+    if path is not None:
+        msg = await server.register(sid, dict(client_info, path=path))
+        assert msg["success"]
+
+
+def test_batch_invalid_item(make_server):
+    async def main():
+        server = make_server()
+        await connect(server, "a", "testing.a")
+
+        msg = await server.batch("a", {"items": [{"type": "echo", "path": "testing.a", "payload": 1}, "invalid"]})
+        assert not msg["success"]
+        assert msg["errors"] == [{"index": 1, "error": "The item should be an object"}]
+        assert server.received["a"] == [("echo", {"path": "testing.a", "payload": 1})]
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("items", ["invalid", {"type": "echo"}, 1])
+def test_batch_invalid_items(make_server, items):
+    async def main():
+        server = make_server()
+        await connect(server, "a", "testing.a")
+
+        msg = await server.batch("a", {"items": items})
+        assert not msg["success"]
+        assert msg["error"] == "The items should be a list"
+        assert server.received.get("a", []) == []
+
+    asyncio.run(main())
+
+
+def test_echo_service_group(make_server):
+    async def main():
+        server = make_server()
+        await connect(server, "a", "testing.echo")
+        await connect(server, "b", "testing.echo")
+
+        # The echo returns to the sender even when another client shares its path
+        for sid in ("a", "b", "a"):
+            assert (await server.echo(sid, {"path": "testing.echo", "payload": sid}))["success"]
+        assert _events(server, "a", "echo") == [{"path": "testing.echo", "payload": "a"}] * 2
+        assert _events(server, "b", "echo") == [{"path": "testing.echo", "payload": "b"}]
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("weight", [0, -1, "heavy", None])
+def test_register_invalid_weight(make_server, weight):
+    async def main():
+        server = make_server()
+        await connect(server, "a")
+
+        msg = await server.register("a", {"path": "testing.a", "weight": weight})
+        assert not msg["success"]
+        assert "weight" in msg["error"]
+        assert server.registry.get_group("testing.a") is None
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("history", [["size", 1], 5, {"size": "many"}, {"size": -1}, {"max_bytes": True}])
+def test_register_invalid_history(make_server, history):
+    async def main():
+        server = make_server()
+        await connect(server, "a")
+
+        msg = await server.register("a", {"path": "testing.a", "history": history})
+        assert not msg["success"]
+        assert "history" in msg["error"]
+        assert server.registry.get_group("testing.a") is None
+        assert server.history.get_config("testing.a") == (server.history.size, server.history.max_bytes)
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("conflate", [["price"], {"field": "price"}, 1])
+def test_register_invalid_conflate(make_server, conflate):
+    async def main():
+        server = make_server()
+        await connect(server, "a")
+
+        msg = await server.register("a", {"path": "testing.a", "conflate": conflate})
+        assert not msg["success"]
+        assert "conflate" in msg["error"]
+        assert server.registry.get_group("testing.a") is None
+
+    asyncio.run(main())
+
+
+def test_publish_corrupt_payload(make_server):
+    async def main():
+        server = make_server()
+        await connect(server, "publisher", "testing.publisher")
+        await connect(server, "zlib", "testing.zlib", codecs=["zlib"])
+        await connect(server, "browser", "testing.browser")
+        for sid in ("zlib", "browser"):
+            await server.subscribe(sid, {"path": "testing.publisher"})
+
+        # The payload which can't be decompressed for the browser is still sent to the sids accepting the codec
+        payload = {"_compressed": "zlib", "data": b"corrupt"}
+        msg = await server.publish("publisher", {"payload": payload})
+        assert msg["success"]
+        assert server.received["zlib"] == [("publish", {"path": "testing.publisher", "payload": payload})]
+
+    asyncio.run(main())
+
+
+def _slow(server, sid):
+    # The Engine.IO queue of the slow sid is full until the test drains it
+    queue = server.eio_queues[sid] = asyncio.Queue()
+    for _ in range(EIO_QUEUE_LIMIT):
+        queue.put_nowait(None)
+    return queue
+
+
+async def _drain(queue):
+    while not queue.empty():
+        queue.get_nowait()
+        queue.task_done()
+    await asyncio.sleep(0.01)
+
+
+def _events(server, sid, event):
+    return [data for received_event, data in server.received.get(sid, []) if received_event == event]
+
+
+def test_slow_sid_outbox(make_server):
+    async def main():
+        server = make_server(outbound_max_messages=2)
+        await connect(server, "publisher", "testing.publisher")
+        await connect(server, "fast", "testing.fast")
+        await connect(server, "slow", "testing.slow")
+        for sid in ("fast", "slow"):
+            await server.subscribe(sid, {"path": "testing.publisher"})
+        queue = _slow(server, "slow")
+
+        # The fast sid receives every message, the outbox of the slow sid keeps the newest ones by drop_oldest
+        for index in range(4):
+            await server.publish("publisher", {"payload": index})
+        assert [data["payload"] for data in _events(server, "fast", "publish")] == [0, 1, 2, 3]
+        assert "slow" not in server.received
+        assert len(server.outboxes["slow"]) == 2 and server.outboxes["slow"].dropped == 2
+        assert server.metrics.dropped == 2
+
+        # The publisher learns the congestion of the receiver by its sid
+        backpressure = _events(server, "publisher", "backpressure")
+        assert [(data["sid"], data["path"], data["congested"]) for data in backpressure] == [
+            ("slow", "testing.slow", True)
+        ]
+
+        # The drained outbox sends the kept messages and tells the publisher
+        await _drain(queue)
+        assert [data["payload"] for data in _events(server, "slow", "publish")] == [2, 3]
+        assert [data["congested"] for data in _events(server, "publisher", "backpressure")] == [True, False]
+        assert "slow" not in server.outboxes
+
+    asyncio.run(main())
+
+
+def test_slow_sid_disconnect(make_server, monkeypatch):
+    async def main():
+        server = make_server(outbound_max_messages=1)
+        await connect(server, "publisher", "testing.publisher")
+        await connect(server, "slow", "testing.slow", outbound_policy="disconnect")
+        await server.subscribe("slow", {"path": "testing.publisher"})
+        _slow(server, "slow")
+
+        disconnected = []
+
+        async def disconnect(sid, namespace=None):
+            disconnected.append(sid)
+
+        monkeypatch.setattr(server.sio, "disconnect", disconnect)
+
+        # The slow sid with the disconnect policy is disconnected when its outbox is full
+        await server.publish("publisher", {"payload": 0})
+        assert disconnected == []
+        await server.publish("publisher", {"payload": 1})
+        assert disconnected == ["slow"]
+
+    asyncio.run(main())
+
+
+def test_conflated_topic(make_server):
+    async def main():
+        server = make_server()
+        await connect(server, "publisher", "testing.publisher", conflate="symbol")
+        await connect(server, "slow", "testing.slow")
+        await server.subscribe("slow", {"path": "testing.publisher"})
+        queue = _slow(server, "slow")
+
+        # The slow sid catches up to the newest value of every symbol instead of the backlog
+        for index in range(10):
+            for symbol in ("a", "b"):
+                await server.publish("publisher", {"payload": {"symbol": symbol, "price": index}})
+        await server.publish("publisher", {"payload": "other"})
+        assert len(server.outboxes["slow"]) == 3
+        assert server.metrics.conflated == 18
+
+        await _drain(queue)
+        assert [data["payload"] for data in _events(server, "slow", "publish")] == [
+            {"symbol": "a", "price": 9}, {"symbol": "b", "price": 9}, "other"
+        ]
+
+    asyncio.run(main())
+
+
+def test_outbox_lanes(make_server):
+    async def main():
+        server = make_server()
+        await connect(server, "caller", "testing.caller")
+        await connect(server, "callee", "testing.callee")
+        await server.subscribe("callee", {"path": "testing.caller"})
+        queue = _slow(server, "callee")
+
+        # The bulk transfer queued first doesn't delay the RPC and the control messages
+        for index in range(4):
+            await server.publish("caller", {"payload": index, "priority": "bulk"})
+        await server.rpc_request("caller", {"path": "testing.callee", "payload": {"id": "request", "method": "work"}})
+        await server.rpc_request("caller", {"path": "testing.callee", "payload": {"id": "other", "method": "work"}})
+        await server.rpc_cancel("caller", {"payload": {"id": "other"}})
+
+        await _drain(queue)
+        received = [(event, data["payload"]) for event, data in server.received["callee"]]
+        assert [(event, payload["id"]) for event, payload in received[:3]] == [
+            ("rpc_cancel", "other"), ("rpc_request", "request"), ("rpc_request", "other")
+        ]
+        assert received[3:] == [("publish", index) for index in range(4)]
+
+    asyncio.run(main())
+
+
+def test_history_replay(make_server):
+    async def main():
+        server = make_server(history_size=2)
+        await connect(server, "publisher", "testing.publisher")
+        for index in range(3):
+            await server.publish("publisher", {"payload": index})
+
+        # The new subscriber receives the kept messages before the reply
+        await connect(server, "subscriber", "testing.subscriber")
+        await server.subscribe("subscriber", {"path": "testing.publisher"})
+        assert [data["payload"] for data in _events(server, "subscriber", "publish")] == [1, 2]
+
+        await server.subscribe("subscriber", {"path": "testing.publisher", "replay": False})
+        assert len(_events(server, "subscriber", "publish")) == 2
+
+    asyncio.run(main())
+
+
+def test_publish_while_subscribing(make_server, monkeypatch):
+    async def main():
+        server = make_server(history_size=10)
+        await connect(server, "publisher", "testing.publisher")
+
+        # The emit yields like the Socket.IO manager, the subscribe runs while the publish is sending
+        emit = server.sio.emit
+
+        async def yielding_emit(*args, **kwargs):
+            await asyncio.sleep(0)
+            await emit(*args, **kwargs)
+
+        monkeypatch.setattr(server.sio, "emit", yielding_emit)
+
+        for index in range(3):
+            sid = "subscriber-{}".format(index)
+            await connect(server, sid, "testing.subscriber")
+            await asyncio.gather(server.publish("publisher", {"_uid": "uid", "payload": index}),
+                                 server.subscribe(sid, {"path": "testing.publisher"}))
+
+            # Every message published before or during the subscribe is received once, in order
+            assert [data["payload"] for data in _events(server, sid, "publish")] == list(range(index + 1))
+
+    asyncio.run(main())
+
+
+def test_history_fragments(make_server):
+    async def main():
+        server = make_server(history_size=2)
+        await connect(server, "publisher", "testing.publisher")
+
+        # The frames of the messages published at the same time are kept by their fragment id
+        first = list(split({"payload": "first " * 100}, 100))
+        second = list(split({"payload": "second " * 100}, 100))
+        for frames in itertools.zip_longest(first, second):
+            for frame in frames:
+                if frame is not None:
+                    await server.publish("publisher", frame)
+        assert server.history_fragments == {}
+
+        await connect(server, "subscriber", "testing.subscriber")
+        await server.subscribe("subscriber", {"path": "testing.publisher"})
+
+        reassembler = Reassembler()
+        payloads = [reassembler.reassemble(data) for data in _events(server, "subscriber", "publish")]
+        assert [data["payload"] for data in payloads if data is not None] == ["first " * 100, "second " * 100]
+
+    asyncio.run(main())
+
+
+def test_history_disabled(make_server):
+    async def main():
+        server = make_server()
+        await connect(server, "publisher", "testing.publisher")
+
+        # Nothing is buffered for the topic without the history
+        frames = list(split({"payload": "x" * 1000}, 100))
+        for frame in frames[:-1]:
+            await server.publish("publisher", frame)
+        assert server.history_fragments == {}
+        assert len(server.history) == 0
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("payload", [
+    None,
+    "request",
+    {"method": "work"},
+    {"id": 1, "method": "work"},
+    {"id": "request", "method": "work", "timeout": "soon"},
+    {"id": "request", "method": "work", "timeout": 0},
+    {"id": "request", "method": "work", "timeout": True},
+])
+def test_rpc_request_invalid(make_server, payload):
+    async def main():
+        server = make_server()
+        await connect(server, "caller", "testing.caller")
+        await connect(server, "callee", "testing.callee")
+
+        # The invalid request is replied without routing it or counting it for the callee
+        msg = await server.rpc_request("caller", {"path": "testing.callee", "payload": payload})
+        assert not msg["success"]
+        assert server.rpc_routes == {}
+        assert server.registry.get_group("testing.callee").outstanding == {"callee": 0}
+        assert "callee" not in server.received
+
+    asyncio.run(main())
+
+
+def test_rpc_request_timeout(make_server):
+    async def main():
+        server = make_server(rpc_timeout=10)
+        await connect(server, "caller", "testing.caller")
+        await connect(server, "callee", "testing.callee")
+
+        # The timeout of the caller is capped by the server
+        payload = {"id": "request", "method": "work", "timeout": 3600}
+        assert (await server.rpc_request("caller", {"path": "testing.callee", "payload": payload}))["success"]
+        assert server.rpc_routes["request"].timeout == 10
+
+        # The id of a routed request can't be reused, the caller without the ack fails by the response
+        assert not (await server.rpc_request("caller", {"path": "testing.callee", "payload": payload}))["success"]
+        assert [data["payload"]["id"] for data in _events(server, "caller", "rpc_response")] == ["request"]
+        assert server.registry.get_group("testing.callee").outstanding == {"callee": 1}
+
+    asyncio.run(main())
+
+
+def test_rate_limit(make_server):
+    async def main():
+        server = make_server(rate_limits={"publish": (1, 1), "rpc_request": (1, 1)})
+        publish = server.sio.handlers["/chat"]["publish"]
+        rpc_request = server.sio.handlers["/chat"]["rpc_request"]
+        await connect(server, "caller", "testing.caller")
+        await connect(server, "callee", "testing.callee")
+
+        # The message over the limit is rejected, the publisher without the ack is told by the rate_limit event
+        assert (await publish("caller", {"payload": 0}))["success"]
+        msg = await publish("caller", {"payload": 1})
+        assert not msg["success"] and msg["rate_limited"] and msg["retry_after"] > 0
+        assert [data["event"] for data in _events(server, "caller", "rate_limit")] == ["publish"]
+
+        # The caller of the request fails by the response
+        request = {"path": "testing.callee", "payload": {"id": "first", "method": "work", "parameters": {}}}
+        assert (await rpc_request("caller", request))["success"]
+        request = dict(request, payload=dict(request["payload"], id="second"))
+        assert not (await rpc_request("caller", request))["success"]
+        responses = _events(server, "caller", "rpc_response")
+        assert [data["payload"]["id"] for data in responses] == ["second"]
+        assert "rate limit" in responses[0]["payload"]["error"]
+        assert "second" not in server.rpc_routes
+        assert server.metrics.limited == 2
+
+    asyncio.run(main())
+
+
+def test_rate_limit_fragments(make_server):
+    async def main():
+        server = make_server(rate_limits={"publish": (1, 1)})
+        publish = server.sio.handlers["/chat"]["publish"]
+        await connect(server, "publisher", "testing.publisher")
+        await connect(server, "subscriber", "testing.subscriber")
+        await server.subscribe("subscriber", {"path": "testing.publisher"})
+
+        # The fragmented message takes one token by its first frame
+        frames = list(split({"payload": "x" * 1000}, 100))
+        assert all([(await publish("publisher", frame))["success"] for frame in frames])
+        assert len(_events(server, "subscriber", "publish")) == len(frames)
+        assert server.admitted_fragments == {}
+
+        # The following frames of the rejected message are dropped too
+        frames = list(split({"payload": "y" * 1000}, 100))
+        assert not any([(await publish("publisher", frame))["success"] for frame in frames])
+        assert len(_events(server, "subscriber", "publish")) == len(frames)
+        assert server.metrics.limited == 1
+
+    asyncio.run(main())
+
+
+async def _start_workers(make_server, folder, count=2, **kwargs):
+    # The workers of one server in the same process, connected by their buses
+    paths = [os.path.join(folder, "worker-{}.sock".format(index)) for index in range(count)]
+    servers = [make_server(**kwargs) for _ in range(count)]
+    for index, server in enumerate(servers):
+        server.worker = index
+        server.bus = Bus(index, paths, server._on_bus_message, on_connect=server._on_bus_connect,
+                         on_disconnect=server._on_bus_disconnect, timeout=1)
+        await server.bus.start()
+
+    for _ in range(100):
+        if all(len(server.bus.writers) == count - 1 for server in servers):
+            break
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.05)
+
+    return servers
+
+
+def test_workers(make_server, tmp_path):
+    async def main():
+        first, second = await _start_workers(make_server, str(tmp_path), history_size=2)
+        await connect(first, "caller", "testing.caller")
+        await connect(second, "callee", "testing.callee", weight=2)
+        await second.subscribe("callee", {"path": "testing.caller"})
+        await asyncio.sleep(0.05)
+
+        # Every worker keeps the records of the clients of the others
+        record = first.registry.get("callee")
+        assert record.worker == 1 and record.path == "testing.callee" and record.rooms == {"testing.caller"}
+        assert first.registry.get_group("testing.callee").weights == {"callee": 2}
+        assert second.registry.get("caller").worker == 0
+
+        # The request is sent by the worker of the callee, its response is routed back by the worker of the route
+        request = {"path": "testing.callee", "payload": {"id": "request", "method": "work", "parameters": {}}}
+        assert (await first.rpc_request("caller", request))["success"]
+        await asyncio.sleep(0.05)
+        assert _events(second, "callee", "rpc_request") == [dict(request, path="testing.caller")]
+        assert second.remote_routes == {"request": 0}
+
+        response = {"path": "testing.caller", "payload": {"id": "request", "result": 3, "error": None}}
+        assert (await second.rpc_response("callee", response))["success"]
+        await asyncio.sleep(0.05)
+        assert [data["payload"]["result"] for data in _events(first, "caller", "rpc_response")] == [3]
+        assert first.rpc_routes == {} and second.remote_routes == {}
+
+        # The publish reaches the subscribers of the other workers, the new subscriber receives their history
+        await first.publish("caller", {"payload": 0})
+        await asyncio.sleep(0.05)
+        assert [data["payload"] for data in _events(second, "callee", "publish")] == [0]
+
+        await connect(second, "late", "testing.late")
+        await second.subscribe("late", {"path": "testing.caller"})
+        assert [data["payload"] for data in _events(second, "late", "publish")] == [0]
+
+        # The clients of the gone worker are removed
+        await second.bus.stop()
+        await asyncio.sleep(0.1)
+        assert "callee" not in first.registry and first.registry.get_group("testing.callee") is None
+        await first.bus.stop()
+
+    asyncio.run(main())
+
+
+def test_replay_before_live(make_server, tmp_path):
+    async def main():
+        first, second = await _start_workers(make_server, str(tmp_path), history_size=2)
+        await connect(first, "publisher", "testing.publisher")
+        await connect(second, "subscriber", "testing.subscriber")
+        await first.publish("publisher", {"payload": "history"})
+
+        # The live publish after the other worker joins the subscriber is sent after the replay, but only once
+        call = second.bus.call
+
+        async def slow_call(peer, message):
+            result = await call(peer, message)
+            await first.publish("publisher", {"payload": "live"})
+            await asyncio.sleep(0.05)
+            return result
+
+        second.bus.call = slow_call
+        await second.subscribe("subscriber", {"path": "testing.publisher"})
+        assert [data["payload"] for data in _events(second, "subscriber", "publish")] == ["history", "live"]
+        assert second.replaying == {}
+
+        await first.bus.stop()
+        await second.bus.stop()
+
+    asyncio.run(main())
+
+
+def test_service_group_round_robin():
+    group = ServiceGroup("testing.service")
+    group.add("a")
+    group.add("b")
+
+    assert [group.select() for _ in range(4)] == ["a", "b", "a", "b"]
+
+    group.remove("a")
+    assert [group.select() for _ in range(2)] == ["b", "b"]
+
+    # The removed sid is replaced by the last one in O(1)
+    for sid in ("c", "d", "e"):
+        group.add(sid)
+    group.remove("c")
+    assert group.sids == ["b", "e", "d"]
+    assert group.positions == {"b": 0, "e": 1, "d": 2}
+    assert sorted(group.select() for _ in range(3)) == ["b", "d", "e"]
+
+
+def test_service_group_least_outstanding():
+    group = ServiceGroup("testing.service", ServiceGroup.LEAST_OUTSTANDING)
+    group.add("a")
+    group.add("b")
+
+    group.acquire("a")
+    assert group.select() == "b"
+
+    group.acquire("b")
+    group.acquire("b")
+    group.release("a")
+    assert group.select() == "a"
+
+
+def test_service_group_weighted():
+    group = ServiceGroup("testing.service", ServiceGroup.WEIGHTED)
+    group.add("a", weight=3)
+    group.add("b", weight=1)
+
+    selected = [group.select() for _ in range(8)]
+    assert selected.count("a") == 6
+    assert selected.count("b") == 2
@@ -0,0 +1,86 @@
+import asyncio
+import gc
+
+import pytest
+
+from chatroom.stream import AsyncRPCStream, RPCStream
+from chatroom.utils import RPCError
+
+
+def test_rpc_stream_credits():
+    credits = []
+    stream = RPCStream("request", 4, lambda id, credit: credits.append((id, credit)))
+
+    for index in range(5):
+        stream.put(index)
+    stream.finish()
+
+    # The credits are returned when half of the window is consumed
+    assert list(stream) == [0, 1, 2, 3, 4]
+    assert credits == [("request", 2), ("request", 2)]
+    assert list(stream) == []
+
+
+def test_rpc_stream_error():
+    stream = RPCStream("request", 4, lambda id, credit: None)
+    stream.put(0)
+    stream.set_error(RPCError("failed"))
+
+    assert next(stream) == 0
+    with pytest.raises(RPCError):
+        next(stream)
+
+
+def test_rpc_stream_cancel():
+    cancelled = []
+    stream = RPCStream("request", 4, lambda id, credit: None, cancel=cancelled.append)
+    stream.put(0)
+
+    # The stream closed before the end cancels the request only once
+    assert next(stream) == 0
+    stream.close()
+    stream.close()
+    assert cancelled == ["request"]
+    assert list(stream) == []
+
+    # The finished stream is not cancelled
+    stream = RPCStream("finished", 4, lambda id, credit: None, cancel=cancelled.append)
+    stream.finish()
+    assert list(stream) == []
+    stream.close()
+    assert cancelled == ["request"]
+
+    # The stream dropped by the caller is cancelled, the sink kept by the pending requests doesn't keep it alive
+    stream = RPCStream("dropped", 4, lambda id, credit: None, cancel=cancelled.append)
+    sink = stream.sink
+    del stream
+    gc.collect()
+    sink.put(0)
+    assert cancelled == ["request", "dropped"]
+
+
+def test_async_rpc_stream_cancel():
+    async def main():
+        cancelled = []
+
+        async def cancel(id):
+            cancelled.append(id)
+
+        async def send_credit(id, credit):
+            pass
+
+        async with AsyncRPCStream("request", 4, send_credit, cancel, asyncio.get_running_loop()) as stream:
+            stream.put(0)
+            async for chunk in stream:
+                assert chunk == 0
+                break
+        assert cancelled == ["request"]
+
+        # The stream dropped without aclose() schedules the cancel in the event loop
+        stream = AsyncRPCStream("dropped", 4, send_credit, cancel, asyncio.get_running_loop())
+        del stream
+        gc.collect()
+        await asyncio.sleep(0.01)
+        assert cancelled == ["request", "dropped"]
+
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+import asyncio
+import threading
+
+import pytest
+
+from chatroom.utils import AsyncEvent, PathTrie
+
+
+def test_path_trie_match():
+    trie = PathTrie()
+    trie.add("sensors.temperature", "exact")
+    trie.add("sensors.*", "single")
+    trie.add("sensors.#", "multi")
+
+    assert trie.match("sensors") == {"multi"}
+    assert trie.match("sensors.temperature") == {"exact", "single", "multi"}
+    assert trie.match("sensors.temperature.room") == {"multi"}
+    assert trie.match("actuators.motor") == set()
+
+
+def test_path_trie_remove():
+    trie = PathTrie()
+    trie.add("sensors.*", "a")
+    trie.add("sensors.*", "b")
+
+    trie.remove("sensors.*", "a")
+    assert trie.match("sensors.temperature") == {"b"}
+
+    trie.remove("sensors.*", "b")
+    assert trie.match("sensors.temperature") == set()
+    assert trie.root.children == {}
+
+
+def test_async_event_threadsafe():
+    async def main():
+        # The event set by another thread before the first wait wakes up the loop
+        event = AsyncEvent(loop=asyncio.get_running_loop())
+        thread = threading.Thread(target=event.set_msg, args=("message",))
+        thread.start()
+        thread.join()
+        assert await event.wait(timeout=1) == "message"
+
+        event = AsyncEvent(threadsafe=False)
+        event.set_error(ValueError("failed"))
+        with pytest.raises(ValueError):
+            await event.wait(timeout=1)
+
+    asyncio.run(main())